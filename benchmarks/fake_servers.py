@@ -0,0 +1,352 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Genres served by the fake TMDb genre list and the fake Notion database schema
+GENRES = {28: "Action", 12: "Adventure", 35: "Comedy", 18: "Drama", 27: "Horror", 878: "Science Fiction"}
+
+# Path segments that are ids are replaced by this in the request counts, so requests are counted per endpoint
+ID_PATTERN = re.compile(r"/(\d+|[0-9a-f]{8}-[0-9a-f-]{27}|person-\d+)(?=/|$)")
+
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class FakeServer():
+    """Local HTTP server standing in for an API, with a fixed `latency` per request and injected throttling and outages.
+
+    A request is answered with 429 Too Many Requests with probability `throttle_probability`, or when more
+    than `rate_limit` requests arrive within a second. It is answered with 503 Service Unavailable with
+    probability `error_probability`, or always when its endpoint, like `GET /3/movie/{id}/credits`, is in
+    `failing_endpoints`. Every request is counted per endpoint in `counts`.
+    """
+
+    def __init__(self, latency: float = 0.0, throttle_probability: float = 0.0, rate_limit: "float | None" = None, retry_after: float = 1.0, error_probability: float = 0.0, failing_endpoints: "list[str] | None" = None, seed: int = 0) -> None:
+        self.latency = latency
+        self.throttle_probability = throttle_probability
+        self.error_probability = error_probability
+        self.failing_endpoints = set(failing_endpoints or [])
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.counts: "dict[str, int]" = {}
+        self.throttled = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = 0.0
+        self._window_count = 0
+        self._server: "ThreadingHTTPServer | None" = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> "FakeServer":
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_PATCH(self):
+                server.handle(self, "PATCH")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+            self.throttled = 0
+            self.errors = 0
+
+    def _is_throttled(self) -> bool:
+        with self._lock:
+            if self.throttle_probability and self._random.random() < self.throttle_probability:
+                return True
+            if self.rate_limit is None:
+                return False
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit
+
+    def _is_failing(self, endpoint: str) -> bool:
+        with self._lock:
+            return endpoint in self.failing_endpoints or (self.error_probability and self._random.random() < self.error_probability)
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        url = urlparse(handler.path)
+        # The first segment is the API version, like /3 or /v1
+        version, _, path = url.path.lstrip("/").partition("/")
+        endpoint = f"{method} /{version}{ID_PATTERN.sub('/{id}', '/' + path)}"
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self._is_throttled():
+            with self._lock:
+                self.throttled += 1
+            self._reply(handler, 429, {"message": "rate limited"}, headers={"Retry-After": str(self.retry_after)})
+            return
+
+        if self._is_failing(endpoint):
+            with self._lock:
+                self.errors += 1
+            self._reply(handler, 503, {"message": "service unavailable", "status_message": "service unavailable"})
+            return
+
+        body = None
+        if method in ("POST", "PATCH"):
+            length = int(handler.headers.get("Content-Length") or 0)
+            body = json.loads(handler.rfile.read(length) or b"{}")
+
+        status, data = self.respond(method, url.path, parse_qs(url.query), body)
+        self._reply(handler, status, data)
+
+    @staticmethod
+    def _reply(handler: BaseHTTPRequestHandler, status: int, data: dict, headers: "dict[str, str] | None" = None):
+        content = json.dumps(data).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def respond(self, method: str, path: str, query: "dict[str, list[str]]", body: "dict | None") -> "tuple[int, dict]":
+        raise NotImplementedError
+
+
+class FakeTMDb(FakeServer):
+    """Stand-in for the TMDb API with `people` synthetic persons.
+
+    Each person has `credits_per_person` movie credits drawn from a shared pool of movies, so the same
+    movie shows up for several persons. Every tenth movie in the pool is upcoming.
+    """
+
+    def __init__(self, people: int, credits_per_person: int = 20, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.people = people
+        pool_size = max(50, people * credits_per_person // 4)
+
+        generator = random.Random(people)
+        self.credits: "dict[int, list[int]]" = {}
+        self.cast: "dict[int, set[int]]" = {}
+        for index in range(people):
+            person_id = person_tmdb_id(index)
+            movie_ids = generator.sample(range(1, pool_size + 1), min(credits_per_person, pool_size))
+            self.credits[person_id] = movie_ids
+            for movie_id in movie_ids:
+                self.cast.setdefault(movie_id, set()).add(person_id)
+
+    @staticmethod
+    def movie(movie_id: int) -> dict:
+        upcoming = movie_id % 10 == 0
+        return {
+            "id": movie_id,
+            "title": f"Movie {movie_id}",
+            "overview": f"Synopsis of movie {movie_id}",
+            "genre_ids": [list(GENRES)[movie_id % len(GENRES)]],
+            "popularity": float(movie_id % 100),
+            "release_date": "2099-01-01" if upcoming else "2001-01-01",
+            "adult": False,
+            "video": False,
+        }
+
+    def respond(self, method, path, query, body):
+        parts = path.strip("/").split("/")[1:]
+
+        if parts == ["genre", "movie", "list"]:
+            return 200, {"genres": [{"id": genre_id, "name": name} for genre_id, name in GENRES.items()]}
+
+        if parts == ["search", "person"]:
+            name = query.get("query", [""])[0]
+            match = re.fullmatch(r"Person (\d+)", unquote(name))
+            results = [{"id": person_tmdb_id(int(match.group(1))), "name": name}] if match else []
+            return 200, {"page": 1, "total_pages": 1, "results": results}
+
+        if parts == ["movie", "changes"]:
+            return 200, {"page": 1, "total_pages": 1, "results": []}
+
+        if parts == ["discover", "movie"]:
+            # Pipe separated person ids match the movies of any of the persons, like in the batch scan mode
+            person_ids = [int(person_id) for person_id in (query.get("with_cast") or query.get("with_crew"))[0].split("|")]
+            movie_ids = {movie_id for person_id in person_ids for movie_id in self.credits.get(person_id, [])}
+            movies = sorted((self.movie(movie_id) for movie_id in sorted(movie_ids)), key=lambda movie: movie["release_date"], reverse=True)
+            page = int(query.get("page", ["1"])[0])
+            return 200, {"page": page, "total_pages": max(1, (len(movies) + 19) // 20), "results": movies[20 * (page - 1):20 * page]}
+
+        if len(parts) == 3 and parts[0] == "person" and parts[2] == "movie_credits":
+            person_id = int(parts[1])
+            movies = [self.movie(movie_id) for movie_id in self.credits.get(person_id, [])]
+            return 200, {
+                "cast": [{**movie, "character": "Someone"} for movie in movies],
+                "crew": [{**movie, "job": "Director"} for movie in movies[:2]],
+            }
+
+        if len(parts) == 3 and parts[0] == "person" and parts[2] == "external_ids":
+            return 200, {"imdb_id": f"nm{parts[1]}"}
+
+        if len(parts) == 3 and parts[0] == "movie" and parts[2] == "external_ids":
+            return 200, {"imdb_id": f"tt{parts[1]}"}
+
+        if len(parts) == 3 and parts[0] == "movie" and parts[2] == "credits":
+            person_ids = sorted(self.cast.get(int(parts[1]), []))
+            return 200, {"cast": [{"id": person_id} for person_id in person_ids], "crew": [{"id": person_id, "job": "Director"} for person_id in person_ids]}
+
+        if len(parts) == 2 and parts[0] == "movie":
+            movie = self.movie(int(parts[1]))
+            movie["genres"] = [{"id": genre_id, "name": GENRES[genre_id]} for genre_id in movie.pop("genre_ids")]
+            movie["imdb_id"] = f"tt{parts[1]}"
+            movie["status"] = "Planned" if movie["release_date"] > "2090" else "Released"
+            return 200, movie
+
+        return 404, {"status_message": "The resource you requested could not be found."}
+
+
+class FakeNotion(FakeServer):
+    """Stand-in for the Notion API with the person, upcoming and released databases.
+
+    Supports the paginated database queries with the filters used by `NotionUpdater`, and creating,
+    changing and archiving pages.
+    """
+
+    def __init__(self, person_database_id: str = "personlist", upcoming_database_id: str = "upcoming", released_database_id: str = "released", **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.person_database_id = person_database_id
+        self.databases: "dict[str, list[dict]]" = {person_database_id: [], upcoming_database_id: [], released_database_id: []}
+        self.pages: "dict[str, dict]" = {}
+
+    def add_persons(self, people: int, unresolved_fraction: float = 0.0):
+        """Fill the person database with `people` persons, of which `unresolved_fraction` have no urls."""
+        generator = random.Random(people)
+        for index in range(people):
+            resolved = generator.random() >= unresolved_fraction
+            tmdb_id = person_tmdb_id(index)
+            properties = {
+                "Name": {"title": [{"text": {"content": f"Person {index}"}, "plain_text": f"Person {index}"}]},
+                "Tags": {"multi_select": [{"name": "Director"}] if index % 5 == 0 else [{"name": "Actor"}]},
+                "IMDb URL": {"url": f"https://imdb.com/name/nm{tmdb_id}" if resolved else None},
+                "TMDb URL": {"url": f"https://www.themoviedb.org/person/{tmdb_id}-person-{index}" if resolved else None},
+                "Upcoming projects": {"relation": []},
+            }
+            self._add_page(self.person_database_id, f"person-{index}", properties)
+
+    def exclude_projects(self, fraction: float, database_id: str = "upcoming") -> int:
+        """Check the Exclude checkbox of `fraction` of the projects linked to a person, like a user would. Returns the number of projects."""
+        with self._lock:
+            pages = [page for page in self.databases[database_id] if not page["archived"] and page["properties"].get("Included people", {}).get("relation")]
+            excluded = pages[:round(len(pages) * fraction)]
+            for page in excluded:
+                page["properties"]["Exclude"] = {"checkbox": True}
+                page["last_edited_time"] = timestamp()
+        return len(excluded)
+
+    def _add_page(self, database_id: str, page_id: str, properties: dict) -> dict:
+        page = {"object": "page", "id": page_id, "last_edited_time": timestamp(), "archived": False, "in_trash": False, "parent": {"database_id": database_id}, "properties": properties}
+        with self._lock:
+            self.databases[database_id].append(page)
+            self.pages[page_id] = page
+        return page
+
+    @staticmethod
+    def _matches(page: dict, query_filter: "dict | None") -> bool:
+        if not query_filter:
+            return True
+        if "and" in query_filter:
+            return all(FakeNotion._matches(page, condition) for condition in query_filter["and"])
+        if query_filter.get("timestamp") == "last_edited_time":
+            return page["last_edited_time"] >= query_filter["last_edited_time"]["on_or_after"]
+        value = page["properties"].get(query_filter["property"], {})
+        if "url" in query_filter:
+            return value.get("url") == query_filter["url"]["equals"]
+        if "checkbox" in query_filter:
+            return value.get("checkbox", False) == query_filter["checkbox"]["equals"]
+        return True
+
+    @staticmethod
+    def _with_plain_text(properties: dict) -> dict:
+        """Add the `plain_text` that Notion returns to title and rich text properties."""
+        for value in properties.values():
+            for kind in ("title", "rich_text"):
+                if kind in value:
+                    value[kind] = [{**text, "plain_text": text["text"]["content"]} for text in value[kind]]
+        return properties
+
+    def _link_people(self, page: dict):
+        """Add the backlinks from the persons in the Included people of a project page, like Notion does."""
+        with self._lock:
+            for relation in page["properties"].get("Included people", {}).get("relation", []):
+                person = self.pages.get(relation["id"])
+                if person is None:
+                    continue
+                backlinks = person["properties"]["Upcoming projects"]["relation"]
+                if {"id": page["id"]} not in backlinks:
+                    backlinks.append({"id": page["id"]})
+                    person["last_edited_time"] = timestamp()
+
+    def respond(self, method, path, query, body):
+        parts = path.strip("/").split("/")[1:]
+
+        if method == "POST" and len(parts) == 3 and parts[0] == "databases" and parts[2] == "query":
+            with self._lock:
+                pages = [page for page in self.databases.get(parts[1], []) if not page["archived"] and self._matches(page, body.get("filter"))]
+            start = int(body.get("start_cursor") or 0)
+            size = min(body.get("page_size", 100), 100)
+            has_more = start + size < len(pages)
+            return 200, {"object": "list", "results": pages[start:start + size], "has_more": has_more, "next_cursor": str(start + size) if has_more else None}
+
+        if method == "GET" and len(parts) == 2 and parts[0] == "databases":
+            options = [{"id": str(uuid.uuid5(uuid.NAMESPACE_DNS, name)), "name": name, "color": "default"} for name in GENRES.values()]
+            return 200, {"object": "database", "id": parts[1], "properties": {"Genres": {"multi_select": {"options": options}}}}
+
+        if method == "POST" and parts == ["pages"]:
+            database_id = body["parent"]["database_id"]
+            properties = self._with_plain_text(body["properties"])
+            if database_id != self.person_database_id:
+                properties.setdefault("Exclude", {"checkbox": False})
+            page = self._add_page(database_id, str(uuid.uuid4()), properties)
+            self._link_people(page)
+            return 200, page
+
+        if method == "PATCH" and len(parts) == 2 and parts[0] == "pages":
+            with self._lock:
+                page = self.pages.get(parts[1])
+                if page is None:
+                    return 404, {"message": f"Could not find page with ID: {parts[1]}."}
+                page["properties"].update(self._with_plain_text(body.get("properties", {})))
+                if "archived" in body:
+                    page["archived"] = body["archived"]
+                page["last_edited_time"] = timestamp()
+            self._link_people(page)
+            return 200, page
+
+        return 404, {"message": f"Invalid request URL: {path}"}
+
+
+def person_tmdb_id(index: int) -> int:
+    return 100000 + index
@@ -0,0 +1,163 @@
+"""Measure how a run scales with the size of the PersonList, against local stand-ins for the TMDb and Notion APIs.
+
+Every scenario runs in a fresh process and a temporary working directory, so the local state, caches and
+module globals of one scenario never leak into the next. The scenarios are:
+
+    first_run             `main()` with an empty UpcomingProjects database
+    second_run            `main()` again right after a first run, which only measures the second run
+    excluded_second_run   like second_run, after checking the Exclude checkbox of some of the created projects
+    daemon_second_cycle   a cycle of the daemon mode right after a first cycle, which only measures the second cycle
+    read_person_database  `NotionUpdater.person_list` with an empty local state
+
+Example:
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 --notion-rate 100 --tmdb-rate 300 --output data/benchmarks.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from fake_servers import FakeNotion, FakeTMDb
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+
+SCENARIOS = ["first_run", "second_run", "excluded_second_run", "daemon_second_cycle", "read_person_database"]
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+
+
+def run_scenario_process(args: argparse.Namespace, name: str, working_directory: str, environment: dict) -> dict:
+    command = [sys.executable, os.path.join(BENCHMARK_DIRECTORY, "scenario.py"), name, "--log-level", args.log_level]
+    if args.tmdb_rate:
+        command += ["--tmdb-rate", str(args.tmdb_rate)]
+    if args.notion_rate:
+        command += ["--notion-rate", str(args.notion_rate)]
+    if args.scan_mode:
+        command += ["--scan-mode", args.scan_mode]
+
+    process = subprocess.run(command, cwd=working_directory, env=environment, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"The {name} scenario failed:\n{process.stderr}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(args: argparse.Namespace, scenario: str, people: int) -> dict:
+    """Run `scenario` with `people` persons and return its measurements."""
+    server_options = {"latency": args.latency, "throttle_probability": args.throttle_probability, "error_probability": args.error_probability}
+    tmdb = FakeTMDb(people=people, credits_per_person=args.credits_per_person, rate_limit=args.tmdb_server_rate_limit, failing_endpoints=args.failing_endpoints, **server_options).start()
+    notion = FakeNotion(rate_limit=args.notion_server_rate_limit, failing_endpoints=args.failing_endpoints, **server_options).start()
+    notion.add_persons(people, unresolved_fraction=args.unresolved_fraction)
+
+    environment = {
+        **os.environ,
+        "TMDB_API_BASE_URL": f"{tmdb.base_url}/3",
+        "TMDB_API_TOKEN": "benchmark",
+        "NOTION_API_BASE_URL": f"{notion.base_url}/v1",
+        "NOTION_API_TOKEN": "benchmark",
+        "PERSON_LIST_DATABASE_ID": notion.person_database_id,
+        "UPCOMING_PROJECTS_DATABASE_ID": "upcoming",
+        "RELEASED_PROJECTS_DATABASE_ID": "released",
+    }
+
+    working_directory = tempfile.mkdtemp(prefix="scraper-benchmark-")
+    # The log of the run goes to the working directory instead of the log of the real runs
+    environment["LOG_DIRECTORY"] = os.path.join(working_directory, "data")
+    try:
+        os.makedirs(os.path.join(working_directory, "data"))
+        shutil.copytree(os.path.join(REPOSITORY_DIRECTORY, "notion_multiselect_genres"), os.path.join(working_directory, "notion_multiselect_genres"))
+
+        process_name = {"read_person_database": "read_person_database", "daemon_second_cycle": "daemon_cycle"}.get(scenario, "main")
+        if scenario in ("second_run", "excluded_second_run", "daemon_second_cycle"):
+            run_scenario_process(args, process_name, working_directory, environment)
+            if scenario == "excluded_second_run":
+                excluded_projects = notion.exclude_projects(args.excluded_fraction)
+            tmdb.reset_counts()
+            notion.reset_counts()
+
+        measurements = run_scenario_process(args, process_name, working_directory, environment)
+
+        # Runs of `main()` and the daemon write a run report with the duration of each phase
+        report_filename = os.path.join(working_directory, "data", "run_report.json")
+        if os.path.isfile(report_filename):
+            with open(report_filename, "r") as f:
+                report = json.load(f)
+            measurements["phases_seconds"] = report["phases_seconds"]
+            measurements["limiter_sleep_seconds"] = sum(host["limiter_sleep_seconds"] for host in report["hosts"].values())
+            measurements["retry_sleep_seconds"] = sum(host["retry_sleep_seconds"] for host in report["hosts"].values())
+            measurements["request_events"] = {
+                f"{endpoint['endpoint']} {event}": count for endpoint in report["endpoints"] for event, count in endpoint.get("events", {}).items()
+            }
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+        tmdb.stop()
+        notion.stop()
+
+    tmdb_requests = sum(tmdb.counts.values())
+    notion_requests = sum(notion.counts.values())
+    if scenario == "excluded_second_run":
+        measurements["excluded_projects"] = excluded_projects
+    return {
+        "scenario": scenario,
+        "people": people,
+        **measurements,
+        "tmdb_requests": tmdb_requests,
+        "notion_requests": notion_requests,
+        "requests_per_person": (tmdb_requests + notion_requests) / people,
+        "people_per_second": people / measurements["wall_time"],
+        "tmdb_throttled": tmdb.throttled,
+        "notion_throttled": notion.throttled,
+        "tmdb_errors": tmdb.errors,
+        "notion_errors": notion.errors,
+        "upcoming_pages": len([page for page in notion.databases["upcoming"] if not page["archived"]]),
+        "tmdb_endpoints": dict(sorted(tmdb.counts.items())),
+        "notion_endpoints": dict(sorted(notion.counts.items())),
+    }
+
+
+def print_table(results: "list[dict]"):
+    columns = [
+        ("scenario", "{}", 22), ("people", "{}", 7), ("wall_time", "{:.2f}", 10), ("cpu_time", "{:.2f}", 9),
+        ("peak_memory_mb", "{:.0f}", 15), ("tmdb_requests", "{}", 14), ("notion_requests", "{}", 16),
+        ("requests_per_person", "{:.2f}", 20), ("people_per_second", "{:.1f}", 18),
+    ]
+    print("".join(name.ljust(width) for name, _, width in columns))
+    for result in results:
+        print("".join(template.format(result.get(name, "")).ljust(width) if name in result else "-".ljust(width) for name, template, width in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of persons in the PersonList database")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--credits-per-person", type=int, default=20, help="movie credits of each person on TMDb, of which about one in ten is upcoming")
+    parser.add_argument("--unresolved-fraction", type=float, default=0.05, help="fraction of the persons without TMDb and IMDb urls")
+    parser.add_argument("--excluded-fraction", type=float, default=0.1, help="fraction of the created projects that are excluded before the excluded_second_run scenario")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake server takes to answer a request")
+    parser.add_argument("--throttle-probability", type=float, default=0.0, help="probability of answering a request with 429 Too Many Requests")
+    parser.add_argument("--error-probability", type=float, default=0.0, help="probability of answering a request with 503 Service Unavailable")
+    parser.add_argument("--failing-endpoints", nargs="+", help="endpoints that always answer with 503, like 'GET /3/movie/{id}/credits'")
+    parser.add_argument("--tmdb-server-rate-limit", type=float, help="requests per second the fake TMDb server allows before answering with 429")
+    parser.add_argument("--notion-server-rate-limit", type=float, help="requests per second the fake Notion server allows before answering with 429")
+    parser.add_argument("--tmdb-rate", type=float, help="client side TMDb rate limit, instead of the one in main.py")
+    parser.add_argument("--notion-rate", type=float, help="client side Notion rate limit, instead of the one in main.py")
+    parser.add_argument("--scan-mode", choices=["credits", "discover", "batch"], help="TMDb scan mode, instead of the one in main.py")
+    parser.add_argument("--log-level", default="WARNING", help="level of the log messages of the runs")
+    parser.add_argument("--output", help="json file to write the results to, with the request counts per endpoint")
+    args = parser.parse_args()
+
+    results = []
+    for scenario in args.scenarios:
+        for people in args.sizes:
+            result = run_benchmark(args, scenario, people)
+            results.append(result)
+            print(f"{scenario} with {people} people: {result['wall_time']:.2f} s, {result['tmdb_requests']} TMDb and {result['notion_requests']} Notion requests", file=sys.stderr)
+
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": datetime.now().isoformat(), "arguments": vars(args), "results": results}, f, indent=2)
@@ -0,0 +1,77 @@
+"""Run one benchmark scenario in a fresh process, and print its measurements as json on the last line.
+
+Started by `run_benchmarks.py` in a temporary working directory, with the API base urls and database ids
+pointing at the fake servers in the environment.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import main as main_module  # noqa: E402
+from custom_logger import CustomLogger  # noqa: E402
+from notion_api_calls import NotionUpdater  # noqa: E402
+from requests_session import RateLimitedSession  # noqa: E402
+from tmdb_async_client import SCAN_MODES  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def run_main(args: argparse.Namespace):
+    main_module.main(full_sync=args.full_sync, reconcile=args.reconcile, scan_mode=args.scan_mode)
+
+
+def run_daemon_cycle(args: argparse.Namespace):
+    main_module.run_daemon(full_sync=args.full_sync, max_cycles=1, scan_mode=args.scan_mode)
+
+
+def read_person_database(args: argparse.Namespace):
+    with RateLimitedSession(max_requests=main_module.NOTION_MAX_REQUESTS_PER_SECOND, burst=main_module.NOTION_BURST) as session:
+        notion_updater = NotionUpdater(session=session, full_sync=args.full_sync)
+        notion_updater.person_list
+        notion_updater.journal.finish()
+        notion_updater.close()
+
+
+SCENARIOS = {
+    "main": run_main,
+    "daemon_cycle": run_daemon_cycle,
+    "read_person_database": read_person_database,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--full-sync", action="store_true")
+    parser.add_argument("--reconcile", action="store_true")
+    parser.add_argument("--tmdb-rate", type=float)
+    parser.add_argument("--notion-rate", type=float)
+    parser.add_argument("--scan-mode", choices=SCAN_MODES, default=main_module.TMDB_SCAN_MODE)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    CustomLogger.setLevel(getattr(logging, args.log_level))
+    if args.tmdb_rate:
+        main_module.TMDB_MAX_REQUESTS_PER_SECOND, main_module.TMDB_BURST = args.tmdb_rate, int(args.tmdb_rate)
+        main_module.DAEMON_TMDB_REQUESTS_PER_SECOND = args.tmdb_rate
+    if args.notion_rate:
+        main_module.NOTION_MAX_REQUESTS_PER_SECOND, main_module.NOTION_BURST = args.notion_rate, int(args.notion_rate)
+        main_module.DAEMON_NOTION_REQUESTS_PER_SECOND = args.notion_rate
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    SCENARIOS[args.scenario](args)
+
+    result = {"wall_time": time.perf_counter() - start, "cpu_time": time.process_time() - cpu_start}
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        result["peak_memory_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
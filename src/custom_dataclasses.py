@@ -1,48 +1,103 @@
 import json
-from dataclasses import asdict, dataclass, field
 
-@dataclass
+# Encoder without whitespace, shared by all instances
+JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
 class Person:
-    notion_page_id: str
-    tmdb_id: str
-    tmdb_url: str
-    imdb_url: str
-    name: str
-    is_director: bool
-    is_actor: bool
-    projects: "list[str]" = field(default_factory=list) # list of FilmProject ids
-    project_page_ids: "list[str]" = field(default_factory=list) # list of Notion page ids for film projects
+    __slots__ = ("notion_page_id", "tmdb_id", "tmdb_url", "imdb_url", "name", "is_director", "is_actor", "projects", "project_page_ids")
 
-    @property
-    def __dict__(self):
-        return asdict(self)
+    def __init__(
+        self,
+        notion_page_id: str,
+        tmdb_id: str,
+        tmdb_url: str,
+        imdb_url: str,
+        name: str,
+        is_director: bool,
+        is_actor: bool,
+        projects: "list[str] | None" = None,
+        project_page_ids: "list[str] | None" = None,
+    ) -> None:
+        self.notion_page_id = notion_page_id
+        self.tmdb_id = tmdb_id
+        self.tmdb_url = tmdb_url
+        self.imdb_url = imdb_url
+        self.name = name
+        self.is_director = is_director
+        self.is_actor = is_actor
+        self.projects: "list[str]" = projects if projects is not None else [] # list of FilmProject ids
+        self.project_page_ids: "list[str]" = project_page_ids if project_page_ids is not None else [] # list of Notion page ids for film projects
+
+    def to_dict(self) -> dict:
+        """Return the attributes as a dictionary. The lists are shared with the person, not copied."""
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Person":
+        return cls(**data)
 
     @property
-    def json(self):
-        return json.dumps(self.__dict__, indent=2)
+    def json(self) -> str:
+        return JSON_ENCODER.encode(self.to_dict())
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"Person(notion_page_id={self.notion_page_id!r}, tmdb_id={self.tmdb_id!r}, name={self.name!r})"
+
 
-@dataclass
 class FilmProject:
-    tmdb_id: str
-    tmdb_url: str
-    imdb_url: str
-    title: str
-    synopsis: str
-    genres: "list[str]" = field(default_factory=list)
-    popularity: float = 0.0
-    associated_person_page_ids: "list[str]" = field(default_factory=list)
-    release_date: str = field(init=False)
-    notion_page_id: str = field(init=False)
-    excluded: bool = field(init=False)
+    __slots__ = (
+        "tmdb_id", "tmdb_url", "imdb_url", "title", "synopsis", "genres", "popularity", "associated_person_page_ids",
+        "release_date", "notion_page_id", "excluded",
+    )
+
+    def __init__(
+        self,
+        tmdb_id: str,
+        tmdb_url: str,
+        imdb_url: str,
+        title: str,
+        synopsis: str,
+        genres: "list[str] | None" = None,
+        popularity: float = 0.0,
+        associated_person_page_ids: "list[str] | None" = None,
+        release_date: "str | None" = None,
+        notion_page_id: str = "",
+        excluded: bool = False,
+    ) -> None:
+        self.tmdb_id = tmdb_id
+        self.tmdb_url = tmdb_url
+        self.imdb_url = imdb_url
+        self.title = title
+        self.synopsis = synopsis
+        self.genres: "list[str]" = genres if genres is not None else []
+        self.popularity = popularity
+        self.associated_person_page_ids: "list[str]" = associated_person_page_ids if associated_person_page_ids is not None else []
+        self.release_date = release_date # None when TMDb has no release date
+        self.notion_page_id = notion_page_id # empty until the project has a page in Notion
+        self.excluded = excluded
+
+    def to_dict(self) -> dict:
+        """Return the attributes as a dictionary. The lists are shared with the project, not copied."""
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FilmProject":
+        return cls(**data)
 
     @property
-    def __dict__(self):
-        if not hasattr(self, "release_date"):
-            self.release_date = ""
-        if not hasattr(self, "notion_page_id"):
-            self.notion_page_id = ""
-        return asdict(self)
-    
-    @property
-    def json(self):
-        return json.dumps(self.__dict__, indent=2)
+    def json(self) -> str:
+        return JSON_ENCODER.encode(self.to_dict())
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"FilmProject(tmdb_id={self.tmdb_id!r}, title={self.title!r}, notion_page_id={self.notion_page_id!r})"
@@ -1,10 +1,11 @@
 import logging
+import os
 from logging.handlers import TimedRotatingFileHandler
 from pathlib import Path
 
-# Make sure there is a log file path
-data_path = Path(__file__).parent.parent / "data"
-data_path.mkdir(exist_ok=True)
+# Make sure there is a log file path. LOG_DIRECTORY is only set to keep the logs of other runs, like the benchmarks, apart
+data_path = Path(os.environ.get("LOG_DIRECTORY", Path(__file__).parent.parent / "data"))
+data_path.mkdir(parents=True, exist_ok=True)
 log_file = data_path / "main.log"
 
 CustomLogger = logging.getLogger(__name__)
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+
+from custom_logger import CustomLogger
+from state_store import STATE_DATABASE_FILENAME
+
+LEGACY_EXCLUDED_PROJECTS_FILENAME = "data/excluded_projects.txt"
+
+
+class ExcludedProjectStore():
+    """Set of TMDb ids for projects that should never be added to the databases, stored in SQLite.
+
+    The ids are the integer primary key of the table, so membership checks are index lookups and
+    duplicates are never stored. New ids are kept in memory and written `batch_size` at a time, or
+    when `flush` is called. The first time the store is opened, the ids in the old text file are
+    moved into it.
+    """
+
+    def __init__(self, filename: str = STATE_DATABASE_FILENAME, legacy_filename: str = LEGACY_EXCLUDED_PROJECTS_FILENAME, batch_size: int = 100) -> None:
+        self.batch_size = batch_size
+        self._pending: "set[int]" = set()
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS excluded_projects (tmdb_id INTEGER PRIMARY KEY) WITHOUT ROWID")
+        self._connection.commit()
+
+        if os.path.isfile(legacy_filename):
+            self.migrate(legacy_filename)
+
+    def __contains__(self, tmdb_id: str) -> bool:
+        if not str(tmdb_id).isdigit():
+            return False
+        tmdb_id = int(tmdb_id)
+        with self._lock:
+            if tmdb_id in self._pending:
+                return True
+            return self._connection.execute("SELECT 1 FROM excluded_projects WHERE tmdb_id = ?", (tmdb_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM excluded_projects").fetchone()[0]
+
+    def add(self, tmdb_ids: "list[str]"):
+        """Exclude the projects with `tmdb_ids`."""
+        with self._lock:
+            self._pending.update(int(tmdb_id) for tmdb_id in tmdb_ids if str(tmdb_id).isdigit())
+            should_flush = len(self._pending) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write the pending ids to the database."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._connection.executemany("INSERT OR IGNORE INTO excluded_projects VALUES (?)", [(tmdb_id,) for tmdb_id in self._pending])
+            self._connection.commit()
+            self._pending.clear()
+
+    def compact(self):
+        """Rebuild the database file to reclaim the space of deleted rows."""
+        self.flush()
+        with self._lock:
+            self._connection.execute("VACUUM")
+
+    def migrate(self, legacy_filename: str):
+        """Move the ids from the old text file, which may contain duplicates, into the store."""
+        with open(legacy_filename, "r") as f:
+            tmdb_ids = f.read().split()
+        self.add(tmdb_ids)
+        self.compact()
+
+        os.replace(legacy_filename, f"{legacy_filename}.migrated")
+        CustomLogger.info(f"Moved {len(set(tmdb_ids))} unique excluded projects from {legacy_filename} into the excluded projects store")
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
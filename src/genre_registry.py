@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+
+TMDB_GENRES_FILE = "data/genres.json"
+NOTION_GENRE_OPTIONS_FILE = "data/notion_genre_options.json"
+# Checked in seed of the Notion options, only read until the options have been read from the database schema once
+NOTION_MULTISELECT_GENRES_FILENAME = "notion_multiselect_genres/genre_tags.json"
+
+
+class GenreRegistry:
+    """Maps TMDb genre ids to genre names, and genre names to Notion multi-select options.
+
+    Both tables are read from file the first time they are needed and kept in memory for the rest of
+    the process. When an unknown genre shows up, the caller fetches the current genres from the API
+    and passes them to `update_tmdb_genres` or `update_notion_options`, which also saves them to file
+    under data. Each table is only refreshed once per process, so an id that is still unknown after
+    the refresh doesn't cause a request for every film. Until the Notion options have been saved, they
+    are read from the checked in `notion_options_seed_file`, which is never written.
+    """
+
+    def __init__(self, tmdb_genres_file: str = TMDB_GENRES_FILE, notion_options_file: str = NOTION_GENRE_OPTIONS_FILE, notion_options_seed_file: str = NOTION_MULTISELECT_GENRES_FILENAME) -> None:
+        self._tmdb_genres_file = tmdb_genres_file
+        self._notion_options_file = notion_options_file
+        self._notion_options_seed_file = notion_options_seed_file
+        self._tmdb_genres: "dict[int, str] | None" = None
+        self._notion_options: "dict[str, dict[str, str]] | None" = None
+        self.tmdb_genres_refreshed = False
+        self.notion_options_refreshed = False
+        self._lock = threading.Lock()
+
+    @property
+    def tmdb_genres(self) -> "dict[int, str]":
+        """Genre names by TMDb genre id."""
+        if self._tmdb_genres is None:
+            with self._lock:
+                if self._tmdb_genres is None:
+                    genres = self._read_json(self._tmdb_genres_file)
+                    # JSON object keys are always strings, while TMDb uses integer ids
+                    self._tmdb_genres = {int(genre_id): name for genre_id, name in genres.items()}
+        return self._tmdb_genres
+
+    @property
+    def notion_options(self) -> "dict[str, dict[str, str]]":
+        """Notion multi-select options by genre name."""
+        if self._notion_options is None:
+            with self._lock:
+                if self._notion_options is None:
+                    filename = self._notion_options_file if os.path.isfile(self._notion_options_file) else self._notion_options_seed_file
+                    self._notion_options = self._read_json(filename)
+        return self._notion_options
+
+    def missing_genre_ids(self, genre_ids: "list[int]") -> "list[int]":
+        return [genre_id for genre_id in genre_ids if int(genre_id) not in self.tmdb_genres]
+
+    def missing_genre_names(self, genres: "list[str]") -> "list[str]":
+        return [genre for genre in genres if genre not in self.notion_options]
+
+    def get_genre_names(self, genre_ids: "list[int]") -> "list[str]":
+        """Convert TMDb genre ids to genre names, skipping unknown ids."""
+        return [self.tmdb_genres[int(genre_id)] for genre_id in genre_ids if int(genre_id) in self.tmdb_genres]
+
+    def get_notion_options(self, genres: "list[str]") -> "list[dict[str, str]]":
+        """Convert genre names to Notion multi-select options.
+
+        Genres without a known option are referred to by name only, which makes Notion create the option.
+        """
+        return [self.notion_options.get(genre, {"name": genre}) for genre in genres]
+
+    def update_tmdb_genres(self, genres: "list[dict]"):
+        """Replace the TMDb genres with the `genres` list from the TMDb genre list endpoint."""
+        with self._lock:
+            self._tmdb_genres = {genre["id"]: genre["name"] for genre in genres}
+            self.tmdb_genres_refreshed = True
+            self._write_json(self._tmdb_genres_file, self._tmdb_genres)
+
+    def update_notion_options(self, options: "list[dict]"):
+        """Replace the Notion options with the multi-select `options` from a Notion database schema."""
+        with self._lock:
+            self._notion_options = {option["name"]: option for option in options}
+            self.notion_options_refreshed = True
+            self._write_json(self._notion_options_file, self._notion_options)
+
+    @staticmethod
+    def _read_json(filename: str) -> dict:
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_json(filename: str, data: dict):
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+# Shared by the TMDb and Notion code, so the genre files are only read once per process
+GENRE_REGISTRY = GenreRegistry()
@@ -1,92 +1,362 @@
+from custom_dataclasses import FilmProject, Person
 from custom_logger import CustomLogger
-from notion_api_calls import NotionUpdater
+from notion_api_calls import QUERY_URL_PATTERN, NotionUpdater, get_changed_properties, get_unresolved_persons
+from pipeline import ProjectPipeline
+from refresh_scheduler import INITIAL_CHANGE_RATE, PERSON, PROJECT, RefreshScheduler, person_refresh_interval, project_refresh_interval
 from requests_session import RateLimitedSession
-from tmdb_api_calls import find_upcoming_projects, get_released_projects_from_previous
+from resilience import CircuitBreaker, RetryPolicy
+from response_cache import ResponseCache
+from run_metrics import RunMetrics
+from run_profiler import RunProfiler
+from tmdb_api_calls import TMDB_CACHE_FILE, TMDB_CACHE_TTLS, today
+from tmdb_async_client import SCAN_MODES, AsyncTMDbClient
 
+import argparse
+import signal
+import threading
 import time
+from datetime import datetime, timedelta
 
 TMDB_MAX_REQUESTS_PER_SECOND = 30
+TMDB_BURST = 30
+TMDB_MAX_CONCURRENT_REQUESTS = 10
+TMDB_SCAN_MODE = "credits"
 NOTION_MAX_REQUESTS_PER_SECOND = 3
+NOTION_BURST = 3
+NOTION_WRITE_WORKERS = 3
+MAX_RETRIES = 3
+# Consecutive server errors after which requests to an endpoint are stopped, and for how many seconds
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
 
+# Name of the state store cursor with the date of the last release check
+RELEASE_CHECK_CURSOR = "tmdb_release_check"
 
-def get_excluded_projects():
-    """Returns a list of tmdb_ids for projects that should not be added to the database"""
-    with open("data/excluded_projects.txt", "r") as f:
-        excluded_projects = f.read().splitlines()
-    return excluded_projects
+# The daemon mode sends its requests at a low, steady rate instead of all at once
+DAEMON_CYCLE_SECONDS = 15 * 60
+DAEMON_TMDB_REQUESTS_PER_SECOND = 1
+DAEMON_NOTION_REQUESTS_PER_SECOND = 1
+# Share of the TMDb requests a cycle can send at the daemon rate that is planned for refreshes, the rest is headroom
+DAEMON_BUDGET_FRACTION = 0.8
+# Estimated TMDb requests to refresh a project, and to scan a person in the credits scan mode
+PROJECT_REFRESH_REQUESTS = 1
+PERSON_REFRESH_REQUESTS = 2
+# The daemon reads the whole Notion databases again this often, to notice the pages deleted in Notion
+DAEMON_FULL_SYNC_INTERVAL = timedelta(days=1)
+# Seconds until a project whose details couldn't be fetched, or that couldn't be moved, or a person whose scan failed, is tried again
+FAILED_REFRESH_DELAY = 60 * 60
 
 
-def main():
+def main(full_sync: bool = False, reconcile: bool = False, profile: bool = False, scan_mode: str = TMDB_SCAN_MODE):
 
-    with RateLimitedSession(max_requests=TMDB_MAX_REQUESTS_PER_SECOND) as tmdb_session:
-        with RateLimitedSession(max_requests=NOTION_MAX_REQUESTS_PER_SECOND) as notion_session:
-            
-            notion_updater = NotionUpdater(session=notion_session)
+    profiler = RunProfiler() if profile else None
+    metrics = RunMetrics(profiler=profiler)
+    success = False
+    try:
+        run(full_sync=full_sync, reconcile=reconcile, metrics=metrics, scan_mode=scan_mode)
+        success = True
+    finally:
+        # The report is also written when the run fails, to show where the time went before the error
+        metrics.write_report(success=success)
+        metrics.write_prometheus(success=success)
+        if profiler is not None:
+            profiler.close()
+            CustomLogger.info(f"Wrote the profiles of the run to {profiler.directory}")
+        phases = {phase: round(seconds, 2) for phase, seconds in metrics.phases.items()}
+        CustomLogger.info(f"Phase durations in seconds: {phases}")
 
-            previous_projects = notion_updater.upcoming_list
-            previous_project_tmdb_ids = [project.tmdb_id for project in previous_projects]
-            CustomLogger.debug(f"Found {len(previous_projects)} projects in the UpcomingProjects database")
 
-            # Remove projects where the Exclude checkbox has been checked from the databases
-            notion_updater.remove_excluded_projects_from_databases()
-            
-            # Move projects that have been released to the ReleasedProjects database
-            if previous_projects:
-                released_projects = get_released_projects_from_previous(requests_session=tmdb_session, previous_projects=previous_projects)
-                notion_updater.add_film_projects_to_database(projects=released_projects, database="released")
-                notion_updater.remove_film_projects_from_database(projects=released_projects)
+def create_sessions(metrics: RunMetrics, tmdb_rate: float, tmdb_burst: int, notion_rate: float, notion_burst: int) -> "tuple[RateLimitedSession, RateLimitedSession]":
+    """Create the TMDb session, with the response cache, and the Notion session."""
+    tmdb_cache = ResponseCache(filename=TMDB_CACHE_FILE, ttls=TMDB_CACHE_TTLS)
 
-                CustomLogger.info(f"Moved {len(released_projects)} projects to the ReleasedProjects database")
-                CustomLogger.info(f"Projects that have been moved from `UpcomingProjects` to `ReleasedProjects`: {[project.tmdb_url for project in released_projects]}")
+    tmdb_retry = RetryPolicy(max_retries=MAX_RETRIES)
+    notion_retry = RetryPolicy(max_retries=MAX_RETRIES, idempotent_post_pattern=QUERY_URL_PATTERN)
 
+    tmdb_session = RateLimitedSession(max_requests=tmdb_rate, burst=tmdb_burst, cache=tmdb_cache, metrics=metrics, retry=tmdb_retry, breaker=CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT))
+    notion_session = RateLimitedSession(max_requests=notion_rate, burst=notion_burst, metrics=metrics, retry=notion_retry, breaker=CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT))
+    return tmdb_session, notion_session
 
-            new_projects = []
-            excluded_projects = get_excluded_projects()
 
-            # Scrape new upcoming projects from all persons
-            for person in notion_updater.person_list:
-                
-                projects = find_upcoming_projects(requests_session=tmdb_session, person=person)
+def run(full_sync: bool, reconcile: bool, metrics: RunMetrics, scan_mode: str = TMDB_SCAN_MODE):
 
-                for project in projects:
-                    # Check if project is already in the database
-                    if project.tmdb_id in previous_project_tmdb_ids:
-                        CustomLogger.debug(f"Project '{project.title}' is already in the database")
-                        continue
+    tmdb_session, notion_session = create_sessions(
+        metrics=metrics,
+        tmdb_rate=TMDB_MAX_REQUESTS_PER_SECOND,
+        tmdb_burst=TMDB_BURST,
+        notion_rate=NOTION_MAX_REQUESTS_PER_SECOND,
+        notion_burst=NOTION_BURST
+    )
 
-                    # Check if project is excluded
-                    if project.tmdb_id in excluded_projects:
-                        CustomLogger.debug(f"Project '{project.title}' is excluded from the database")
-                        continue
+    with tmdb_session:
+        with notion_session:
+            notion_updater = NotionUpdater(session=notion_session, full_sync=full_sync, write_workers=NOTION_WRITE_WORKERS)
+            try:
+                with metrics.phase("notion_load"):
+                    previous_projects = list(notion_updater.upcoming_list)
+                    CustomLogger.debug(f"Found {len(previous_projects)} projects in the UpcomingProjects database")
+                    # Taken before any page is archived, the persons keep the relations to the projects removed in this run
+                    persons = list(notion_updater.person_list)
 
-                    # Check if the project is already in another person's list
-                    used_tmdb_ids = [project.tmdb_id for project in new_projects]
-                    if project.tmdb_id in used_tmdb_ids:
+                # Finish the writes of an interrupted run before deciding what to write in this run
+                if notion_updater.journal.resumed:
+                    with metrics.phase("resume"):
+                        notion_updater.resume_pending_mutations()
 
-                        # Update the project with the new person
-                        used_project = new_projects[used_tmdb_ids.index(project.tmdb_id)]
-                        used_project.associated_person_page_ids.append(person.notion_page_id)
-                        person.projects.append(project.tmdb_id)
-                        
-                        CustomLogger.debug(f"Project '{project.title}' already in another person's list. Updated associated people: {used_project.associated_person_page_ids}")
-                        continue
+                # Remove projects where the Exclude checkbox has been checked from the databases
+                with metrics.phase("excluded_removal"):
+                    notion_updater.remove_excluded_projects_from_databases()
 
-                    new_projects.append(project)
-                    person.projects.append(project.tmdb_id)
-                
-                CustomLogger.info(f"Found {len(projects)} upcoming projects for {person.name}")
+                registry = notion_updater.registry
 
-            CustomLogger.debug(f"Adding new projects to the UpcomingProjects database")
-            notion_updater.add_film_projects_to_database(projects=new_projects, database="upcoming")
+                with AsyncTMDbClient(session=tmdb_session, max_concurrency=TMDB_MAX_CONCURRENT_REQUESTS, scan_mode=scan_mode) as tmdb_client:
+
+                    # Move projects that have been released to the ReleasedProjects database
+                    if registry.previous_projects:
+                        with metrics.phase("release_check"):
+                            last_check = notion_updater.state.get_cursor(RELEASE_CHECK_CURSOR)
+                            if last_check is not None:
+                                last_check = datetime.strptime(last_check, "%Y-%m-%d").date()
+
+                            released_projects, is_complete = tmdb_client.run_release_check(projects=registry.previous_projects, last_check=last_check)
+                            moved_projects = notion_updater.move_film_projects_to_released(projects=released_projects)
+
+                            # The next run checks the same changes again if a project couldn't be checked or moved
+                            if is_complete and len(moved_projects) == len(released_projects):
+                                notion_updater.state.set_cursor(RELEASE_CHECK_CURSOR, today().isoformat())
+                            released_projects = moved_projects
+
+                        CustomLogger.info(f"Moved {len(released_projects)} projects to the ReleasedProjects database")
+                        CustomLogger.info(f"Projects that have been moved from `UpcomingProjects` to `ReleasedProjects`: {[project.tmdb_url for project in released_projects]}")
+
+                    # Update the pages of the remaining upcoming projects where the TMDb data has changed
+                    if reconcile:
+                        with metrics.phase("reconcile"):
+                            fresh_projects = tmdb_client.run_refresh(projects=registry.previous_projects)
+                            counts = notion_updater.reconcile_projects(stored_projects=registry.previous_projects, fresh_projects=fresh_projects)
+                        CustomLogger.info(f"Reconciled the UpcomingProjects database: {counts}")
+
+                    # Find the persons with missing urls on TMDb, and add the urls to their pages after the other writes
+                    unresolved_persons = get_unresolved_persons(persons)
+                    if unresolved_persons:
+                        with metrics.phase("person_resolution"):
+                            resolved_persons = tmdb_client.run_resolve_persons(persons=unresolved_persons)
+                            notion_updater.backfill_person_urls(persons=resolved_persons)
+                        CustomLogger.info(f"Filled in the urls of {len(resolved_persons)} of {len(unresolved_persons)} persons with missing urls from TMDb")
+
+                    # Scrape new upcoming projects from all persons concurrently, while adding them to the database
+                    with metrics.phase("person_scan"):
+                        pipeline = ProjectPipeline(
+                            notion_updater=notion_updater,
+                            tmdb_client=tmdb_client,
+                            registry=registry,
+                            journal=notion_updater.journal
+                        )
+                        new_projects = pipeline.run(persons=[person for person in persons if person.tmdb_id])
+
+                CustomLogger.info(f"Added {len(new_projects)} new projects to the UpcomingProjects database")
+                CustomLogger.info(f"Project registry stats: {registry.stats}")
+
+                # Finish the url backfills of the person database before the run is done
+                with metrics.phase("writes"):
+                    notion_updater.writes.flush()
+                CustomLogger.info(f"Notion write stats: {notion_updater.writes.stats}")
+                metrics.set_counters("notion_writes", notion_updater.writes.stats)
+                metrics.set_counters("project_registry", registry.stats)
+
+                notion_updater.journal.finish()
+            finally:
+                # Also save the local state when the run fails, the journal finishes the writes in the next run
+                notion_updater.close()
+
+
+def run_daemon(full_sync: bool = False, cycle_seconds: float = DAEMON_CYCLE_SECONDS, max_cycles: "int | None" = None, scan_mode: str = TMDB_SCAN_MODE):
+    """Keep running, and refresh the persons and upcoming projects that are due every `cycle_seconds`.
+
+    Unlike `main`, the sessions, caches and Notion state stay loaded between cycles, and each person and
+    project is only refreshed when its own interval has passed, see `RefreshScheduler`. Every cycle plans
+    no more requests than fit in the cycle at the daemon rates, so the requests are spread out evenly,
+    and the persons and projects that don't fit are refreshed in the next cycle, the most overdue first.
+
+    The daemon stops after the current cycle on SIGINT or SIGTERM, or after `max_cycles` cycles. A cycle
+    that fails is logged and finished by the next cycle, like an interrupted run.
+    """
+    metrics = RunMetrics()
+    stop = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *args: stop.set())
+
+    tmdb_session, notion_session = create_sessions(
+        metrics=metrics,
+        tmdb_rate=DAEMON_TMDB_REQUESTS_PER_SECOND,
+        tmdb_burst=1,
+        notion_rate=DAEMON_NOTION_REQUESTS_PER_SECOND,
+        notion_burst=1
+    )
+
+    with tmdb_session:
+        with notion_session:
+            notion_updater = NotionUpdater(session=notion_session, full_sync=full_sync, write_workers=NOTION_WRITE_WORKERS, full_sync_interval=DAEMON_FULL_SYNC_INTERVAL)
+            try:
+                scheduler = RefreshScheduler(store=notion_updater.state)
+                with AsyncTMDbClient(session=tmdb_session, max_concurrency=TMDB_MAX_CONCURRENT_REQUESTS, scan_mode=scan_mode) as tmdb_client:
+                    cycle = 0
+                    while not stop.is_set() and (max_cycles is None or cycle < max_cycles):
+                        cycle += 1
+                        start = time.monotonic()
+                        # The report and the Prometheus textfile describe the last cycle, and the latencies of older cycles aren't kept
+                        metrics.reset()
+                        if cycle > 1:
+                            # Resumes the journal of the previous cycle if it failed
+                            notion_updater.journal.start()
+
+                        success = False
+                        try:
+                            counts = run_cycle(notion_updater=notion_updater, tmdb_client=tmdb_client, scheduler=scheduler, metrics=metrics, cycle_seconds=cycle_seconds)
+                            notion_updater.journal.finish()
+                            success = True
+                            CustomLogger.info(f"Finished cycle {cycle} in {round(time.monotonic() - start, 2)} s: {counts}")
+                        except Exception:
+                            CustomLogger.exception(f"Cycle {cycle} failed")
+                        finally:
+                            notion_updater.refresh()
+                            metrics.set_counters("refresh_schedule", scheduler.stats())
+                            metrics.write_report(success=success, cycles=cycle)
+                            metrics.write_prometheus(success=success)
+
+                        if max_cycles is None or cycle < max_cycles:
+                            stop.wait(max(0.0, cycle_seconds - (time.monotonic() - start)))
+            finally:
+                notion_updater.close()
+
+    CustomLogger.info(f"Stopped the daemon after {cycle} cycles")
+
+
+def run_cycle(notion_updater: NotionUpdater, tmdb_client: AsyncTMDbClient, scheduler: RefreshScheduler, metrics: RunMetrics, cycle_seconds: float) -> "dict[str, int]":
+    """Refresh the upcoming projects and persons that are due, within the TMDb request budget of one cycle."""
+    with metrics.phase("notion_load"):
+        notion_updater.upcoming_list
+        persons = list(notion_updater.person_list)
+
+    if notion_updater.journal.resumed:
+        with metrics.phase("resume"):
+            notion_updater.resume_pending_mutations()
+
+    with metrics.phase("excluded_removal"):
+        notion_updater.remove_excluded_projects_from_databases()
+
+    registry = notion_updater.registry
+
+    # Persons with missing urls are looked up in the TMDb response cache after the first cycle, so this is cheap
+    unresolved_persons = get_unresolved_persons(persons)
+    if unresolved_persons:
+        with metrics.phase("person_resolution"):
+            resolved_persons = tmdb_client.run_resolve_persons(persons=unresolved_persons)
+            notion_updater.backfill_person_urls(persons=resolved_persons)
+
+    persons = [person for person in persons if person.tmdb_id]
+    scheduler.sync(PERSON, [person.notion_page_id for person in persons])
+    scheduler.sync(PROJECT, [project.notion_page_id for project in registry.previous_projects])
+
+    budget = DAEMON_TMDB_REQUESTS_PER_SECOND * cycle_seconds * DAEMON_BUDGET_FRACTION
+
+    # Upcoming projects get up to half of the budget, and the persons get the rest
+    projects_by_page_id = {project.notion_page_id: project for project in registry.previous_projects}
+    due_projects = [projects_by_page_id[page_id] for page_id in scheduler.due(PROJECT, limit=int(budget / 2 / PROJECT_REFRESH_REQUESTS))]
+    budget -= len(due_projects) * PROJECT_REFRESH_REQUESTS
+    if due_projects:
+        with metrics.phase("project_refresh"):
+            counts = refresh_projects(notion_updater=notion_updater, tmdb_client=tmdb_client, scheduler=scheduler, projects=due_projects)
+    else:
+        counts = {}
+
+    persons_by_page_id = {person.notion_page_id: person for person in persons}
+    due_persons = [persons_by_page_id[page_id] for page_id in scheduler.due(PERSON, limit=int(budget / PERSON_REFRESH_REQUESTS))]
+    if due_persons:
+        with metrics.phase("person_scan"):
+            counts["new_projects"] = scan_persons(notion_updater=notion_updater, tmdb_client=tmdb_client, scheduler=scheduler, persons=due_persons)
+
+    with metrics.phase("writes"):
+        notion_updater.writes.flush()
+    metrics.set_counters("notion_writes", notion_updater.writes.stats)
+    metrics.set_counters("project_registry", registry.stats)
+
+    return {"refreshed_projects": len(due_projects), "scanned_persons": len(due_persons), **counts}
+
+
+def refresh_projects(notion_updater: NotionUpdater, tmdb_client: AsyncTMDbClient, scheduler: RefreshScheduler, projects: "list[FilmProject]") -> "dict[str, int]":
+    """Move the released `projects` to the ReleasedProjects database, and update the pages of the others where the TMDb data has changed."""
+    released_projects, fresh_projects = [], []
+    for project, (fresh_project, is_released) in zip(projects, tmdb_client.run_check_projects(projects=projects)):
+        if fresh_project is None:
+            scheduler.postpone(PROJECT, project.notion_page_id, FAILED_REFRESH_DELAY)
+        elif is_released:
+            released_projects.append(project)
+        else:
+            fresh_projects.append(fresh_project)
+            changed = bool(get_changed_properties(stored_project=project, fresh_project=fresh_project))
+            scheduler.record(PROJECT, project.notion_page_id, changed=changed, interval=lambda change_rate, fresh_project=fresh_project: project_refresh_interval(fresh_project, change_rate))
+
+    moved_projects = notion_updater.move_film_projects_to_released(projects=released_projects)
+    moved_page_ids = {project.notion_page_id for project in moved_projects}
+    for project in released_projects:
+        if project.notion_page_id in moved_page_ids:
+            scheduler.remove(PROJECT, project.notion_page_id)
+        else:
+            scheduler.postpone(PROJECT, project.notion_page_id, FAILED_REFRESH_DELAY)
+
+    counts = notion_updater.reconcile_projects(stored_projects=projects, fresh_projects=fresh_projects)
+    return {"released_projects": len(moved_projects), **{f"{name}_projects": count for name, count in counts.items()}}
+
+
+def scan_persons(notion_updater: NotionUpdater, tmdb_client: AsyncTMDbClient, scheduler: RefreshScheduler, persons: "list[Person]") -> int:
+    """Scan `persons` for new upcoming projects and add them to the UpcomingProjects database. Returns the number of new projects.
+
+    The persons whose scan failed are tried again after `FAILED_REFRESH_DELAY`.
+    """
+    registry = notion_updater.registry
+    pipeline = ProjectPipeline(notion_updater=notion_updater, tmdb_client=tmdb_client, registry=registry, journal=notion_updater.journal)
+    new_projects = pipeline.run(persons=persons)
+
+    # The new projects were just created from fresh TMDb data, so their first refresh can wait a full interval
+    for project in new_projects:
+        if project.notion_page_id:
+            scheduler.schedule(PROJECT, project.notion_page_id, interval=project_refresh_interval(project, INITIAL_CHANGE_RATE))
+
+    persons_with_new_projects = {page_id for project in new_projects for page_id in project.associated_person_page_ids}
+    failed_page_ids = {person.notion_page_id for person in pipeline.failed_persons}
+    for person in persons:
+        if person.notion_page_id in failed_page_ids:
+            scheduler.postpone(PERSON, person.notion_page_id, FAILED_REFRESH_DELAY)
+            continue
+        projects = [registry.get(tmdb_id) for tmdb_id in person.projects if registry.get(tmdb_id) is not None]
+        scheduler.record(
+            PERSON,
+            person.notion_page_id,
+            changed=person.notion_page_id in persons_with_new_projects,
+            interval=lambda change_rate, projects=projects: person_refresh_interval(projects, change_rate)
+        )
+
+    return len(new_projects)
 
-    notion_updater.close()
-    
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find upcoming movies for the people in Notion and add them to the Notion databases.")
+    parser.add_argument("--full-sync", action="store_true", help="read every page of the Notion databases instead of only the pages changed since the last run")
+    parser.add_argument("--reconcile", action="store_true", help="update the pages of upcoming projects where the details on TMDb have changed")
+    parser.add_argument("--profile", action="store_true", help="profile the CPU time and memory allocations of each phase, and write the profiles under data/profiles")
+    parser.add_argument("--daemon", action="store_true", help="keep running, and refresh each person and upcoming project on its own schedule")
+    parser.add_argument("--scan-mode", choices=SCAN_MODES, default=TMDB_SCAN_MODE, help="how TMDb is searched for the upcoming movies of each person: one movie credits request per person, discover queries per person, or discover queries covering many persons at once")
+    parser.add_argument("--cycle-minutes", type=float, default=DAEMON_CYCLE_SECONDS / 60, help="minutes between the cycles of the daemon mode")
+    args = parser.parse_args()
+
     start = time.time()
     CustomLogger.info("Starting script")
 
-    main()
+    if args.daemon:
+        run_daemon(full_sync=args.full_sync, cycle_seconds=args.cycle_minutes * 60, scan_mode=args.scan_mode)
+    else:
+        main(full_sync=args.full_sync, reconcile=args.reconcile, profile=args.profile, scan_mode=args.scan_mode)
     
     stop = time.time()
     CustomLogger.info(f"Finished script in {round(stop-start, 2)} s")
\ No newline at end of file
@@ -1,13 +1,24 @@
 import json
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable, Iterator
 
+import requests
 from dotenv import find_dotenv, load_dotenv
 
 from custom_dataclasses import FilmProject, Person
 from custom_logger import CustomLogger
+from excluded_store import ExcludedProjectStore
+from genre_registry import GENRE_REGISTRY
+from notion_snapshot import DatabaseSnapshot
+from notion_write_queue import PRIORITY_BACKFILL, PRIORITY_MOVE, PRIORITY_PERSON, PRIORITY_UPCOMING, PRIORITY_UPDATE, Mutation, NotionWriteQueue
+from project_registry import ProjectRegistry
+from state_store import StateStore
 from requests_session import RateLimitedSession
-from tmdb_api_calls import get_person_id, get_external_id_person
+from run_journal import RunJournal
 
 load_dotenv(find_dotenv())
 
@@ -16,12 +27,17 @@ NOTION_API_TOKEN = os.environ.get("NOTION_API_TOKEN")
 PERSON_LIST_DATABASE_ID = os.environ.get("PERSON_LIST_DATABASE_ID")
 UPCOMING_PROJECTS_DATABASE_ID = os.environ.get("UPCOMING_PROJECTS_DATABASE_ID")
 RELEASED_PROJECTS_DATABASE_ID = os.environ.get("RELEASED_PROJECTS_DATABASE_ID")
+NOTION_API_BASE_URL = os.environ.get("NOTION_API_BASE_URL", "https://api.notion.com/v1")
 
 # API ENDPOINTS
-GET_PERSON_DATABASE_URL = f"https://api.notion.com/v1/databases/{PERSON_LIST_DATABASE_ID}/query"
-GET_UPCOMING_DATABASE_URL = f"https://api.notion.com/v1/databases/{UPCOMING_PROJECTS_DATABASE_ID}/query"
-GET_RELEASED_DATABASE_URL = f"https://api.notion.com/v1/databases/{RELEASED_PROJECTS_DATABASE_ID}/query"
-CREATE_PAGE_URL = f"https://api.notion.com/v1/pages"
+GET_PERSON_DATABASE_URL = f"{NOTION_API_BASE_URL}/databases/{PERSON_LIST_DATABASE_ID}/query"
+GET_UPCOMING_DATABASE_URL = f"{NOTION_API_BASE_URL}/databases/{UPCOMING_PROJECTS_DATABASE_ID}/query"
+GET_RELEASED_DATABASE_URL = f"{NOTION_API_BASE_URL}/databases/{RELEASED_PROJECTS_DATABASE_ID}/query"
+CREATE_PAGE_URL = f"{NOTION_API_BASE_URL}/pages"
+UPCOMING_DATABASE_URL = f"{NOTION_API_BASE_URL}/databases/{UPCOMING_PROJECTS_DATABASE_ID}"
+
+# Database queries only read pages, so the session may send them again when they fail
+QUERY_URL_PATTERN = r"/databases/[^/]+/query$"
 
 HEADERS = {
     "Authorization": NOTION_API_TOKEN,
@@ -30,94 +46,336 @@ HEADERS = {
     "content-type": "application/json"
 }
 
-# FILENAMES
-NOTION_MULTISELECT_GENRES_FILENAME = "notion_multiselect_genres/genre_tags.json"
-PREVIOUS_PROJECTS_FILENAME = "data/previous_projects.json"
+# Query filter for pages where the Exclude checkbox is checked
+EXCLUDE_FILTER = {"property": "Exclude", "checkbox": {"equals": True}}
+
+# Names of the local snapshots of each database
+SNAPSHOT_NAMES = {
+    GET_PERSON_DATABASE_URL: "personlist",
+    GET_UPCOMING_DATABASE_URL: "upcoming",
+    GET_RELEASED_DATABASE_URL: "released",
+}
+
+# Query url of each database by database id
+QUERY_URLS = {
+    PERSON_LIST_DATABASE_ID: GET_PERSON_DATABASE_URL,
+    UPCOMING_PROJECTS_DATABASE_ID: GET_UPCOMING_DATABASE_URL,
+    RELEASED_PROJECTS_DATABASE_ID: GET_RELEASED_DATABASE_URL,
+}
+
+# Relative change in popularity needed before the Popularity property of a page is updated
+POPULARITY_CHANGE_THRESHOLD = 0.1
+
+
+def get_changed_properties(stored_project: FilmProject, fresh_project: FilmProject) -> "list[str]":
+    """Return the names of the properties that differ between a project as stored in Notion and its fresh TMDb data.
+
+    Genres are compared without their order, and small changes in popularity are ignored since the
+    popularity on TMDb changes every day. A missing IMDb url on TMDb never clears the stored url.
+    """
+    changed = []
+    if stored_project.title != fresh_project.title:
+        changed.append("Title")
+    if stored_project.tmdb_url != fresh_project.tmdb_url:
+        changed.append("TMDb URL")
+    if fresh_project.imdb_url and stored_project.imdb_url != fresh_project.imdb_url:
+        changed.append("IMDb URL")
+    if stored_project.synopsis != fresh_project.synopsis:
+        changed.append("Synopsis")
+    if set(stored_project.genres) != set(fresh_project.genres):
+        changed.append("Genres")
+    if stored_project.release_date != fresh_project.release_date:
+        changed.append("Release date")
+
+    stored_popularity = stored_project.popularity or 0.0
+    if abs(fresh_project.popularity - stored_popularity) > POPULARITY_CHANGE_THRESHOLD * max(stored_popularity, 1.0):
+        changed.append("Popularity")
+
+    return changed
+
+
+def get_unresolved_persons(persons: "list[Person]") -> "list[Person]":
+    """Persons with a missing IMDb or TMDb url, which have to be found on TMDb by name."""
+    return [person for person in persons if not person.imdb_url or not person.tmdb_url]
+
+
+def create_key(database_id: str, tmdb_url: str) -> str:
+    """Key of the mutation creating the page with `tmdb_url` in a database in the run journal."""
+    return f"{database_id}:{tmdb_url}"
+
+
+def build_page_response(url: str, page: dict) -> requests.Response:
+    """Build the response of a create request for a page that turned out to exist already."""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers["Content-Type"] = "application/json"
+    response._content = json.dumps(page).encode()
+    response.encoding = "utf-8"
+    return response
+
+
+def parse_person(page: dict) -> Person:
+    """Create a `Person` from a raw page of the person database."""
+    properties = page["properties"]
 
+    name = properties["Name"]["title"][0]["plain_text"]
 
-# URLs
-IMDB_PERSON_URL = "https://imdb.com/name"
-TMDB_PERSON_URL = "https://www.themoviedb.org/person"
+    is_director, is_actor = False, False
+    for tag in properties["Tags"]["multi_select"]:
+        if tag["name"] == "Director":
+            is_director = True
+        elif tag["name"] == "Actor":
+            is_actor = True
+
+    imdb_url = properties["IMDb URL"]["url"] or ""
+    tmdb_url = properties["TMDb URL"]["url"] or ""
+
+    if not imdb_url or not tmdb_url:
+        CustomLogger.debug(f"Either IMDb url, TMDb url, or both urls are missing for {name}")
+
+    # Get the ID from the TMDb url
+    tmdb_id_regex = r".*\/person\/(\d+)-.*"
+    tmdb_id = re.sub(tmdb_id_regex, r"\1", tmdb_url) if tmdb_url else ""
+
+    return Person(
+        notion_page_id=page["id"],
+        tmdb_id=tmdb_id,
+        tmdb_url=tmdb_url,
+        imdb_url=imdb_url,
+        name=name,
+        is_director=is_director,
+        is_actor=is_actor,
+        project_page_ids=[relation["id"] for relation in properties["Upcoming projects"]["relation"]],
+    )
+
+
+def parse_project(page: dict) -> FilmProject:
+    """Create a `FilmProject` from a raw page of the upcoming or released database."""
+    properties = page["properties"]
+
+    person_page_ids = [relation["id"] for relation in properties["Included people"]["relation"]]
+
+    title = properties["Title"]["title"][0]["text"]["content"]
+
+    imdb_url = properties["IMDb URL"]["url"]
+    tmdb_url = properties["TMDb URL"]["url"]
+
+    # Get the ID from the TMDb url
+    tmdb_id_regex = r".*\/movie\/(\d+)-.*"
+    tmdb_id = re.sub(tmdb_id_regex, r"\1", tmdb_url)
+
+    genres = [tag["name"] for tag in properties["Genres"]["multi_select"]]
+
+    synopsis = properties["Synopsis"]["rich_text"][0]["text"]["content"]
+
+    popularity = properties["Popularity"]["number"]
+
+    if properties["Release date"]["date"]:
+        release_date = properties["Release date"]["date"]["start"]
+    else:
+        release_date = None
+
+    return FilmProject(
+        tmdb_id=tmdb_id,
+        tmdb_url=tmdb_url,
+        imdb_url=imdb_url,
+        title=title,
+        synopsis=synopsis,
+        genres=genres,
+        popularity=popularity,
+        associated_person_page_ids=person_page_ids,
+        release_date=release_date,
+        notion_page_id=page["id"],
+        excluded=properties["Exclude"]["checkbox"],
+    )
 
 
 class NotionUpdater():
-    """Class employing functionality for reading from and writing to Notion databases."""
+    """Class employing functionality for reading from and writing to Notion databases.
 
-    def __init__(self, session: RateLimitedSession) -> None:
+    Each database is mirrored in the local `StateStore`, and only the pages edited since the previous
+    run are fetched from Notion. Set `full_sync` to read every page of the databases again, or
+    `full_sync_interval` to do so whenever the last full sync is older. The databases are only read
+    the first time their list is used.
+
+    Every page that is created, changed or archived goes through the `NotionWriteQueue`, which sends
+    the most valuable writes first with `write_workers` requests in flight. Each write is recorded in
+    the `RunJournal` of the run, so an interrupted run can be finished without writing the same page twice.
+    """
+
+    def __init__(self, session: RateLimitedSession, full_sync: bool = False, excluded_store: "ExcludedProjectStore | None" = None, state_store: "StateStore | None" = None, journal: "RunJournal | None" = None, write_workers: int = 3, full_sync_interval: "timedelta | None" = None) -> None:
         self._session = session
-        self._person_list: "list[Person]" = []
+        self.writes = NotionWriteQueue(send=self.send_mutation, workers=write_workers)
+        self._genre_options_lock = threading.Lock()
+        self._queued_people_updates: "set[str]" = set()
+        self._queued_people_updates_lock = threading.Lock()
+        self._full_sync = full_sync
+        self._full_sync_interval = full_sync_interval
+        self.state = state_store if state_store is not None else StateStore()
+        self.journal = journal if journal is not None else RunJournal(store=self.state)
+        if self.journal.run_id is None:
+            self.journal.start()
+        self._snapshots: "dict[str, DatabaseSnapshot]" = {url: DatabaseSnapshot(name=name, store=self.state) for url, name in SNAPSHOT_NAMES.items()}
+        self._person_list: "list[Person] | None" = None
         self._name_list: "list[str]" = []
-        self._upcoming_list: "list[FilmProject]" = []
-        self._released_list: "list[FilmProject]" = []
+        self._upcoming_list: "list[FilmProject] | None" = None
+        self._released_list: "list[FilmProject] | None" = None
         self._previous_projects: "dict[str, str]" = {}
-        self._upcoming_multiselect_options: "dict[str, dict[str, str]]" = {}
-        self._released_multiselect_options: "dict[str, dict[str, str]]" = {}
+        self.excluded_store = excluded_store if excluded_store is not None else ExcludedProjectStore()
+        self.registry = ProjectRegistry(excluded_store=self.excluded_store)
 
-        # Find all relevant previous data
-        self.update_person_list()
-        self.update_upcoming_list()
-        self.update_released_list()
 
+    def refresh(self):
+        """Forget the database lists and the projects found so far, for the next cycle of the daemon mode.
+
+        The lists are synced again the next time they are used. Even with `full_sync`, only the pages
+        changed since the last sync are fetched until `full_sync_interval` has passed.
+        """
+        self._full_sync = False
+        self._person_list = None
+        self._name_list = []
+        self._upcoming_list = None
+        self._released_list = None
+        self._previous_projects = {}
+        self.registry = ProjectRegistry(excluded_store=self.excluded_store)
 
     @property
     def person_list(self):
         """List of objects of the `Person` dataclass, containing all directors and actors/actresses."""
-        if self._person_list == []:
+        # The upcoming projects are needed to find the tmdb ids of each person's projects
+        self.upcoming_list
+        if self._person_list is None:
             self.update_person_list()
+        # The relations of pages archived earlier in the run are already gone from the state store
+        project_tmdb_ids = self.state.person_project_tmdb_ids(database="upcoming")
         for person in self._person_list:
-            person.projects = [self.previous_projects[p_id] for p_id in person.project_page_ids]
+            person.projects = project_tmdb_ids.get(person.notion_page_id, [])
         return self._person_list
     
     @property
     def upcoming_list(self):
         """List of objects of the `FilmProject` dataclass, containing all upcoming film projects."""
-        if self._upcoming_list == []:
+        if self._upcoming_list is None:
             self.update_upcoming_list()
         return self._upcoming_list
     
     @property
     def released_list(self):
         """List of objects of the `FilmProject` dataclass, containing all released film projects."""
-        if self._released_list == []:
+        if self._released_list is None:
             self.update_released_list()
         return self._released_list
     
     @property
     def previous_projects(self):
+        """Dictionary with the tmdb id of each project in the upcoming database by page id."""
         if self._previous_projects == {}:
-            try:
-                with open(PREVIOUS_PROJECTS_FILENAME, "r") as f:
-                    self._previous_projects = json.load(f)
-            except FileNotFoundError:
-                # Make sure there is a file to read from in the future
-                self.write_json_to_file(data={}, filename=PREVIOUS_PROJECTS_FILENAME)
+            self._previous_projects = self.state.project_tmdb_ids(database="upcoming")
         return self._previous_projects
     
     @property
     def multiselect_genre_options(self):
         """Dictionary containing all the json info about each genre tag in the databases in Notion."""
-        if self._upcoming_multiselect_options == {}:
-            with open(NOTION_MULTISELECT_GENRES_FILENAME, "r") as f:
-                self._upcoming_multiselect_options = json.load(f)
-        return self._upcoming_multiselect_options
-
-    def read_database(self, url: str = GET_PERSON_DATABASE_URL):
-        """Return all pages in a Notion database located at `url`."""
-        payload = { "page_size": 100 }
-        response = self._session.post(url, json=payload, headers=HEADERS)
-        data = response.json()
-
-        results = data["results"]
-
-        while data["has_more"]:
-            payload = {"page_size": 100, "start_cursor": data["next_cursor"]}
+        return GENRE_REGISTRY.notion_options
+
+    def get_genre_options(self, genres: "list[str]") -> "list[dict[str, str]]":
+        """Get the multi-select options for `genres`, reading the options from the database schema if any genre is unknown."""
+        if GENRE_REGISTRY.missing_genre_names(genres) and not GENRE_REGISTRY.notion_options_refreshed:
+            # Only one write worker needs to read the schema
+            with self._genre_options_lock:
+                if not GENRE_REGISTRY.notion_options_refreshed:
+                    response = self._session.get(UPCOMING_DATABASE_URL, headers=HEADERS)
+                    data = response.json()
+
+                    if response.status_code == 200:
+                        GENRE_REGISTRY.update_notion_options(options=data["properties"]["Genres"]["multi_select"]["options"])
+                    else:
+                        CustomLogger.warning(f"Could not read the genre options of the UpcomingProjects database. Response status code: {response.status_code}.")
+
+        return GENRE_REGISTRY.get_notion_options(genres)
+
+    def read_database_pages(self, url: str = GET_PERSON_DATABASE_URL, query_filter: "dict | None" = None, sorts: "list[dict] | None" = None, prefetch: bool = True) -> "Iterator[list[dict]]":
+        """Yield the raw pages in a Notion database located at `url`, one page of query results at a time.
+
+        `query_filter` and `sorts` follow the format of the filter and sorts of the Notion database query endpoint,
+        and are used to only return the matching pages in the given order. With `prefetch`, the next page of
+        results is requested while the current one is being processed.
+        """
+        query = {}
+        if query_filter:
+            query["filter"] = query_filter
+        if sorts:
+            query["sorts"] = sorts
+
+        def fetch(start_cursor: "str | None") -> dict:
+            payload = {"page_size": 100, **query}
+            if start_cursor:
+                payload["start_cursor"] = start_cursor
             response = self._session.post(url, json=payload, headers=HEADERS)
             data = response.json()
-            results.extend(data["results"])
+            if response.status_code != 200:
+                error = f"Could not read the database at {url=}. Response status code: {response.status_code}. {data.get('message', '')}"
+                CustomLogger.error(error)
+                raise ValueError(error)
+            return data
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            data = fetch(None)
+            while True:
+                next_data = None
+                if data["has_more"]:
+                    if executor is not None:
+                        next_data = executor.submit(fetch, data["next_cursor"])
+                    else:
+                        next_data = fetch(data["next_cursor"])
+                yield data["results"]
+
+                if next_data is None:
+                    break
+                data = next_data.result() if executor is not None else next_data
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
 
         CustomLogger.debug(f"Finished reading database at {url=}")
-        
-        return results
+
+    def read_database(self, url: str = GET_PERSON_DATABASE_URL, query_filter: "dict | None" = None, sorts: "list[dict] | None" = None) -> "Iterator[Person | FilmProject]":
+        """Yield the pages in a Notion database located at `url` as `Person`s or `FilmProject`s.
+
+        Only one page of query results is held in memory at a time, see `read_database_pages`.
+        """
+        parse = parse_person if url == GET_PERSON_DATABASE_URL else parse_project
+        for results in self.read_database_pages(url=url, query_filter=query_filter, sorts=sorts):
+            for result in results:
+                yield parse(result)
+
+    def sync_database(self, url: str) -> "Iterator[list[dict]]":
+        """Yield all raw pages in a Notion database located at `url` in batches, only fetching the pages changed since the last sync.
+
+        Every page is read again with `full_sync`, or when the last full sync of the database is older than
+        `full_sync_interval`. The sync cursor is only saved once every batch has been consumed.
+        """
+        snapshot = self._snapshots[url]
+
+        if self._full_sync or snapshot.full_sync_due(self._full_sync_interval):
+            snapshot.begin(full=True)
+            count = 0
+            for results in self.read_database_pages(url=url):
+                pages = snapshot.merge(results)
+                count += len(pages)
+                yield pages
+            CustomLogger.debug(f"Read all {count} pages of the {snapshot.name} database")
+        else:
+            snapshot.begin(full=False)
+            count = 0
+            for results in self.read_database_pages(url=url, query_filter=snapshot.filter):
+                count += len(snapshot.merge(results))
+            CustomLogger.debug(f"Merged {count} changed pages into the {snapshot.name} snapshot")
+            yield from snapshot.iter_pages()
+
+        snapshot.finish()
 
     def write_json_to_file(self, data, filename: str = "data/notion_personlist_json.json"):
         with open(filename, "w") as f:
@@ -130,146 +388,81 @@ class NotionUpdater():
         urls = [GET_PERSON_DATABASE_URL, GET_UPCOMING_DATABASE_URL, GET_RELEASED_DATABASE_URL]
 
         for filename, url in zip(filenames, urls):
-            data = self.read_database(url=url)
+            data = [page for results in self.read_database_pages(url=url) for page in results]
             self.write_json_to_file(data=data, filename=filename)
 
 
     def update_person_list(self):
-        """Get all persons from Notion database with their associated attributes."""
-        results = self.read_database(url=GET_PERSON_DATABASE_URL)
-        for result in results:
-            page_id = result["id"]
-
-            properties = result["properties"]
-
-            name = properties["Name"]["title"][0]["plain_text"]
-
-            is_director, is_actor = False, False
-            for tag in properties["Tags"]["multi_select"]:
-                if tag["name"] == "Director":
-                    is_director = True
-                elif tag["name"] == "Actor":
-                    is_actor = True
-
-            if not properties["IMDb URL"]["url"] or not properties["TMDb URL"]["url"]:
+        """Get all persons from Notion database with their associated attributes.
 
-                CustomLogger.debug(f"Either IMDb url, TMDb url, or both urls are missing for {name}")
+        Persons with a missing TMDb url have an empty `tmdb_id` until they are found on TMDb with
+        `AsyncTMDbClient.resolve_persons` and written back with `backfill_person_urls`.
+        """
+        self._person_list = []
+        self._name_list = []
+        for results in self.sync_database(url=GET_PERSON_DATABASE_URL):
+            for result in results:
+                person = parse_person(result)
+                self._person_list.append(person)
+                self._name_list.append(person.name)
 
-                # Find the IMDb and TMDb urls from the name
-                tmdb_id = get_person_id(requests_session=self._session, name=name)
-                tmdb_url = f"{TMDB_PERSON_URL}/{tmdb_id}"
-                imdb_id = get_external_id_person(requests_session=self._session, person_id=tmdb_id)
-                imdb_url = f"{IMDB_PERSON_URL}/{imdb_id}"
+        self.state.save_people(self._person_list)
 
-                # Add the urls to the person's page in the database
-                url_payload = {
-                    "properties": {
-                        "IMDb URL": {"url": imdb_url},
-                        "TMDb URL": {"url": tmdb_url}
-                    }
-                }
-                response = self._session.patch(f"{CREATE_PAGE_URL}/{page_id}", headers=HEADERS, json=url_payload)
+    def get_projects(self, url: str, query_filter: "dict | None" = None) -> "list[FilmProject]":
+        """Method for getting all `FilmProject`s of the database at `url`.
 
-                CustomLogger.debug(f"Updated the page for {name} with their urls. Patch request response status code: {response.status_code}")
+        With a `query_filter`, only the matching pages are fetched directly from Notion instead of syncing the whole database.
+        """
+        if query_filter:
+            return list(self.read_database(url=url, query_filter=query_filter))
 
-            else:
-                imdb_url = properties["IMDb URL"]["url"]
-                tmdb_url = properties["TMDb URL"]["url"]
-
-            # Get the ID from the TMDb url
-            tmdb_id_regex = r".*\/person\/(\d+)-.*"
-            tmdb_id = re.sub(tmdb_id_regex, r"\1", tmdb_url)
-
-            project_page_ids = [relation["id"] for relation in properties["Upcoming projects"]["relation"]]
-
-            person = Person(
-                notion_page_id=page_id,
-                tmdb_id=tmdb_id,
-                tmdb_url=tmdb_url,
-                imdb_url=imdb_url,
-                name=name,
-                is_director=is_director,
-                is_actor=is_actor
-            )
-
-            person.project_page_ids = project_page_ids
-
-            if self.previous_projects:
-                try:
-                    person.projects = [self.previous_projects[page_id] for page_id in person.project_page_ids]
-                except KeyError:
-                    CustomLogger.warning(f"KeyError: {page_id} not found in previous projects")
-
-            self._person_list.append(person)
-            self._name_list.append(name)
-
-    def get_projects(self, url: str) -> "list[FilmProject]":
-        """Method for getting all `FilmProject`s of the database at `url`."""
         projects = []
-        results = self.read_database(url=url)
-        for result in results:
-            project_page_id = result["id"]
-            properties = result["properties"]
-            
-            person_page_ids = [relation["id"] for relation in properties["Included people"]["relation"]]
-
-            title = properties["Title"]["title"][0]["text"]["content"]
-
-            imdb_url = properties["IMDb URL"]["url"]
-            tmdb_url = properties["TMDb URL"]["url"]
-
-            # Get the ID from the TMDb url
-            tmdb_id_regex = r".*\/movie\/(\d+)-.*"
-            tmdb_id = re.sub(tmdb_id_regex, r"\1", tmdb_url)
-
-            genres = [tag["name"] for tag in properties["Genres"]["multi_select"]]
-
-            synopsis = properties["Synopsis"]["rich_text"][0]["text"]["content"]
+        for results in self.sync_database(url=url):
+            for result in results:
+                film_project = parse_project(result)
+                projects.append(film_project)
 
-            popularity = properties["Popularity"]["number"]
+                if url == GET_UPCOMING_DATABASE_URL:
+                    self._previous_projects[film_project.notion_page_id] = film_project.tmdb_id
 
-            if properties["Release date"]["date"]:
-                release_date = properties["Release date"]["date"]["start"]
-            else:
-                release_date = None
-
-            exclude = properties["Exclude"]["checkbox"]
-
-            film_project = FilmProject(
-                tmdb_id=tmdb_id,
-                tmdb_url=tmdb_url,
-                imdb_url=imdb_url,
-                title=title,
-                synopsis=synopsis,
-                genres=genres,
-                popularity=popularity,
-                associated_person_page_ids=person_page_ids
-            )
-
-            film_project.excluded = exclude
-            film_project.notion_page_id = project_page_id
-            
-            if release_date:
-                film_project.release_date = release_date
-
-            projects.append(film_project)
+        self.state.save_projects(database=SNAPSHOT_NAMES[url], projects=projects)
 
-            if url == GET_UPCOMING_DATABASE_URL:
-                self._previous_projects[project_page_id] = tmdb_id
-        
         return projects
 
     def update_upcoming_list(self):
         """Get all upcoming projects from Notion database."""
         self._upcoming_list = self.get_projects(url=GET_UPCOMING_DATABASE_URL)
+        for project in self._upcoming_list:
+            self.registry.add_previous(project)
 
     def update_released_list(self):
         """Get all released projects from Notion database."""
         self._released_list = self.get_projects(url=GET_RELEASED_DATABASE_URL)
 
 
+    def backfill_person_urls(self, persons: "list[Person]") -> "list[Mutation]":
+        """Queue updates of the pages of resolved persons with their urls, after all other writes."""
+        mutations = []
+        for person in persons:
+            url_properties = {
+                "IMDb URL": {"url": person.imdb_url or None},
+                "TMDb URL": {"url": person.tmdb_url}
+            }
+            mutations.append(self.patch_page(
+                page_id=person.notion_page_id,
+                properties=url_properties,
+                priority=PRIORITY_BACKFILL,
+                on_done=lambda mutation, person=person: self.state.update_people([person])
+            ))
+
+        CustomLogger.debug(f"Queued updates of the urls of {len(persons)} persons")
+        return mutations
+
     def add_persons_to_database(self, persons: "list[Person]"):
-        responses = []
+        if self._person_list is None:
+            self.update_person_list()
+
+        mutations = []
         for person in persons:
             # Don't add person that's already in the Notion database
             if person.name in self._name_list:
@@ -294,13 +487,13 @@ class NotionUpdater():
                 "TMDb URL": {"url": person.tmdb_url}
             }
 
-            response = self.create_page_in_person_database(data=data)
-            responses.append(response)
-        
-        return responses
+            mutations.append(self.create_page_in_person_database(data=data))
+
+        self.writes.flush(mutations)
+        return [mutation.response for mutation in mutations]
         
 
-    def create_page_in_person_database(self, data: dict):
+    def create_page_in_person_database(self, data: dict) -> Mutation:
         """Creates an entry in the Notion database for directors/actors.
         
         data must follow the format:
@@ -316,49 +509,173 @@ class NotionUpdater():
                 {'id': 'b758d37a-dfba-4038-9773-3cf384878e7e', 'name': 'Actor', 'color': 'blue'}
         """
 
-        url = CREATE_PAGE_URL
         payload = {"parent": {"database_id": PERSON_LIST_DATABASE_ID}, "properties": data}
-        response = self._session.post(url, headers=HEADERS, json=payload)
-        return response
+        key = create_key(database_id=PERSON_LIST_DATABASE_ID, tmdb_url=data["TMDb URL"]["url"])
+        return self.writes.submit(Mutation(kind="create", key=key, method="POST", url=CREATE_PAGE_URL, payload=payload, priority=PRIORITY_PERSON))
     
 
-    def add_film_projects_to_database(self, projects: "list[FilmProject]", database: str):
-        """Add film projects to the database with a relation link to the person database.
+    def get_project_properties(self, project: FilmProject, names: "list[str] | None" = None) -> dict:
+        """Return the properties of the page for a project, or only the properties in `names`."""
+        names = names if names is not None else ["Title", "Included people", "Genres", "Synopsis", "IMDb URL", "TMDb URL", "Popularity", "Release date"]
+
+        properties = {}
+        for name in names:
+            if name == "Title":
+                properties[name] = {"title": [{"text": {"content": project.title}}]}
+            elif name == "Included people":
+                properties[name] = {"relation": [{"id": p_id} for p_id in project.associated_person_page_ids]}
+            elif name == "Genres":
+                properties[name] = {"multi_select": self.get_genre_options(project.genres)}
+            elif name == "Synopsis":
+                properties[name] = {"rich_text": [{"text": {"content": project.synopsis}}]}
+            elif name == "IMDb URL":
+                properties[name] = {"url": project.imdb_url if project.imdb_url else None}
+            elif name == "TMDb URL":
+                properties[name] = {"url": project.tmdb_url}
+            elif name == "Popularity":
+                properties[name] = {"number": project.popularity}
+            elif name == "Release date":
+                properties[name] = {"date": {"start": project.release_date} if project.release_date else None}
+        return properties
+
+    def add_film_projects_to_database(self, projects: "list[FilmProject]", database: str) -> "list[Mutation]":
+        """Add film projects to the database with a relation link to the person database, and wait until they are written.
         
         Param `database` must be either "upcoming" or "released".
         """
+        mutations = [self.add_film_project_to_database(project=project, database=database) for project in projects]
+        self.writes.flush(mutations)
+        return mutations
+
+    def add_film_project_to_database(self, project: FilmProject, database: str) -> Mutation:
+        """Queue a single film project to be added to the database with a relation link to the person database.
+
+        Param `database` must be either "upcoming" or "released". New upcoming projects are written before
+        any other writes, the most popular first. Projects added to the upcoming database get the id of
+        their new page and are added to the upcoming list.
+        """
 
         if database == "upcoming":
             database_id = UPCOMING_PROJECTS_DATABASE_ID
+            priority, value = PRIORITY_UPCOMING, project.popularity or 0.0
         elif database == "released":
             database_id = RELEASED_PROJECTS_DATABASE_ID
+            priority, value = PRIORITY_MOVE, 0.0
         else:
             error = "Param `database` must be either 'upcoming' or 'released'."
             CustomLogger.error(error)
             raise ValueError(error)
-        
-        for project in projects:
-            release_date = {"start": project.release_date} if hasattr(project, "release_date") else None
-            data = {
-                "Title": {"title": [{"text": {"content": project.title}}]},
-                "Included people": {"relation": [{"id": p_id} for p_id in project.associated_person_page_ids]},
-                "Genres": {"multi_select": [
-                    self.multiselect_genre_options[genre] for genre in project.genres
-                ]},
-                "Synopsis": {"rich_text": [{"text": {"content": project.synopsis}}]},
-                "IMDb URL": {"url": project.imdb_url if project.imdb_url else None},
-                "TMDb URL": {"url": project.tmdb_url},
-                "Popularity": {"number": project.popularity},
-                "Release date": {"date": release_date}
-            }
-            response = self.create_page_in_database(data=data, database_id=database_id)
 
-            if response.status_code != 200:
-                CustomLogger.warning(f"Something went wrong when adding {project.title} to the database. Response status code: {response.status_code}.")
+        # People can be merged into the project while it waits in the queue, so the properties are built when it is sent
+        sent_people: "list[str]" = []
+
+        def build_properties() -> dict:
+            sent_people[:] = project.associated_person_page_ids
+            return self.get_project_properties(project=project)
+
+        def on_done(mutation: Mutation):
+            page_id = mutation.response.json()["id"]
+            self.state.add_project(database=database, page_id=page_id, project=project)
+            if database == "upcoming":
+                project.notion_page_id = page_id
+                self._previous_projects[page_id] = project.tmdb_id
+                if self._upcoming_list is not None:
+                    self._upcoming_list.append(project)
+
+                # People merged into the project while the request was in flight
+                if project.associated_person_page_ids != sent_people:
+                    self.update_project_people(project=project)
+
+        key = create_key(database_id=database_id, tmdb_url=project.tmdb_url)
+        return self.create_page_in_database(data=build_properties, database_id=database_id, key=key, priority=priority, value=value, on_done=on_done)
+
+    def update_project_people(self, project: FilmProject) -> "Mutation | None":
+        """Queue an update of the relation links to the person database of a project that is already in the database.
+
+        Projects that are still waiting to be created get their people when they are created. Only one
+        update of the people of a project waits in the queue at a time, and it sends the people at the
+        time it is sent.
+        """
+        if not project.notion_page_id:
+            return None
+
+        with self._queued_people_updates_lock:
+            if project.tmdb_id in self._queued_people_updates:
+                return None
+            self._queued_people_updates.add(project.tmdb_id)
+
+        sent_people: "list[str]" = []
+
+        def build_payload() -> dict:
+            with self._queued_people_updates_lock:
+                self._queued_people_updates.discard(project.tmdb_id)
+            sent_people[:] = project.associated_person_page_ids
+            return {"properties": self.get_project_properties(project=project, names=["Included people"])}
+
+        def on_done(mutation: Mutation):
+            self.state.save_relations(project_page_id=project.notion_page_id, person_page_ids=sent_people)
+
+        return self.writes.submit(Mutation(
+            kind="patch",
+            key=f"{project.notion_page_id}:Included people",
+            method="PATCH",
+            url=f"{CREATE_PAGE_URL}/{project.notion_page_id}",
+            payload=build_payload,
+            priority=PRIORITY_UPDATE,
+            on_done=on_done
+        ))
+
+
+    def reconcile_projects(self, stored_projects: "list[FilmProject]", fresh_projects: "list[FilmProject]") -> "dict[str, int]":
+        """Update the pages of `stored_projects` with the fresh TMDb data of the same projects.
+
+        Only the changed properties are sent, and pages where nothing changed are not written at all.
+        The stored projects are updated in place. Returns the number of updated, unchanged and failed pages.
+        """
+        stored_by_tmdb_id = {project.tmdb_id: project for project in stored_projects}
+        counts = {"updated": 0, "unchanged": 0, "failed": 0}
+
+        def apply_changes(stored_project: FilmProject, fresh_project: FilmProject, changed: "list[str]"):
+            for name, attribute in (("Title", "title"), ("TMDb URL", "tmdb_url"), ("IMDb URL", "imdb_url"), ("Synopsis", "synopsis"), ("Genres", "genres"), ("Popularity", "popularity")):
+                if name in changed:
+                    setattr(stored_project, attribute, getattr(fresh_project, attribute))
+            if "Release date" in changed:
+                stored_project.release_date = fresh_project.release_date
+
+            self.state.add_project(database="upcoming", page_id=stored_project.notion_page_id, project=stored_project)
+            CustomLogger.debug(f"Updated {changed} of {stored_project.title}")
+
+        mutations = []
+        for fresh_project in fresh_projects:
+            stored_project = stored_by_tmdb_id.get(fresh_project.tmdb_id)
+            if stored_project is None:
+                continue
+
+            changed = get_changed_properties(stored_project=stored_project, fresh_project=fresh_project)
+            if not changed:
+                counts["unchanged"] += 1
+                continue
+
+            mutations.append(self.update_project_properties(
+                project=fresh_project,
+                names=changed,
+                on_done=lambda mutation, stored=stored_project, fresh=fresh_project, changed=changed: apply_changes(stored, fresh, changed)
+            ))
+
+        self.writes.flush(mutations)
+        for mutation in mutations:
+            counts["updated" if mutation.succeeded else "failed"] += 1
+
+        return counts
+
+    def update_project_properties(self, project: FilmProject, names: "list[str]", on_done: "Callable[[Mutation], None] | None" = None) -> Mutation:
+        """Queue an update of only the properties in `names` of a project that is already in the database."""
+        data = self.get_project_properties(project=project, names=names)
+        return self.patch_page(page_id=project.notion_page_id, properties=data, on_done=on_done)
 
 
-    def create_page_in_database(self, data: dict, database_id: str):
-        """Creates an entry in the Notion database for a project.
+    def create_page_in_database(self, data: "dict | Callable[[], dict]", database_id: str, key: str, priority: int = PRIORITY_UPDATE, value: float = 0.0, on_done: "Callable[[Mutation], None] | None" = None) -> Mutation:
+        """Queue an entry in the Notion database for a project.
         
         data must follow the format:
             data = {
@@ -372,54 +689,145 @@ class NotionUpdater():
                 "Release date": {"date": {"start": <insert date>}}
             }
             where tags is a list of genre multi_select options in json form.
+
+        data can also be a function returning the properties, which is called right before the page is created.
         """
-        url = CREATE_PAGE_URL
-        payload = {"parent": {"database_id": database_id}, "properties": data}
-        response = self._session.post(url, headers=HEADERS, json=payload)
+        if callable(data):
+            payload = lambda: {"parent": {"database_id": database_id}, "properties": data()}
+        else:
+            payload = {"parent": {"database_id": database_id}, "properties": data}
+        return self.writes.submit(Mutation(kind="create", key=key, method="POST", url=CREATE_PAGE_URL, payload=payload, priority=priority, value=value, on_done=on_done))
+
+    def patch_page(self, page_id: str, properties: dict, priority: int = PRIORITY_UPDATE, on_done: "Callable[[Mutation], None] | None" = None) -> Mutation:
+        """Queue an update of the `properties` of a page."""
+        key = f"{page_id}:{','.join(sorted(properties))}"
+        return self.writes.submit(Mutation(kind="patch", key=key, method="PATCH", url=f"{CREATE_PAGE_URL}/{page_id}", payload={"properties": properties}, priority=priority, on_done=on_done))
+
+    def send_mutation(self, mutation: Mutation):
+        """Send a request that creates, changes or archives a page, recording it in the run journal.
+
+        The mutation is recorded before it is sent, and marked done or failed when the response arrives.
+        This is called by the workers of the write queue. A create that may have landed in an earlier
+        attempt is looked up first, and the page that was found is returned instead of creating it again.
+        """
+        if mutation.may_exist:
+            page = self.find_created_page(key=mutation.key)
+            if page is not None:
+                self.journal.complete(kind=mutation.kind, key=mutation.key, page_id=page["id"])
+                CustomLogger.debug(f"Found the page of the create mutation {mutation.key} after it failed")
+                return build_page_response(url=mutation.url, page=page)
+            mutation.may_exist = False
+
+        payload = mutation.build_payload()
+        self.journal.begin(kind=mutation.kind, key=mutation.key, method=mutation.method, url=mutation.url, payload=payload)
+        try:
+            response = self._session.request(mutation.method, mutation.url, headers=HEADERS, json=payload)
+        except Exception:
+            self.journal.fail(kind=mutation.kind, key=mutation.key)
+            raise
+
+        if response.status_code == 200:
+            self.journal.complete(kind=mutation.kind, key=mutation.key, page_id=response.json()["id"])
+        else:
+            self.journal.fail(kind=mutation.kind, key=mutation.key)
+
         return response
+
+    def resume_pending_mutations(self):
+        """Settle the mutations of an interrupted run that were sent without knowing if they landed.
+
+        Changes and archivals are sent again, since sending them twice does no harm. Created pages are
+        looked up in their database instead, and only marked as done if the page exists.
+        """
+        for kind, key, method, url, payload in self.journal.pending_mutations():
+            if kind == "archive":
+                self.delete_page(page_id=key)
+            elif kind == "patch":
+                self.writes.submit(Mutation(kind=kind, key=key, method=method, url=url, payload=payload))
+            elif kind == "create":
+                page = self.find_created_page(key=key)
+                if page is not None:
+                    self.journal.complete(kind=kind, key=key, page_id=page["id"])
+                else:
+                    self.journal.fail(kind=kind, key=key)
+            CustomLogger.debug(f"Resumed the pending {kind} mutation {key}")
+
+        self.writes.flush()
+
+    def find_created_page(self, key: str) -> "dict | None":
+        """Look up the page of a create mutation by the database and TMDb url in its key, see `create_key`."""
+        database_id, tmdb_url = key.split(":", 1)
+        query_filter = {"property": "TMDb URL", "url": {"equals": tmdb_url}}
+        return next((page for results in self.read_database_pages(url=QUERY_URLS[database_id], query_filter=query_filter, prefetch=False) for page in results), None)
+
+    def move_film_projects_to_released(self, projects: "list[FilmProject]") -> "list[FilmProject]":
+        """Add the projects to the released database and remove them from the upcoming database.
+
+        Projects that were already added to the released database earlier in the run are not added again.
+        Returns the projects that were moved.
+        """
+        moved_projects = []
+        mutations = []
+        for project in projects:
+            status = self.journal.status(kind="create", key=create_key(database_id=RELEASED_PROJECTS_DATABASE_ID, tmdb_url=project.tmdb_url))
+            if status is not None and status[0] == RunJournal.DONE:
+                CustomLogger.debug(f"{project.title} was already added to the released database")
+                moved_projects.append(project)
+            else:
+                mutations.append((project, self.add_film_project_to_database(project=project, database="released")))
+
+        self.writes.flush([mutation for _, mutation in mutations])
+        moved_projects.extend(project for project, mutation in mutations if mutation.succeeded)
+
+        self.remove_film_projects_from_database(projects=moved_projects)
+        return moved_projects
     
 
     def remove_film_projects_from_database(self, projects: "list[FilmProject]"):
-        """Remove film projects from the database and add their tmdb ids to a file with excluded projects."""
-        
-        removed_project_tmdb_ids = []
-        for project in projects:
-            response = self.delete_page(page_id=project.notion_page_id)
+        """Remove film projects from the database and add their tmdb ids to the excluded projects.
 
-            if response.status_code != 200:
-                CustomLogger.warning(f"Something went wrong when deleting {project.title} from the database. Response status code: {response.status_code}.")
-            else:
-                removed_project_tmdb_ids.append(project.tmdb_id)
-            
-            CustomLogger.debug(f"Deleted {project.title} from the database")
-        
-        # Add the removed projects to the excluded projects file
-        self.add_excluded_projects_to_file(project_tmdb_ids=removed_project_tmdb_ids)
+        The projects are excluded before their pages are archived, so a run that is interrupted after an
+        archive was journaled never adds the project again.
+        """
+        self.registry.add_excluded([project.tmdb_id for project in projects])
+        self.excluded_store.flush()
+        CustomLogger.debug(f"Added {len(projects)} projects to the excluded projects")
+
+        mutations = [self.delete_page(page_id=project.notion_page_id) for project in projects]
+        self.writes.flush(mutations)
+
+        for project, mutation in zip(projects, mutations):
+            if mutation.succeeded:
+                self.registry.remove_previous(project.tmdb_id)
+                CustomLogger.debug(f"Deleted {project.title} from the database")
     
 
-    def delete_page(self, page_id: str):
-        """Deletes a page from the Notion database."""
+    def delete_page(self, page_id: str) -> Mutation:
+        """Queue the deletion of a page from the Notion database."""
+
+        # Archived pages are left out of the database queries, so they have to be removed from the local state here
+        def on_done(mutation: Mutation):
+            self.state.remove_page(page_id)
+            self._previous_projects.pop(page_id, None)
+
         url = f"{CREATE_PAGE_URL}/{page_id}"
-        response = self._session.patch(url, headers=HEADERS, json={"archived": True})
-        return response
+        return self.writes.submit(Mutation(kind="archive", key=page_id, method="PATCH", url=url, payload={"archived": True}, priority=PRIORITY_MOVE, on_done=on_done))
     
 
-    def add_excluded_projects_to_file(self, project_tmdb_ids: "list[str]"):
-        """Add all excluded project tmdb ids to a file for future lookup."""
-        with open("data/excluded_projects.txt", "a") as f:
-            for tmdb_id in project_tmdb_ids:
-                f.write(f"{tmdb_id}\n")
-        CustomLogger.debug(f"Added {len(project_tmdb_ids)} projects to the excluded projects file")
-
     def get_excluded_projects(self, database: str = "upcoming") -> "list[FilmProject]": 
-        """Get all projects with the exclude checkbox checked."""
-        projects = []
+        """Get all projects with the exclude checkbox checked.
+
+        The upcoming list is needed for the rest of the run anyway, while the released projects are
+        filtered by Notion so that the released list isn't read.
+        """
+        excluded_projects = []
         if database == "upcoming":
-            projects = self.upcoming_list
+            excluded_projects = [project for project in self.upcoming_list if project.excluded]
         elif database == "released":
-            projects = self.released_list
-
-        excluded_projects = [project for project in projects if project.excluded]
+            if self._released_list is not None:
+                excluded_projects = [project for project in self._released_list if project.excluded]
+            else:
+                excluded_projects = self.get_projects(url=GET_RELEASED_DATABASE_URL, query_filter=EXCLUDE_FILTER)
 
         return excluded_projects
     
@@ -436,12 +844,11 @@ class NotionUpdater():
     
 
     def close(self):
-        """Save the relation between page ids and tmdb ids to a json file for future use."""
-        
-        # Update previous projects with new upcoming projects that have been found
-        self._previous_projects = {project.notion_page_id: project.tmdb_id for project in self._upcoming_list}
+        """Finish the queued writes and close the local stores."""
+        self.writes.close()
 
-        self.write_json_to_file(data=self._previous_projects, filename=PREVIOUS_PROJECTS_FILENAME)
+        self.excluded_store.close()
+        self.state.close()
     
 
 
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from state_store import StateStore
+
+
+class DatabaseSnapshot:
+    """Local copy of the raw pages in a Notion database, used to only fetch pages that changed since the last sync.
+
+    The pages live in the `StateStore` and are never all held in memory. A sync writes each batch of
+    pages from Notion to the store as it arrives with `merge`, and `finish` saves the new sync cursor
+    once every batch has been merged. The pages are read back in batches with `iter_pages`.
+
+    The sync cursor is the latest `last_edited_time` among the pages in the snapshot. Notion rounds
+    `last_edited_time` to the minute, so a query for pages edited on or after the cursor may return a
+    few pages that are already up to date, but never misses one.
+
+    Pages archived from within Notion no longer show up in database queries, so they are only removed
+    from the snapshot by a full sync.
+    """
+
+    def __init__(self, name: str, store: StateStore) -> None:
+        self.name = name
+        self._store = store
+        self.cursor: "str | None" = store.get_cursor(name)
+        self.last_full_sync: "str | None" = store.get_cursor(f"{name}_full_sync")
+        self._full = False
+        self._next_cursor: "str | None" = None
+        self._seen_page_ids: "set[str]" = set()
+
+    @property
+    def filter(self) -> "dict | None":
+        """Notion query filter for the pages edited since the last sync, or None if there hasn't been a sync."""
+        if self.cursor is None:
+            return None
+        return {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": self.cursor}}
+
+    def full_sync_due(self, interval: "timedelta | None") -> bool:
+        """Whether the next sync should read every page: always before the first sync, and with an `interval` once the last full sync is older."""
+        if self.cursor is None:
+            return True
+        if interval is None:
+            return False
+        return self.last_full_sync is None or datetime.now(timezone.utc) - datetime.fromisoformat(self.last_full_sync) >= interval
+
+    def begin(self, full: bool):
+        """Start a sync. A `full` sync replaces all pages with the merged ones when it is finished."""
+        self._full = full
+        self._next_cursor = None if full else self.cursor
+        self._seen_page_ids = set()
+
+    def merge(self, pages: "list[dict]") -> "list[dict]":
+        """Add new pages and replace changed pages. Returns the pages that are not archived."""
+        kept_pages = []
+        removed_page_ids = []
+        for page in pages:
+            if page.get("archived") or page.get("in_trash"):
+                removed_page_ids.append(page["id"])
+            else:
+                kept_pages.append(page)
+                self._seen_page_ids.add(page["id"])
+            # The timestamps are ISO 8601 strings in UTC, so they can be compared as strings
+            if self._next_cursor is None or page["last_edited_time"] > self._next_cursor:
+                self._next_cursor = page["last_edited_time"]
+
+        self._store.save_pages(database=self.name, pages=kept_pages, removed_page_ids=removed_page_ids)
+        return kept_pages
+
+    def finish(self):
+        """Save the new sync cursor, and after a full sync remove the pages that are no longer in the database.
+
+        Only called once every page of the sync has been merged, so an interrupted sync is fetched again.
+        """
+        if self._full:
+            self._store.delete_pages_except(database=self.name, page_ids=self._seen_page_ids)
+            self.last_full_sync = datetime.now(timezone.utc).isoformat()
+            self._store.set_cursor(f"{self.name}_full_sync", self.last_full_sync)
+        self.cursor = self._next_cursor
+        self._store.set_cursor(self.name, self.cursor)
+        self._seen_page_ids = set()
+
+    def iter_pages(self, batch_size: int = 100) -> "Iterator[list[dict]]":
+        """Yield the pages of the snapshot `batch_size` at a time."""
+        return self._store.iter_pages(database=self.name, batch_size=batch_size)
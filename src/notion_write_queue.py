@@ -0,0 +1,205 @@
+import itertools
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Union
+
+import requests
+
+from custom_logger import CustomLogger
+from requests_session import parse_retry_after
+from resilience import backoff_delay
+
+# Priority tiers of the mutations, lower tiers are sent first
+PRIORITY_UPCOMING = 0
+PRIORITY_MOVE = 1
+PRIORITY_UPDATE = 2
+PRIORITY_PERSON = 3
+PRIORITY_BACKFILL = 4
+
+# Status codes that are worth sending the same request again for
+RETRY_STATUS_CODES = {409, 429, 500, 502, 503, 504}
+
+
+@dataclass
+class Mutation:
+    """A request that creates, changes or archives a Notion page.
+
+    `payload` is either the json body of the request or a function returning it, which is called right
+    before the request is sent so that the body is as up to date as possible. `on_done` is called with
+    the mutation when it succeeds. Within a priority tier, mutations with a higher `value` are sent first.
+    `may_exist` is set on a create that failed in a way that doesn't rule out that the page was created.
+    """
+    kind: str
+    key: str
+    method: str
+    url: str
+    payload: "Union[dict, Callable[[], dict]]"
+    priority: int = PRIORITY_UPDATE
+    value: float = 0.0
+    on_done: "Callable[[Mutation], None] | None" = None
+    status: str = "queued"
+    attempts: int = 0
+    response: "requests.Response | None" = None
+    error: "BaseException | None" = None
+    may_exist: bool = False
+    finished: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == "done"
+
+    def build_payload(self) -> dict:
+        return self.payload() if callable(self.payload) else self.payload
+
+    def wait(self) -> "Mutation":
+        """Block until the mutation has succeeded or failed."""
+        self.finished.wait()
+        return self
+
+
+class NotionWriteQueue():
+    """Priority queue of Notion mutations, sent by a pool of `workers` threads.
+
+    The requests are sent with `send`, which should go through the rate limited Notion session, so the
+    workers keep the request budget fully used while the most valuable mutations are always sent first.
+    A mutation that fails with a status code in `RETRY_STATUS_CODES` or a connection error is queued again,
+    up to `max_retries` times, after a jittered exponential backoff or the `Retry-After` of the response.
+    A create that failed with anything but a 429 may have created the page anyway, so it is queued again
+    with `may_exist` set, and `send` has to look the page up before creating it again. At most
+    `max_pending` mutations wait in the queue, so `submit` blocks while Notion can't keep up.
+    """
+
+    def __init__(self, send: "Callable[[Mutation], requests.Response]", workers: int = 3, max_retries: int = 3, retry_delay: float = 1.0, max_retry_delay: float = 60.0, max_pending: int = 1000) -> None:
+        self._send = send
+        self._workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_pending = max_pending
+
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._threads: "list[threading.Thread]" = []
+        self._lock = threading.Lock()
+
+        # Number of submitted mutations that haven't succeeded or failed yet
+        self._unfinished = 0
+        self._unfinished_changed = threading.Condition()
+
+        self.failed: "list[Mutation]" = []
+        self._stats: "dict[str, int]" = {}
+
+    def submit(self, mutation: Mutation) -> Mutation:
+        """Queue a mutation and return it. Call `wait` on the mutation to block until it has been sent."""
+        with self._unfinished_changed:
+            # Mutations submitted by the workers themselves never wait, or the workers could end up waiting for each other
+            if threading.current_thread() not in self._threads:
+                self._unfinished_changed.wait_for(lambda: self._unfinished < self.max_pending)
+            self._unfinished += 1
+        self._start_workers()
+        self._put(mutation)
+        return mutation
+
+    def _put(self, mutation: Mutation):
+        self._queue.put(((mutation.priority, -mutation.value, next(self._order)), mutation))
+
+    def _start_workers(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self._workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            _, mutation = self._queue.get()
+            if mutation is None:
+                return
+            self._process(mutation)
+
+    def _process(self, mutation: Mutation):
+        mutation.attempts += 1
+        try:
+            mutation.response = self._send(mutation)
+            mutation.error = None
+        except Exception as error:
+            mutation.response = None
+            mutation.error = error
+
+        if mutation.response is not None and mutation.response.status_code == 200:
+            self._finish(mutation, "done")
+            return
+
+        if mutation.error is not None:
+            retryable = isinstance(mutation.error, requests.RequestException)
+        else:
+            retryable = mutation.response.status_code in RETRY_STATUS_CODES
+        if retryable and mutation.attempts <= self.max_retries:
+            self._count(f"{mutation.kind}_retried")
+            if mutation.kind == "create" and (mutation.response is None or mutation.response.status_code != 429):
+                mutation.may_exist = True
+            # Wait without holding up the worker, so other mutations are sent in the meantime
+            delay = backoff_delay(mutation.attempts, self.retry_delay, self.max_retry_delay)
+            if mutation.response is not None:
+                delay = max(delay, parse_retry_after(mutation.response.headers.get("Retry-After")) or 0.0)
+            timer = threading.Timer(delay, self._put, args=(mutation,))
+            timer.daemon = True
+            timer.start()
+            return
+
+        self._finish(mutation, "failed")
+
+    def _finish(self, mutation: Mutation, status: str):
+        mutation.status = status
+        self._count(f"{mutation.kind}_{status}")
+
+        if status == "done" and mutation.on_done is not None:
+            try:
+                mutation.on_done(mutation)
+            except Exception as error:
+                CustomLogger.error(f"Error after the {mutation.kind} mutation {mutation.key}: {error!r}")
+        elif status == "failed":
+            with self._lock:
+                self.failed.append(mutation)
+            reason = mutation.error if mutation.error is not None else f"status code {mutation.response.status_code}"
+            CustomLogger.warning(f"The {mutation.kind} mutation {mutation.key} failed after {mutation.attempts} attempts: {reason}")
+
+        CustomLogger.debug(f"The {mutation.kind} mutation {mutation.key} is {status} after {mutation.attempts} attempts")
+        mutation.finished.set()
+        with self._unfinished_changed:
+            self._unfinished -= 1
+            self._unfinished_changed.notify_all()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    @property
+    def stats(self) -> "dict[str, int]":
+        """Number of mutations of each kind that were done, failed or retried."""
+        with self._lock:
+            return dict(self._stats)
+
+    def flush(self, mutations: "list[Mutation] | None" = None):
+        """Wait until `mutations`, or every mutation submitted so far, has succeeded or failed."""
+        if mutations is not None:
+            for mutation in mutations:
+                mutation.wait()
+            return
+
+        # Mutations waiting to be retried are not in the queue, so the queue being empty is not enough
+        with self._unfinished_changed:
+            self._unfinished_changed.wait_for(lambda: self._unfinished == 0)
+
+    def close(self):
+        """Send every queued mutation and stop the workers."""
+        self.flush()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(((float("inf"), 0, next(self._order)), None))
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,55 @@
+import json
+import os
+import threading
+
+TMDB_PERSON_IDS_FILE = "data/person_ids.json"
+
+
+class PersonIdCache:
+    """Maps person names to their TMDb and IMDb ids, stored in a json file between runs.
+
+    The file is read the first time an id is needed, and only written by `save` when a new person
+    has been added.
+    """
+
+    def __init__(self, filename: str = TMDB_PERSON_IDS_FILE) -> None:
+        self._filename = filename
+        self._ids: "dict[str, dict[str, str]] | None" = None
+        self._changed = False
+        self._lock = threading.Lock()
+
+    @property
+    def ids(self) -> "dict[str, dict[str, str]]":
+        """The `tmdb_id` and `imdb_id` of each person by name."""
+        if self._ids is None:
+            with self._lock:
+                if self._ids is None:
+                    self._ids = self._read_json(self._filename)
+        return self._ids
+
+    def get(self, name: str) -> "tuple[str, str] | None":
+        """Return the TMDb and IMDb ids of the person named `name`, if they are known."""
+        ids = self.ids.get(name)
+        if ids is None:
+            return None
+        return ids["tmdb_id"], ids["imdb_id"]
+
+    def set(self, name: str, tmdb_id: str, imdb_id: str):
+        with self._lock:
+            self.ids[name] = {"tmdb_id": tmdb_id, "imdb_id": imdb_id}
+            self._changed = True
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            with open(self._filename, "w") as f:
+                json.dump(self._ids, f, indent=2)
+            self._changed = False
+
+    @staticmethod
+    def _read_json(filename: str) -> dict:
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, "r") as f:
+            return json.load(f)
@@ -0,0 +1,82 @@
+from custom_dataclasses import FilmProject, Person
+from custom_logger import CustomLogger
+from notion_api_calls import NotionUpdater
+from project_registry import ProjectRegistry
+from run_journal import RunJournal
+from tmdb_async_client import AsyncTMDbClient
+
+
+class ProjectPipeline():
+    """Streams new upcoming projects from the TMDb scan to the UpcomingProjects database.
+
+    The pipeline has three stages running at the same time:
+        1. The TMDb scan yields the projects of each person as soon as the person has been scanned.
+        2. The merge stage skips projects that are already in the database or excluded, and merges
+           projects found for several persons.
+        3. The write queue of the `NotionUpdater` adds the new projects to Notion, and updates the people
+           of projects that were written before another person was found to be involved.
+
+    The scan holds at most `queue_size` scanned persons, and the write queue blocks the merge stage
+    while Notion can't keep up, so the TMDb and Notion rate limits are used at the same time without
+    holding every project in memory while waiting.
+
+    With a `journal`, every successfully scanned person is checkpointed, and the persons checkpointed by
+    an interrupted run are not scanned again. Their projects are merged from the journal instead.
+    Persons whose scan failed are left out of `merge_projects` and the journal, and kept in `failed_persons`.
+    """
+
+    def __init__(self, notion_updater: NotionUpdater, tmdb_client: AsyncTMDbClient, registry: ProjectRegistry, queue_size: int = 100, journal: "RunJournal | None" = None) -> None:
+        self._notion_updater = notion_updater
+        self._tmdb_client = tmdb_client
+        self._registry = registry
+        self._queue_size = queue_size
+        self._journal = journal
+        self.failed_persons: "list[Person]" = []
+
+    def run(self, persons: "list[Person]") -> "list[FilmProject]":
+        """Scan all persons and write their new projects to Notion. Returns the new projects."""
+        scanned_persons = self._journal.scanned_persons() if self._journal else {}
+        persons_to_scan = [person for person in persons if person.notion_page_id not in scanned_persons]
+
+        for person in persons:
+            if person.notion_page_id in scanned_persons:
+                self.merge_projects(person=person, projects=scanned_persons[person.notion_page_id])
+
+        for person, projects in self._tmdb_client.iter_scan(persons=persons_to_scan, queue_size=self._queue_size):
+            if projects is None:
+                self.failed_persons.append(person)
+                CustomLogger.warning(f"Could not scan {person.name} for upcoming projects")
+                continue
+
+            self.merge_projects(person=person, projects=projects)
+            if self._journal:
+                self._journal.checkpoint_person(person=person, projects=projects)
+            CustomLogger.info(f"Found {len(projects)} upcoming projects for {person.name}")
+
+        # Wait until every new project has been written
+        self._notion_updater.writes.flush()
+
+        return self._registry.new_projects
+
+    def merge_projects(self, person: Person, projects: "list[FilmProject]"):
+        """Queue the new projects of a person to be written to Notion."""
+        for project in projects:
+            outcome = self._registry.add(project=project, person=person)
+
+            if outcome == ProjectRegistry.PREVIOUS:
+                used_project = self._registry.get(project.tmdb_id)
+                if person.notion_page_id in used_project.associated_person_page_ids:
+                    CustomLogger.debug(f"Project '{project.title}' is already in the database")
+                else:
+                    # The person was added to the PersonList, or scanned in a later daemon cycle, after the project was written
+                    used_project.associated_person_page_ids.append(person.notion_page_id)
+                    self._notion_updater.update_project_people(project=used_project)
+                    CustomLogger.debug(f"Project '{project.title}' is already in the database. Updated associated people: {used_project.associated_person_page_ids}")
+            elif outcome == ProjectRegistry.EXCLUDED:
+                CustomLogger.debug(f"Project '{project.title}' is excluded from the database")
+            elif outcome == ProjectRegistry.MERGED:
+                used_project = self._registry.get(project.tmdb_id)
+                self._notion_updater.update_project_people(project=used_project)
+                CustomLogger.debug(f"Project '{project.title}' already in another person's list. Updated associated people: {used_project.associated_person_page_ids}")
+            elif outcome == ProjectRegistry.NEW:
+                self._notion_updater.add_film_project_to_database(project=project, database="upcoming")
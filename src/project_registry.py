@@ -0,0 +1,89 @@
+from custom_dataclasses import FilmProject, Person
+from excluded_store import ExcludedProjectStore
+
+
+class ProjectRegistry():
+    """Keeps track of all known film projects by their TMDb id.
+
+    A project is either a previous project already in the UpcomingProjects database, excluded from
+    the databases, or a new project found during this run. Adding a project that was already found
+    for another person merges the person into the associated people of the first project. The
+    excluded projects are looked up in the `excluded_store`.
+    """
+
+    # Outcomes of `add`
+    PREVIOUS = "previous"
+    EXCLUDED = "excluded"
+    NEW = "new"
+    MERGED = "merged"
+    DUPLICATE = "duplicate"
+
+    def __init__(self, excluded_store: ExcludedProjectStore) -> None:
+        self._previous: "dict[str, FilmProject]" = {}
+        self._excluded = excluded_store
+        self._new: "dict[str, FilmProject]" = {}
+        self._outcomes: "dict[str, int]" = {outcome: 0 for outcome in (self.PREVIOUS, self.EXCLUDED, self.NEW, self.MERGED, self.DUPLICATE)}
+
+    def add_previous(self, project: FilmProject):
+        """Register a project that is already in the UpcomingProjects database."""
+        self._previous[project.tmdb_id] = project
+
+    def remove_previous(self, tmdb_id: str):
+        self._previous.pop(tmdb_id, None)
+
+    def add_excluded(self, tmdb_ids: "list[str]"):
+        """Register projects that should never be added to the databases."""
+        self._excluded.add(tmdb_ids)
+
+    def get(self, tmdb_id: str) -> "FilmProject | None":
+        """Return the new or previous project with `tmdb_id`."""
+        return self._new.get(tmdb_id) or self._previous.get(tmdb_id)
+
+    @property
+    def previous_projects(self) -> "list[FilmProject]":
+        return list(self._previous.values())
+
+    @property
+    def new_projects(self) -> "list[FilmProject]":
+        return list(self._new.values())
+
+    def add(self, project: FilmProject, person: Person) -> str:
+        """Register a project found for `person` and return the outcome.
+
+        The outcome is one of:
+            PREVIOUS  - the project is already in the database and is skipped
+            EXCLUDED  - the project is excluded and is skipped
+            NEW       - the project is new and should be added to the database
+            MERGED    - the project was already found for another person, which now includes `person`
+            DUPLICATE - the project was already found and already includes `person`
+        """
+        if project.tmdb_id in self._previous:
+            outcome = self.PREVIOUS
+        elif project.tmdb_id in self._excluded:
+            outcome = self.EXCLUDED
+        elif project.tmdb_id in self._new:
+            used_project = self._new[project.tmdb_id]
+            if person.notion_page_id in used_project.associated_person_page_ids:
+                outcome = self.DUPLICATE
+            else:
+                used_project.associated_person_page_ids.append(person.notion_page_id)
+                outcome = self.MERGED
+        else:
+            self._new[project.tmdb_id] = project
+            outcome = self.NEW
+
+        if outcome in (self.NEW, self.MERGED, self.DUPLICATE) and project.tmdb_id not in person.projects:
+            person.projects.append(project.tmdb_id)
+
+        self._outcomes[outcome] += 1
+        return outcome
+
+    @property
+    def stats(self) -> "dict[str, int]":
+        """Number of projects of each kind, and how many times `add` had each outcome."""
+        return {
+            "previous_projects": len(self._previous),
+            "excluded_projects": len(self._excluded),
+            "new_projects": len(self._new),
+            **{f"{outcome}_added": count for outcome, count in self._outcomes.items()},
+        }
@@ -0,0 +1,177 @@
+import math
+import random
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable
+
+from custom_dataclasses import FilmProject
+from state_store import StateStore
+from tmdb_api_calls import DAY, today
+
+# Kinds of scheduled items
+PERSON = "person"
+PROJECT = "project"
+
+# How often a person is scanned for new projects when nothing else is known about them
+PERSON_REFRESH_INTERVAL = 7 * DAY
+
+# How often an upcoming project is checked, by the most days until its release date
+RELEASE_REFRESH_INTERVALS = [(14, 1 * DAY), (60, 3 * DAY), (180, 7 * DAY)]
+DISTANT_RELEASE_REFRESH_INTERVAL = 14 * DAY
+
+# Bounds of the refresh intervals of each kind, in seconds
+REFRESH_INTERVAL_BOUNDS = {
+    PERSON: (1 * DAY, 28 * DAY),
+    PROJECT: (0.5 * DAY, 28 * DAY),
+}
+
+# Weight of the latest refresh in the moving average of how often a refresh finds changes
+CHANGE_RATE_WEIGHT = 0.3
+INITIAL_CHANGE_RATE = 0.5
+
+# Refresh times are moved by up to this fraction of the interval, so items added together drift apart
+INTERVAL_JITTER = 0.1
+
+
+def popularity_factor(popularity: "float | None") -> float:
+    """How many times more often to refresh an item with `popularity`, from 1 for unknown items to about 3 for the most popular."""
+    return 1 + math.log10(1 + max(popularity or 0.0, 0.0))
+
+
+def change_factor(change_rate: float) -> float:
+    """Multiplier of the interval, from 2 for items that never change to 1/2 for items that changed at every refresh."""
+    return 2 ** (1 - 2 * change_rate)
+
+
+def clamp_interval(kind: str, interval: float) -> float:
+    shortest, longest = REFRESH_INTERVAL_BOUNDS[kind]
+    return min(longest, max(shortest, interval))
+
+
+def project_refresh_interval(project: FilmProject, change_rate: float) -> float:
+    """Seconds until an upcoming project is checked again for changes and a release.
+
+    Projects are checked more often the closer their release date is, the more popular they are and
+    the more often they changed at recent checks.
+    """
+    interval = DISTANT_RELEASE_REFRESH_INTERVAL
+    if project.release_date:
+        days_until_release = (datetime.strptime(project.release_date, "%Y-%m-%d").date() - today()).days
+        for days, release_interval in RELEASE_REFRESH_INTERVALS:
+            if days_until_release <= days:
+                interval = release_interval
+                break
+
+    return clamp_interval(PROJECT, interval / popularity_factor(project.popularity) * change_factor(change_rate))
+
+
+def person_refresh_interval(projects: "list[FilmProject]", change_rate: float) -> float:
+    """Seconds until a person is scanned again for new projects.
+
+    Persons are scanned more often when their upcoming `projects` are popular, and when recent scans
+    found new projects.
+    """
+    popularity = max((project.popularity or 0.0 for project in projects), default=0.0)
+    return clamp_interval(PERSON, PERSON_REFRESH_INTERVAL / popularity_factor(popularity) * change_factor(change_rate))
+
+
+class RefreshScheduler():
+    """Schedules when each person and upcoming project is refreshed by the daemon mode, stored in the `StateStore`.
+
+    Every item has its own refresh interval, computed by `person_refresh_interval` or
+    `project_refresh_interval` from what is known about it and from a moving average of how often its
+    refreshes found changes. New items are due at once. `due` returns the most overdue items first,
+    so items that didn't fit in one cycle are refreshed in the next.
+    """
+
+    def __init__(self, store: StateStore) -> None:
+        self._store = store
+
+        with store.transaction() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS refresh_schedule (
+                    kind TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    next_refresh REAL NOT NULL,
+                    change_rate REAL NOT NULL,
+                    last_refresh REAL,
+                    PRIMARY KEY (kind, item_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS refresh_schedule_next_refresh ON refresh_schedule (kind, next_refresh);
+                """
+            )
+
+    def sync(self, kind: str, item_ids: "list[str]"):
+        """Add the items that aren't scheduled yet, due at once, and drop the items that are gone."""
+        now = time.time()
+        with self._store.transaction() as connection:
+            scheduled = {row[0] for row in connection.execute("SELECT item_id FROM refresh_schedule WHERE kind = ?", (kind,))}
+            current = set(item_ids)
+            connection.executemany(
+                "INSERT INTO refresh_schedule (kind, item_id, next_refresh, change_rate) VALUES (?, ?, ?, ?)",
+                [(kind, item_id, now, INITIAL_CHANGE_RATE) for item_id in current - scheduled]
+            )
+            connection.executemany("DELETE FROM refresh_schedule WHERE kind = ? AND item_id = ?", [(kind, item_id) for item_id in scheduled - current])
+
+    def due(self, kind: str, limit: int) -> "list[str]":
+        """Return the ids of up to `limit` items that are due, the most overdue first."""
+        with self._store.transaction() as connection:
+            rows = connection.execute(
+                "SELECT item_id FROM refresh_schedule WHERE kind = ? AND next_refresh <= ? ORDER BY next_refresh LIMIT ?",
+                (kind, time.time(), limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _change_rate(self, connection: sqlite3.Connection, kind: str, item_id: str) -> float:
+        row = connection.execute("SELECT change_rate FROM refresh_schedule WHERE kind = ? AND item_id = ?", (kind, item_id)).fetchone()
+        return row[0] if row else INITIAL_CHANGE_RATE
+
+    def record(self, kind: str, item_id: str, changed: bool, interval: "Callable[[float], float]"):
+        """Save a refresh of an item that did or didn't find changes, and schedule the next one.
+
+        `interval` returns the seconds until the next refresh from the updated change rate of the item,
+        the moving average of how often its refreshes found changes.
+        """
+        now = time.time()
+        with self._store.transaction() as connection:
+            change_rate = (1 - CHANGE_RATE_WEIGHT) * self._change_rate(connection, kind, item_id) + CHANGE_RATE_WEIGHT * changed
+            next_refresh = now + interval(change_rate) * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER)
+            connection.execute(
+                "UPDATE refresh_schedule SET next_refresh = ?, change_rate = ?, last_refresh = ? WHERE kind = ? AND item_id = ?",
+                (next_refresh, change_rate, now, kind, item_id)
+            )
+
+    def schedule(self, kind: str, item_id: str, interval: float):
+        """Schedule the first refresh of an item `interval` seconds from now, e.g. for a project that was just created from fresh TMDb data."""
+        now = time.time()
+        with self._store.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO refresh_schedule VALUES (?, ?, ?, ?, ?)",
+                (kind, item_id, now + interval * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER), INITIAL_CHANGE_RATE, now)
+            )
+
+    def postpone(self, kind: str, item_id: str, seconds: float):
+        """Try an item again after `seconds`, without counting it as refreshed, e.g. when its request failed."""
+        with self._store.transaction() as connection:
+            connection.execute("UPDATE refresh_schedule SET next_refresh = ? WHERE kind = ? AND item_id = ?", (time.time() + seconds, kind, item_id))
+
+    def remove(self, kind: str, item_id: str):
+        with self._store.transaction() as connection:
+            connection.execute("DELETE FROM refresh_schedule WHERE kind = ? AND item_id = ?", (kind, item_id))
+
+    def stats(self) -> "dict[str, float]":
+        """Number of scheduled and due items of each kind, and their average refresh interval in days."""
+        now = time.time()
+        with self._store.transaction() as connection:
+            rows = connection.execute(
+                "SELECT kind, COUNT(*), SUM(next_refresh <= ?), AVG(next_refresh - last_refresh) FROM refresh_schedule GROUP BY kind",
+                (now,)
+            ).fetchall()
+        stats = {}
+        for kind, count, due, average_interval in rows:
+            stats[f"{kind}s_scheduled"] = count
+            stats[f"{kind}s_due"] = due
+            stats[f"{kind}_average_interval_days"] = (average_interval or 0.0) / DAY
+        return stats
@@ -1,25 +1,225 @@
-import requests
+import threading
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+from custom_logger import CustomLogger
+from resilience import CircuitBreaker, RetryPolicy
+from response_cache import ResponseCache
+from run_metrics import RunMetrics, get_endpoint
+
+
+def parse_retry_after(value: "str | None") -> "float | None":
+    """Convert a `Retry-After` header, given either as seconds or as an HTTP date, to seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Token bucket allowing on average `rate` requests per second, with bursts of up to `burst` requests.
+
+    Every request reserves a token, and the bucket is allowed to go into debt so that callers waiting
+    for a token are served in the order they arrived. Reservations are protected by a lock, so the
+    same bucket can be shared between threads.
+
+    A 429 response halves the rate (down to `min_rate`), and every successful response after that
+    gives back a little of the rate until `max_rate` is reached again.
+    """
+
+    def __init__(self, rate: float, burst: "int | None" = None, min_rate: "float | None" = None) -> None:
+        self.max_rate: float = rate
+        self.min_rate: float = min_rate if min_rate is not None else rate / 10
+        self.rate: float = rate
+        self.capacity: float = burst if burst is not None else max(1, int(rate))
+        self._tokens: float = self.capacity
+        self._last_refill: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, current_time: float):
+        self._tokens = min(self.capacity, self._tokens + (current_time - self._last_refill) * self.rate)
+        self._last_refill = current_time
+
+    def reserve(self) -> float:
+        """Reserve a token and return how many seconds to wait before it may be used."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> float:
+        """Block the current thread until a token is available. Returns the number of seconds waited."""
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+    def pause(self, seconds: float):
+        """Hold back all future reservations for at least `seconds` seconds."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+    def on_throttled(self, retry_after: "float | None" = None):
+        """Slow down after the server answered 429 Too Many Requests."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.pause(retry_after if retry_after is not None else 1 / self.rate)
+
+    def on_success(self):
+        """Slowly recover the rate after being throttled."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class HostRateLimiter:
+    """Keeps a separate `TokenBucket` for every host, so each API has its own budget.
+
+    With `metrics`, the time spent waiting for each host is recorded.
+    """
+
+    def __init__(self, rate: float, burst: "int | None" = None, metrics: "RunMetrics | None" = None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.metrics = metrics
+        self._buckets: "dict[str, TokenBucket]" = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        """Return the bucket for the host of `url`."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(rate=self.rate, burst=self.burst)
+            return self._buckets[host]
+
+    def acquire(self, url: str):
+        self._record_wait(url, self.bucket(url).acquire())
+
+    def _record_wait(self, url: str, wait_time: float):
+        if self.metrics is not None and wait_time > 0:
+            self.metrics.record_limiter_sleep(urlparse(url).netloc, wait_time)
+
+    def update(self, url: str, response: requests.Response):
+        """Adapt the budget of the host to the response."""
+        bucket = self.bucket(url)
+        if response.status_code == 429:
+            bucket.on_throttled(retry_after=parse_retry_after(response.headers.get("Retry-After")))
+        elif response.status_code < 400:
+            bucket.on_success()
+
 
 class RateLimitedSession(requests.Session):
-    """Use a requests session, but ensure no more than `max_requests` number of requests are sent every second."""
-    def __init__(self, max_requests:int=30, *args, **kwargs):
+    """Use a requests session, but ensure no more than `max_requests` number of requests are sent every second.
+
+    Optionally answers GET requests from a `cache`, retries and cuts off failing endpoints, see
+    `RetryPolicy` and `CircuitBreaker`, and records every request in `metrics`.
+    """
+    def __init__(self, max_requests: int = 30, burst: "int | None" = None, limiter: "HostRateLimiter | None" = None, cache: "ResponseCache | None" = None, metrics: "RunMetrics | None" = None, retry: "RetryPolicy | None" = None, breaker: "CircuitBreaker | None" = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_requests: int = max_requests
-        self.interval: float = 1 / max_requests
-        self.last_request_time: float = time.monotonic()
+        self.limiter: HostRateLimiter = limiter if limiter is not None else HostRateLimiter(rate=max_requests, burst=burst, metrics=metrics)
+        self.cache: "ResponseCache | None" = cache
+        self.metrics: "RunMetrics | None" = metrics
+        self.retry: RetryPolicy = retry if retry is not None else RetryPolicy()
+        self.breaker: CircuitBreaker = breaker if breaker is not None else CircuitBreaker()
 
-    def send(self, *args, **kwargs):
-        # Calculate the time since the last request
-        current_time: float = time.monotonic()
-        elapsed_time: float = current_time - self.last_request_time
+    def close(self):
+        super().close()
+        if self.cache is not None:
+            self.cache.close()
 
-        # If the elapsed time is less than the interval, pause execution
-        if elapsed_time < self.interval:
-            time.sleep(self.interval - elapsed_time)
+    def send(self, request: requests.PreparedRequest, **kwargs):
+        ttl = self.cache.ttl(request.url) if self.cache is not None and request.method == "GET" else None
+        if ttl is None:
+            return self._send(request, **kwargs)
 
-        # Make the request and update the last request time
-        response: requests.Response = super().send(*args, **kwargs)
-        self.last_request_time = time.monotonic()
+        cached = self.cache.lookup(request.url)
+        if cached is not None:
+            entry, is_fresh = cached
+            if is_fresh:
+                if self.metrics is not None:
+                    self.metrics.record_cache_hit(request.method, request.url)
+                return self.cache.build_response(entry, request)
+            if entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._send(request, **kwargs)
+
+        if response.status_code == 304 and cached is not None:
+            self.cache.refresh(request.url, ttl)
+            return self.cache.build_response(cached[0], request)
+        if response.status_code == 200:
+            self.cache.store(request.url, response, ttl)
 
         return response
+
+    def _send(self, request: requests.PreparedRequest, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining_open_time = self.breaker.remaining_open_time(request.method, request.url)
+            if remaining_open_time is not None:
+                if self.metrics is not None:
+                    self.metrics.record_event(request.method, request.url, "circuit_rejected")
+                return self.breaker.build_response(request, remaining_open_time)
+
+            self.limiter.acquire(request.url)
+
+            start = time.perf_counter()
+            try:
+                response: "requests.Response | None" = super().send(request, **kwargs)
+            except requests.RequestException as error:
+                if self.metrics is not None:
+                    self.metrics.record_request(request.method, request.url, type(error).__name__, time.perf_counter() - start)
+                self._record_outcome(request, None)
+                if not self.retry.should_retry(request, attempt):
+                    raise
+                self._wait_before_retry(request, attempt, None)
+                continue
+
+            if self.metrics is not None:
+                self.metrics.record_request(request.method, request.url, response.status_code, time.perf_counter() - start)
+            self.limiter.update(request.url, response)
+            self._record_outcome(request, response)
+
+            if not self.retry.should_retry(request, attempt, response):
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            self._wait_before_retry(request, attempt, retry_after)
+
+    def _record_outcome(self, request: requests.PreparedRequest, response: "requests.Response | None"):
+        """Update the circuit breaker with the response, or the lack of one."""
+        if response is not None and response.status_code == 429:
+            self.breaker.release_trial(request.method, request.url)
+            return
+        if not self.breaker.is_failure(response):
+            self.breaker.record_success(request.method, request.url)
+        elif self.breaker.record_failure(request.method, request.url):
+            CustomLogger.warning(f"Stopped sending {' '.join(get_endpoint(request.method, request.url))} requests for {self.breaker.reset_timeout} seconds after repeated failures")
+            if self.metrics is not None:
+                self.metrics.record_event(request.method, request.url, "circuit_opened")
+
+    def _wait_before_retry(self, request: requests.PreparedRequest, attempt: int, retry_after: "float | None"):
+        delay = self.retry.delay(attempt, retry_after)
+        CustomLogger.debug(f"Retrying {request.method} {request.url} in {delay:.2f} seconds after {attempt} attempts")
+        if self.metrics is not None:
+            self.metrics.record_event(request.method, request.url, "retried", seconds=delay)
+        time.sleep(delay)
@@ -0,0 +1,148 @@
+import json
+import random
+import re
+import threading
+import time
+
+import requests
+
+from run_metrics import get_endpoint
+
+# Status codes of responses that may succeed when the request is sent again
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Methods that can be sent again without changing the result, even if the first request reached the server
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with jitter for the retry after `attempt` failed attempts.
+
+    The delay is drawn between half and all of `base * 2 ** (attempt - 1)`, capped at `cap`, so clients
+    that failed at the same moment don't all retry at the same moment.
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class RetryPolicy():
+    """Decides which failed requests `RateLimitedSession` sends again, and how long it waits in between.
+
+    A request is retried up to `max_retries` times with `backoff_delay`, or longer when the response has a
+    `Retry-After` header. A 429 response is always retried, since the server didn't handle the request.
+    Responses with other status codes in `RETRY_STATUS_CODES` and connection errors are only retried for
+    idempotent requests: those with a method in `IDEMPOTENT_METHODS`, or a POST to a url matching
+    `idempotent_post_pattern`, like a Notion database query.
+    """
+
+    def __init__(self, max_retries: int = 3, backoff: float = 0.5, max_backoff: float = 30.0, idempotent_post_pattern: "str | None" = None) -> None:
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._idempotent_post_pattern = re.compile(idempotent_post_pattern) if idempotent_post_pattern else None
+
+    def is_idempotent(self, request: requests.PreparedRequest) -> bool:
+        if request.method in IDEMPOTENT_METHODS:
+            return True
+        return request.method == "POST" and self._idempotent_post_pattern is not None and bool(self._idempotent_post_pattern.search(request.url))
+
+    def should_retry(self, request: requests.PreparedRequest, attempt: int, response: "requests.Response | None" = None) -> bool:
+        """Whether to send `request` again after `attempt` attempts ended in `response`, or in an exception without one."""
+        if attempt > self.max_retries:
+            return False
+        if response is None:
+            return self.is_idempotent(request)
+        if response.status_code == 429:
+            return True
+        return response.status_code in RETRY_STATUS_CODES and self.is_idempotent(request)
+
+    def delay(self, attempt: int, retry_after: "float | None" = None) -> float:
+        """Seconds to wait before the next attempt, at least as long as the `Retry-After` of the server."""
+        delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+
+class CircuitBreaker():
+    """Stops sending requests to an endpoint that keeps failing, so a degraded API doesn't hold up the whole run.
+
+    Endpoints are grouped like in the run metrics, see `get_endpoint`. After `failure_threshold`
+    consecutive server errors or connection errors, the circuit of the endpoint opens and its requests are
+    answered at once with a 503 response, without being sent. After `reset_timeout` seconds one trial
+    request is let through: if it succeeds the circuit closes again, otherwise it stays open for another
+    `reset_timeout` seconds. Throttling is left to the rate limiter and doesn't count as a failure.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures: "dict[tuple[str, str], int]" = {}
+        self._opened_at: "dict[tuple[str, str], float]" = {}
+        self._trials: "set[tuple[str, str]]" = set()
+        self._lock = threading.Lock()
+
+    def remaining_open_time(self, method: str, url: str) -> "float | None":
+        """Return the seconds until the circuit of the endpoint closes, or None if a request may be sent.
+
+        When the reset timeout has passed, the first caller gets None and sends the trial request.
+        """
+        key = get_endpoint(method, url)
+        with self._lock:
+            opened_at = self._opened_at.get(key)
+            if opened_at is None:
+                return None
+            remaining = opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and key not in self._trials:
+                self._trials.add(key)
+                return None
+            return max(remaining, 0.0) or self.reset_timeout
+
+    def record_success(self, method: str, url: str):
+        key = get_endpoint(method, url)
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+            self._trials.discard(key)
+
+    def release_trial(self, method: str, url: str):
+        """Let another request be the trial, after the trial request of the endpoint was throttled."""
+        key = get_endpoint(method, url)
+        with self._lock:
+            self._trials.discard(key)
+
+    def record_failure(self, method: str, url: str) -> bool:
+        """Count a failed request. Returns True if this opened the circuit."""
+        key = get_endpoint(method, url)
+        with self._lock:
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if key in self._trials or (key not in self._opened_at and self._failures[key] >= self.failure_threshold):
+                self._trials.discard(key)
+                self._opened_at[key] = time.monotonic()
+                return True
+            return False
+
+    def is_failure(self, response: "requests.Response | None") -> bool:
+        """Whether a response, or an exception without one, counts towards opening the circuit."""
+        return response is None or response.status_code >= 500
+
+    @staticmethod
+    def build_response(request: requests.PreparedRequest, retry_after: float) -> requests.Response:
+        """Build the 503 response returned instead of sending a request while the circuit is open."""
+        message = f"The circuit of {' '.join(get_endpoint(request.method, request.url))} is open after repeated failures"
+        response = build_error_response(request.url, message, retry_after=retry_after)
+        response.request = request
+        return response
+
+
+def build_error_response(url: str, message: str, retry_after: "float | None" = None) -> requests.Response:
+    """Build a 503 response for a request that got no response, which callers handle like any failed request."""
+    response = requests.Response()
+    response.status_code = 503
+    response.reason = "Service Unavailable"
+    response.url = url
+    response.headers["Content-Type"] = "application/json"
+    if retry_after is not None:
+        response.headers["Retry-After"] = f"{retry_after:.1f}"
+    # TMDb puts the error in `status_message` and Notion in `message`
+    response._content = json.dumps({"status_message": message, "message": message}).encode()
+    response.encoding = "utf-8"
+    return response
@@ -0,0 +1,123 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Headers describing the raw body, which no longer apply once requests has decoded the content
+DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class ResponseCache:
+    """Persistent cache for GET responses, stored in an SQLite database at `filename`.
+
+    `ttls` is a list of `(pattern, seconds)` pairs, where the first regex pattern found in the url
+    decides how long a response stays fresh. Responses for urls not matching any pattern are not cached.
+    Stale responses with an ETag or Last-Modified header are revalidated with a conditional request.
+    When there are more than `max_entries` responses, the least recently used ones are removed.
+    """
+
+    def __init__(self, filename: str, ttls: "list[tuple[str, float]]", max_entries: int = 100_000) -> None:
+        self.filename = filename
+        self.max_entries = max_entries
+        self._ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self._stores_since_eviction = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                status_code INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                content BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._connection.commit()
+            self._connection.close()
+
+    def ttl(self, url: str) -> "float | None":
+        """Return how many seconds a response from `url` stays fresh, or None if it shouldn't be cached."""
+        for pattern, ttl in self._ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def lookup(self, url: str) -> "tuple[sqlite3.Row, bool] | None":
+        """Return the cached entry for `url` and whether it is still fresh."""
+        with self._lock:
+            entry = self._connection.execute("SELECT * FROM responses WHERE url = ?", (url,)).fetchone()
+            if entry is None:
+                return None
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE url = ?", (time.time(), url))
+        return entry, entry["expires"] > time.time()
+
+    def store(self, url: str, response: requests.Response, ttl: float):
+        """Save a successful response."""
+        headers = {key: value for key, value in response.headers.items() if key.lower() not in DROPPED_HEADERS}
+        current_time = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.status_code,
+                    json.dumps(headers),
+                    response.content,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    current_time + ttl,
+                    current_time,
+                )
+            )
+            self._stores_since_eviction += 1
+            if self._stores_since_eviction >= 1000:
+                self._evict()
+            self._connection.commit()
+
+    def refresh(self, url: str, ttl: float):
+        """Mark a cached response as fresh again after the server confirmed it hasn't changed."""
+        with self._lock:
+            self._connection.execute("UPDATE responses SET expires = ? WHERE url = ?", (time.time() + ttl, url))
+            self._connection.commit()
+
+    def _evict(self):
+        """Remove the least recently used responses above `max_entries`. The lock must be held."""
+        self._connection.execute(
+            "DELETE FROM responses WHERE url IN (SELECT url FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self._stores_since_eviction = 0
+
+    @staticmethod
+    def build_response(entry: sqlite3.Row, request: requests.PreparedRequest) -> requests.Response:
+        """Recreate a `requests.Response` from a cached entry."""
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers = CaseInsensitiveDict(json.loads(entry["headers"]))
+        response._content = entry["content"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        return response
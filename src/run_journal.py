@@ -0,0 +1,136 @@
+import json
+from datetime import datetime
+
+from custom_dataclasses import JSON_ENCODER, FilmProject, Person
+from custom_logger import CustomLogger
+from state_store import StateStore
+
+
+class RunJournal():
+    """Write-ahead journal of a run, stored in the `StateStore`, so an interrupted run can be finished by the next run.
+
+    Every person scan is checkpointed with the projects that were found, so the next run only scans
+    the persons that weren't finished. Every Notion mutation is recorded before it is sent and marked
+    done or failed afterwards, so the next run knows which writes landed and which ones may have.
+
+    A run is unfinished until `finish` is called. `start` resumes the unfinished run if there is one.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, store: StateStore) -> None:
+        self._store = store
+        self.run_id: "int | None" = None
+        self.resumed = False
+
+        with store.transaction() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY,
+                    started_at TEXT NOT NULL,
+                    finished_at TEXT
+                );
+
+                CREATE TABLE IF NOT EXISTS scanned_persons (
+                    run_id INTEGER NOT NULL,
+                    person_page_id TEXT NOT NULL,
+                    projects TEXT NOT NULL,
+                    PRIMARY KEY (run_id, person_page_id)
+                ) WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS mutations (
+                    run_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    page_id TEXT,
+                    PRIMARY KEY (run_id, kind, key)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS mutations_status ON mutations (run_id, status);
+                """
+            )
+
+    def start(self) -> bool:
+        """Start a new run, or resume the last run if it didn't finish. Returns True when a run is resumed."""
+        with self._store.transaction() as connection:
+            row = connection.execute("SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1").fetchone()
+            if row:
+                self.run_id = row[0]
+                self.resumed = True
+            else:
+                self.run_id = connection.execute("INSERT INTO runs (started_at) VALUES (?)", (datetime.now().isoformat(),)).lastrowid
+                self.resumed = False
+
+        if self.resumed:
+            CustomLogger.info(f"Resuming run {self.run_id} with {len(self.scanned_persons())} persons already scanned")
+        return self.resumed
+
+    def finish(self):
+        """Mark the run as finished and drop its checkpoints and mutations."""
+        with self._store.transaction() as connection:
+            connection.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (datetime.now().isoformat(), self.run_id))
+            connection.execute("DELETE FROM scanned_persons WHERE run_id = ?", (self.run_id,))
+            connection.execute("DELETE FROM mutations WHERE run_id = ?", (self.run_id,))
+
+    ##### PERSON SCANS #####
+
+    def checkpoint_person(self, person: Person, projects: "list[FilmProject]"):
+        """Record that a person has been scanned, together with the projects that were found."""
+        with self._store.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO scanned_persons VALUES (?, ?, ?)",
+                (self.run_id, person.notion_page_id, JSON_ENCODER.encode([project.to_dict() for project in projects]))
+            )
+
+    def scanned_persons(self) -> "dict[str, list[FilmProject]]":
+        """Return the projects found for each person scanned in this run by person page id."""
+        with self._store.transaction() as connection:
+            rows = connection.execute("SELECT person_page_id, projects FROM scanned_persons WHERE run_id = ?", (self.run_id,)).fetchall()
+        return {page_id: [FilmProject.from_dict(data) for data in json.loads(projects)] for page_id, projects in rows}
+
+    ##### NOTION MUTATIONS #####
+
+    def begin(self, kind: str, key: str, method: str, url: str, payload: dict):
+        """Record a mutation that is about to be sent. `kind` and `key` identify the mutation within the run."""
+        with self._store.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO mutations VALUES (?, ?, ?, ?, ?, ?, ?, NULL)",
+                (self.run_id, kind, key, method, url, JSON_ENCODER.encode(payload), self.PENDING)
+            )
+
+    def complete(self, kind: str, key: str, page_id: "str | None" = None):
+        """Mark a mutation as done, with the id of the page it created or changed."""
+        self._set_status(kind, key, self.DONE, page_id)
+
+    def fail(self, kind: str, key: str):
+        self._set_status(kind, key, self.FAILED)
+
+    def _set_status(self, kind: str, key: str, status: str, page_id: "str | None" = None):
+        with self._store.transaction() as connection:
+            connection.execute(
+                "UPDATE mutations SET status = ?, page_id = ? WHERE run_id = ? AND kind = ? AND key = ?",
+                (status, page_id, self.run_id, kind, key)
+            )
+
+    def status(self, kind: str, key: str) -> "tuple[str, str | None] | None":
+        """Return the status and page id of a mutation in this run, or None if it hasn't been recorded."""
+        with self._store.transaction() as connection:
+            return connection.execute(
+                "SELECT status, page_id FROM mutations WHERE run_id = ? AND kind = ? AND key = ?",
+                (self.run_id, kind, key)
+            ).fetchone()
+
+    def pending_mutations(self) -> "list[tuple[str, str, str, str, dict]]":
+        """Return `(kind, key, method, url, payload)` of the mutations that were sent without knowing if they landed."""
+        with self._store.transaction() as connection:
+            rows = connection.execute(
+                "SELECT kind, key, method, url, payload FROM mutations WHERE run_id = ? AND status = ?",
+                (self.run_id, self.PENDING)
+            ).fetchall()
+        return [(kind, key, method, url, json.loads(payload)) for kind, key, method, url, payload in rows]
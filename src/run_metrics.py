@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Iterator
+from urllib.parse import urlparse
+
+from run_profiler import RunProfiler
+
+RUN_REPORT_FILE = "data/run_report.json"
+PROMETHEUS_TEXTFILE = "data/scraper.prom"
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Numeric TMDb ids and Notion page and database ids in a path are replaced by {id}, so requests are grouped by endpoint.
+# The first segment is the API version, like /3 or /v1, and is kept.
+ID_PATTERN = re.compile(r"(?<=.)/(\d+|[0-9a-fA-F]{32}|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(?=/|$)")
+
+
+def get_endpoint(method: str, url: str) -> "tuple[str, str]":
+    """Return the host and the endpoint, like `GET /3/person/{id}/movie_credits`, of a request."""
+    parsed_url = urlparse(url)
+    return parsed_url.netloc, f"{method} {ID_PATTERN.sub('/{id}', parsed_url.path)}"
+
+
+def percentile(sorted_values: "list[float]", fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class RunMetrics():
+    """Collects the request, rate limiter and phase metrics of a run, written with `write_report` and `write_prometheus`.
+
+    With a `profiler`, every phase is also profiled, see `RunProfiler`.
+    """
+
+    def __init__(self, profiler: "RunProfiler | None" = None) -> None:
+        self.profiler = profiler
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._latencies: "dict[tuple[str, str], list[float]]" = {}
+        self._statuses: "dict[tuple[str, str, str], int]" = {}
+        self._cache_hits: "dict[tuple[str, str], int]" = {}
+        self._limiter_sleep: "dict[str, float]" = {}
+        self._events: "dict[tuple[str, str, str], int]" = {}
+        self._retry_sleep: "dict[str, float]" = {}
+        self._phases: "dict[str, float]" = {}
+        self._counters: "dict[str, dict[str, float]]" = {}
+
+    def reset(self):
+        """Forget everything recorded so far and restart the clock, so each cycle of the daemon mode reports only itself."""
+        with self._lock:
+            self.started_at = datetime.now()
+            self._start = time.perf_counter()
+            for values in (self._latencies, self._statuses, self._cache_hits, self._limiter_sleep, self._events, self._retry_sleep, self._phases, self._counters):
+                values.clear()
+
+    def record_request(self, method: str, url: str, status: "int | str", latency: float):
+        """Record a sent request. `status` is the status code, or the name of the exception if there was no response."""
+        host, endpoint = get_endpoint(method, url)
+        with self._lock:
+            self._latencies.setdefault((host, endpoint), []).append(latency)
+            key = (host, endpoint, str(status))
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def record_cache_hit(self, method: str, url: str):
+        """Record a request that was answered from the response cache without being sent."""
+        key = get_endpoint(method, url)
+        with self._lock:
+            self._cache_hits[key] = self._cache_hits.get(key, 0) + 1
+
+    def record_limiter_sleep(self, host: str, seconds: float):
+        """Record time spent waiting for the rate limit of `host`."""
+        with self._lock:
+            self._limiter_sleep[host] = self._limiter_sleep.get(host, 0.0) + seconds
+
+    def record_event(self, method: str, url: str, event: str, seconds: float = 0.0):
+        """Record a retry or circuit breaker `event` of a request, and the `seconds` waited because of it."""
+        host, endpoint = get_endpoint(method, url)
+        with self._lock:
+            key = (host, endpoint, event)
+            self._events[key] = self._events.get(key, 0) + 1
+            if seconds:
+                self._retry_sleep[host] = self._retry_sleep.get(host, 0.0) + seconds
+
+    def set_counters(self, name: str, values: "dict[str, float]"):
+        """Save a group of counters, like the Notion write stats, to include in the report."""
+        with self._lock:
+            self._counters[name] = dict(values)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the statements inside the `with` block as the phase `name`. A phase entered twice adds up."""
+        profiling = self.profiler.phase(name, waiting=self.waiting_seconds) if self.profiler is not None else nullcontext()
+        start = time.perf_counter()
+        try:
+            with profiling:
+                yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + duration
+
+    def waiting_seconds(self) -> "dict[str, float]":
+        """Total seconds spent on requests and waiting for the rate limits and retries so far, summed over all threads."""
+        with self._lock:
+            return {
+                "request_seconds": sum(sum(latencies) for latencies in self._latencies.values()),
+                "limiter_sleep_seconds": sum(self._limiter_sleep.values()),
+                "retry_sleep_seconds": sum(self._retry_sleep.values()),
+            }
+
+    @property
+    def phases(self) -> "dict[str, float]":
+        """Duration in seconds of each phase so far."""
+        with self._lock:
+            return dict(self._phases)
+
+    @property
+    def duration(self) -> float:
+        return time.perf_counter() - self._start
+
+    def report(self) -> dict:
+        """Return all metrics as a dictionary that can be written as json."""
+        with self._lock:
+            endpoints = []
+            for (host, endpoint), latencies in sorted(self._latencies.items()):
+                latencies = sorted(latencies)
+                endpoints.append({
+                    "host": host,
+                    "endpoint": endpoint,
+                    "requests": len(latencies),
+                    "cache_hits": self._cache_hits.get((host, endpoint), 0),
+                    "statuses": {status: count for (h, e, status), count in sorted(self._statuses.items()) if (h, e) == (host, endpoint)},
+                    "events": {event: count for (h, e, event), count in sorted(self._events.items()) if (h, e) == (host, endpoint)},
+                    "latency_seconds": {
+                        "total": sum(latencies),
+                        "mean": sum(latencies) / len(latencies),
+                        "p50": percentile(latencies, 0.5),
+                        "p95": percentile(latencies, 0.95),
+                        "max": latencies[-1],
+                    },
+                })
+            for (host, endpoint), hits in sorted(self._cache_hits.items()):
+                if (host, endpoint) not in self._latencies:
+                    endpoints.append({"host": host, "endpoint": endpoint, "requests": 0, "cache_hits": hits, "statuses": {}})
+
+            hosts = sorted({host for host, _ in self._latencies} | {host for host, _ in self._cache_hits} | set(self._limiter_sleep) | set(self._retry_sleep))
+            return {
+                "started_at": self.started_at.isoformat(),
+                "duration_seconds": self.duration,
+                "phases_seconds": dict(self._phases),
+                "hosts": {
+                    host: {
+                        "requests": sum(len(latencies) for (h, _), latencies in self._latencies.items() if h == host),
+                        "cache_hits": sum(hits for (h, _), hits in self._cache_hits.items() if h == host),
+                        "limiter_sleep_seconds": self._limiter_sleep.get(host, 0.0),
+                        "retry_sleep_seconds": self._retry_sleep.get(host, 0.0),
+                    }
+                    for host in hosts
+                },
+                "endpoints": endpoints,
+                "counters": {name: dict(values) for name, values in self._counters.items()},
+            }
+
+    def write_report(self, filename: str = RUN_REPORT_FILE, **extra):
+        """Write the json run report, with `extra` items like the outcome of the run added to it."""
+        write_atomically(filename, json.dumps({**self.report(), **extra}, indent=2))
+
+    def write_prometheus(self, filename: str = PROMETHEUS_TEXTFILE, success: bool = True):
+        """Write the metrics in the Prometheus text format."""
+        lines = []
+
+        def add(name: str, kind: str, description: str, samples: "list[tuple[dict[str, str], float]]"):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(format_sample(name, labels, value) for labels, value in samples)
+
+        with self._lock:
+            add("scraper_requests_total", "counter", "HTTP requests sent by status code.", [
+                ({"host": host, "endpoint": endpoint, "status": status}, count)
+                for (host, endpoint, status), count in sorted(self._statuses.items())
+            ])
+
+            lines.append("# HELP scraper_request_duration_seconds HTTP request latency.")
+            lines.append("# TYPE scraper_request_duration_seconds histogram")
+            for (host, endpoint), latencies in sorted(self._latencies.items()):
+                labels = {"host": host, "endpoint": endpoint}
+                for bucket in LATENCY_BUCKETS:
+                    lines.append(format_sample("scraper_request_duration_seconds_bucket", {**labels, "le": str(bucket)}, sum(1 for latency in latencies if latency <= bucket)))
+                lines.append(format_sample("scraper_request_duration_seconds_bucket", {**labels, "le": "+Inf"}, len(latencies)))
+                lines.append(format_sample("scraper_request_duration_seconds_sum", labels, sum(latencies)))
+                lines.append(format_sample("scraper_request_duration_seconds_count", labels, len(latencies)))
+
+            add("scraper_cache_hits_total", "counter", "GET requests answered from the response cache.", [
+                ({"host": host, "endpoint": endpoint}, hits) for (host, endpoint), hits in sorted(self._cache_hits.items())
+            ])
+            add("scraper_rate_limiter_sleep_seconds_total", "counter", "Time requests waited for the rate limit.", [
+                ({"host": host}, seconds) for host, seconds in sorted(self._limiter_sleep.items())
+            ])
+            add("scraper_request_events_total", "counter", "Retried requests, and requests rejected or circuits opened by the circuit breaker.", [
+                ({"host": host, "endpoint": endpoint, "event": event}, count)
+                for (host, endpoint, event), count in sorted(self._events.items())
+            ])
+            add("scraper_retry_sleep_seconds_total", "counter", "Time waited before retrying failed requests.", [
+                ({"host": host}, seconds) for host, seconds in sorted(self._retry_sleep.items())
+            ])
+            add("scraper_phase_duration_seconds", "gauge", "Duration of each phase of the last run.", [
+                ({"phase": phase}, seconds) for phase, seconds in self._phases.items()
+            ])
+            add("scraper_counter", "gauge", "Counters of the last run, like the Notion write stats.", [
+                ({"group": group, "name": name}, value) for group, values in sorted(self._counters.items()) for name, value in sorted(values.items())
+            ])
+
+        add("scraper_run_duration_seconds", "gauge", "Duration of the last run.", [({}, self.duration)])
+        add("scraper_run_timestamp_seconds", "gauge", "Time the last run started.", [({}, self.started_at.timestamp())])
+        add("scraper_run_success", "gauge", "Whether the last run finished without errors.", [({}, int(success))])
+
+        write_atomically(filename, "\n".join(lines) + "\n")
+
+
+def format_sample(name: str, labels: "dict[str, str]", value: float) -> str:
+    """Format a sample in the Prometheus text format, escaping the label values."""
+    if not labels:
+        return f"{name} {value}"
+    label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+    return f"{name}{{{label_text}}} {value}"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_atomically(filename: str, text: str):
+    """Write `text` to a temporary file first, so a collector never reads a half written file."""
+    temporary_filename = f"{filename}.tmp"
+    with open(temporary_filename, "w") as f:
+        f.write(text)
+    os.replace(temporary_filename, filename)
@@ -0,0 +1,125 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator
+
+PROFILE_DIRECTORY = "data/profiles"
+
+# Number of functions and allocation sites listed in the text summaries
+SUMMARY_LIMIT = 30
+
+# Allocations made by the profiling itself are left out of the allocation summaries
+ALLOCATION_FILTERS = [tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats)] + [tracemalloc.Filter(False, __file__)]
+
+# From Python 3.12, cProfile sees every thread, while older versions only profile the thread that enabled it
+PROFILER_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class RunProfiler():
+    """Profiles each phase of a run with cProfile and tracemalloc, for the `--profile` mode of `main.py`.
+
+    For every phase entered with `phase`, a pstats file, a text summary of the slowest functions and a
+    text summary of the largest allocations are written to a directory for the run under
+    `PROFILE_DIRECTORY`. `close` writes `summary.json` with the wall time, CPU time and time spent
+    waiting on requests and the rate limits of each phase.
+
+    Before Python 3.12 cProfile only profiles one thread, so every thread started after the profiler
+    gets its own profiler, and their stats for the whole run are written to `threads.pstats`.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIRECTORY) -> None:
+        self.directory = os.path.join(directory, datetime.now().strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(self.directory, exist_ok=True)
+        self._phases: "list[dict]" = []
+        self._thread_profilers: "list[cProfile.Profile]" = []
+        self._lock = threading.Lock()
+
+        tracemalloc.start()
+        if not PROFILER_SEES_ALL_THREADS:
+            threading.setprofile(self._profile_thread)
+
+    def _profile_thread(self, frame, event, arg):
+        """Replace the temporary profile function of a new thread with a profiler of its own."""
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append(profiler)
+        profiler.enable()
+
+    @contextmanager
+    def phase(self, name: str, waiting: "Callable[[], dict[str, float]] | None" = None) -> Iterator[None]:
+        """Profile the statements inside the `with` block. `waiting` returns the seconds spent waiting so far by kind."""
+        index = len(self._phases) + 1
+        waiting_before = waiting() if waiting is not None else {}
+        snapshot_before = tracemalloc.take_snapshot().filter_traces(ALLOCATION_FILTERS)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+        profiler = cProfile.Profile()
+        wall_start, cpu_start, thread_cpu_start = time.perf_counter(), time.process_time(), time.thread_time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            thread_cpu_time = time.thread_time() - thread_cpu_start
+            _, peak_memory = tracemalloc.get_traced_memory()
+            snapshot_after = tracemalloc.take_snapshot().filter_traces(ALLOCATION_FILTERS)
+
+            filename = os.path.join(self.directory, f"{index:02d}_{name}")
+            profiler.dump_stats(f"{filename}.pstats")
+            self._write_function_summary(f"{filename}_functions.txt", profiler)
+            self._write_allocation_summary(f"{filename}_allocations.txt", snapshot_after.compare_to(snapshot_before, "lineno"))
+
+            waiting_after = waiting() if waiting is not None else {}
+            self._phases.append({
+                "phase": name,
+                "wall_seconds": wall_time,
+                "cpu_seconds": cpu_time,
+                "main_thread_cpu_seconds": thread_cpu_time,
+                # Time no thread was using the CPU, which is mostly spent waiting on the network and rate limits
+                "idle_seconds": max(0.0, wall_time - cpu_time),
+                **{kind: seconds - waiting_before.get(kind, 0.0) for kind, seconds in waiting_after.items()},
+                "peak_traced_memory_mb": peak_memory / 2**20,
+            })
+
+    @staticmethod
+    def _write_function_summary(filename: str, profiler: cProfile.Profile):
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(SUMMARY_LIMIT)
+        with open(filename, "w") as f:
+            f.write(output.getvalue())
+
+    @staticmethod
+    def _write_allocation_summary(filename: str, differences: "list[tracemalloc.StatisticDiff]"):
+        with open(filename, "w") as f:
+            f.write(f"Largest memory allocations during the phase, top {SUMMARY_LIMIT}\n\n")
+            for difference in differences[:SUMMARY_LIMIT]:
+                f.write(f"{difference}\n")
+
+    def close(self):
+        """Stop profiling, and write the stats of the other threads and the summary of the phases."""
+        if not PROFILER_SEES_ALL_THREADS:
+            threading.setprofile(None)
+        tracemalloc.stop()
+
+        with self._lock:
+            thread_profilers = list(self._thread_profilers)
+        if thread_profilers:
+            # The write workers and TMDb threads have been stopped by now, so their profilers are no longer collecting
+            stats = pstats.Stats(thread_profilers[0])
+            for profiler in thread_profilers[1:]:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(self.directory, "threads.pstats"))
+
+        with open(os.path.join(self.directory, "summary.json"), "w") as f:
+            json.dump({"phases": self._phases}, f, indent=2)
@@ -0,0 +1,215 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from custom_dataclasses import JSON_ENCODER, FilmProject, Person
+
+STATE_DATABASE_FILENAME = "data/state.sqlite"
+
+
+class StateStore():
+    """Local SQLite mirror of the person, upcoming and released Notion databases.
+
+    The raw pages of each database are stored together with the sync cursor of the database, so a
+    run can start from the local copy and only fetch the pages that changed in Notion. The parsed
+    people and projects are stored in indexed tables, with the relations between them, so that the
+    mappings between Notion page ids and TMDb ids are simple queries.
+
+    Every write happens in a transaction, so a run that is interrupted never leaves a half written state.
+    """
+
+    def __init__(self, filename: str = STATE_DATABASE_FILENAME) -> None:
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.transaction() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_id TEXT PRIMARY KEY,
+                    database TEXT NOT NULL,
+                    last_edited_time TEXT NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS pages_database ON pages (database);
+
+                CREATE TABLE IF NOT EXISTS sync_cursors (
+                    database TEXT PRIMARY KEY,
+                    cursor TEXT
+                );
+
+                CREATE TABLE IF NOT EXISTS people (
+                    page_id TEXT PRIMARY KEY,
+                    tmdb_id TEXT,
+                    name TEXT NOT NULL,
+                    tmdb_url TEXT,
+                    imdb_url TEXT,
+                    is_director INTEGER NOT NULL,
+                    is_actor INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS people_tmdb_id ON people (tmdb_id);
+
+                CREATE TABLE IF NOT EXISTS projects (
+                    page_id TEXT PRIMARY KEY,
+                    database TEXT NOT NULL,
+                    tmdb_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    release_date TEXT,
+                    popularity REAL,
+                    excluded INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS projects_tmdb_id ON projects (tmdb_id);
+                CREATE INDEX IF NOT EXISTS projects_database ON projects (database);
+
+                CREATE TABLE IF NOT EXISTS relations (
+                    project_page_id TEXT NOT NULL,
+                    person_page_id TEXT NOT NULL,
+                    PRIMARY KEY (project_page_id, person_page_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS relations_person_page_id ON relations (person_page_id);
+                """
+            )
+
+    @contextmanager
+    def transaction(self) -> "Iterator[sqlite3.Connection]":
+        """Run the statements inside the `with` block as one transaction, which is rolled back on errors."""
+        with self._lock:
+            with self._connection:
+                yield self._connection
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    ##### RAW PAGES #####
+
+    def get_cursor(self, database: str) -> "str | None":
+        with self._lock:
+            row = self._connection.execute("SELECT cursor FROM sync_cursors WHERE database = ?", (database,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name: str, cursor: "str | None"):
+        """Save the sync cursor of a database, or a cursor that isn't tied to one like the time of the last release check."""
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO sync_cursors VALUES (?, ?)", (name, cursor))
+
+    def iter_pages(self, database: str, batch_size: int = 100) -> "Iterator[list[dict]]":
+        """Yield the raw pages of `database` `batch_size` at a time, ordered by page id."""
+        last_page_id = ""
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT page_id, data FROM pages WHERE database = ? AND page_id > ? ORDER BY page_id LIMIT ?",
+                    (database, last_page_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_page_id = rows[-1][0]
+            yield [json.loads(data) for _, data in rows]
+
+    def save_pages(self, database: str, pages: "list[dict]", removed_page_ids: "list[str]" = ()):
+        """Save changed pages of `database` and remove archived ones."""
+        with self.transaction() as connection:
+            self._delete_pages(connection, removed_page_ids)
+            connection.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                [(page["id"], database, page["last_edited_time"], JSON_ENCODER.encode(page)) for page in pages]
+            )
+
+    def delete_pages_except(self, database: str, page_ids: "set[str]"):
+        """Remove the pages of `database` that are not in `page_ids`, after a full sync."""
+        with self.transaction() as connection:
+            stored_page_ids = [row[0] for row in connection.execute("SELECT page_id FROM pages WHERE database = ?", (database,))]
+            self._delete_pages(connection, [page_id for page_id in stored_page_ids if page_id not in page_ids])
+
+    def remove_page(self, page_id: str):
+        """Remove an archived page together with its person or project and their relations."""
+        with self.transaction() as connection:
+            self._delete_pages(connection, [page_id])
+
+    @staticmethod
+    def _delete_pages(connection: sqlite3.Connection, page_ids: "list[str]"):
+        rows = [(page_id,) for page_id in page_ids]
+        connection.executemany("DELETE FROM pages WHERE page_id = ?", rows)
+        connection.executemany("DELETE FROM people WHERE page_id = ?", rows)
+        connection.executemany("DELETE FROM projects WHERE page_id = ?", rows)
+        connection.executemany("DELETE FROM relations WHERE project_page_id = ? OR person_page_id = ?", [(page_id, page_id) for page_id in page_ids])
+
+    ##### PEOPLE AND PROJECTS #####
+
+    def save_people(self, persons: "list[Person]"):
+        """Replace the people with `persons`."""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM people")
+            self._insert_people(connection, persons)
+
+    def update_people(self, persons: "list[Person]"):
+        """Save the current ids and urls of `persons`, e.g. after their urls were filled in."""
+        with self.transaction() as connection:
+            self._insert_people(connection, persons)
+
+    @staticmethod
+    def _insert_people(connection: sqlite3.Connection, persons: "list[Person]"):
+        connection.executemany(
+            "INSERT OR REPLACE INTO people VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(p.notion_page_id, p.tmdb_id, p.name, p.tmdb_url, p.imdb_url, p.is_director, p.is_actor) for p in persons]
+        )
+
+    def save_projects(self, database: str, projects: "list[FilmProject]"):
+        """Replace the projects of `database` with `projects`, including their relations to people."""
+        with self.transaction() as connection:
+            page_ids = [(row[0],) for row in connection.execute("SELECT page_id FROM projects WHERE database = ?", (database,))]
+            connection.executemany("DELETE FROM relations WHERE project_page_id = ?", page_ids)
+            connection.execute("DELETE FROM projects WHERE database = ?", (database,))
+            for project in projects:
+                self._insert_project(connection, database, project.notion_page_id, project)
+
+    def add_project(self, database: str, page_id: str, project: FilmProject):
+        """Save a project that was just added to `database` as the page `page_id`."""
+        with self.transaction() as connection:
+            self._insert_project(connection, database, page_id, project)
+
+    @staticmethod
+    def _insert_project(connection: sqlite3.Connection, database: str, page_id: str, project: FilmProject):
+        connection.execute(
+            "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                page_id,
+                database,
+                project.tmdb_id,
+                project.title,
+                project.release_date,
+                project.popularity,
+                project.excluded,
+            )
+        )
+        StateStore._insert_relations(connection, page_id, project.associated_person_page_ids)
+
+    def save_relations(self, project_page_id: str, person_page_ids: "list[str]"):
+        """Replace the people related to a project page."""
+        with self.transaction() as connection:
+            self._insert_relations(connection, project_page_id, person_page_ids)
+
+    @staticmethod
+    def _insert_relations(connection: sqlite3.Connection, project_page_id: str, person_page_ids: "list[str]"):
+        connection.execute("DELETE FROM relations WHERE project_page_id = ?", (project_page_id,))
+        connection.executemany("INSERT OR IGNORE INTO relations VALUES (?, ?)", [(project_page_id, person_page_id) for person_page_id in person_page_ids])
+
+    def project_tmdb_ids(self, database: str) -> "dict[str, str]":
+        """Return the TMDb id of each project in `database` by page id."""
+        with self._lock:
+            return dict(self._connection.execute("SELECT page_id, tmdb_id FROM projects WHERE database = ?", (database,)).fetchall())
+
+    def person_project_tmdb_ids(self, database: str = "upcoming") -> "dict[str, list[str]]":
+        """Return the TMDb ids of the projects in `database` related to each person by person page id."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT relations.person_page_id, projects.tmdb_id FROM relations JOIN projects ON projects.page_id = relations.project_page_id "
+                "WHERE projects.database = ? ORDER BY relations.person_page_id, projects.rowid",
+                (database,)
+            ).fetchall()
+        tmdb_ids: "dict[str, list[str]]" = {}
+        for person_page_id, tmdb_id in rows:
+            tmdb_ids.setdefault(person_page_id, []).append(tmdb_id)
+        return tmdb_ids
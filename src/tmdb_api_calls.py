@@ -1,10 +1,11 @@
-import json
 import os
 import re
-from datetime import datetime
+import threading
+from datetime import date, datetime
 from dotenv import find_dotenv, load_dotenv
 from custom_dataclasses import FilmProject, Person
 from custom_logger import CustomLogger
+from genre_registry import GENRE_REGISTRY
 from requests_session import RateLimitedSession
 
 load_dotenv(find_dotenv())
@@ -13,28 +14,62 @@ load_dotenv(find_dotenv())
 ##### CONSTANTS #####
 
 TMDB_API_TOKEN = os.environ.get("TMDB_API_TOKEN")
+# Points the requests at the fake TMDb server of the benchmarks
+TMDB_API_BASE_URL = os.environ.get("TMDB_API_BASE_URL", "https://api.themoviedb.org/3")
 
 IMDB_MOVIE_URL = "https://imdb.com/title"
+IMDB_PERSON_URL = "https://imdb.com/name"
 
 TMDB_MOVIE_URL = "https://www.themoviedb.org/movie"
 TMDB_PERSON_URL = "https://www.themoviedb.org/person"
 
-TMDB_API_MOVIE_DETAILS_URL = "https://api.themoviedb.org/3/movie"
-TMDB_API_MOVIES_URL = "https://api.themoviedb.org/3/discover/movie"
-TMDB_API_PERSON_URL = "https://api.themoviedb.org/3/search/person?query="
-TMDB_API_GENRES_URL = "https://api.themoviedb.org/3/genre/movie/list?language=en"
+TMDB_API_MOVIE_DETAILS_URL = f"{TMDB_API_BASE_URL}/movie"
+TMDB_API_MOVIES_URL = f"{TMDB_API_BASE_URL}/discover/movie"
+TMDB_API_MOVIE_CHANGES_URL = f"{TMDB_API_BASE_URL}/movie/changes"
+TMDB_API_PERSON_DETAILS_URL = f"{TMDB_API_BASE_URL}/person"
+TMDB_API_PERSON_URL = f"{TMDB_API_BASE_URL}/search/person?query="
+TMDB_API_GENRES_URL = f"{TMDB_API_BASE_URL}/genre/movie/list?language=en"
 # TMDB_API_EXT_ID_URL = "https://api.themoviedb.org/3/movie/"
 
-TMDB_GENRES_FILE = "data/genres.json"
-TMDB_PERSON_IDS_FILE = "data/person_ids.json"
+TMDB_CACHE_FILE = "data/tmdb_cache.sqlite"
 
-DATE_TODAY = datetime.today().date()
+DAY = 24 * 60 * 60
+
+# How long responses from each endpoint are cached, the first matching pattern is used
+TMDB_CACHE_TTLS = [
+    (r"/external_ids", 90 * DAY),
+    (r"/search/person", 90 * DAY),
+    (r"/genre/movie/list", 7 * DAY),
+    (r"/person/\d+/movie_credits", 1 * DAY),
+    (r"/movie/\d+/credits", 1 * DAY),
+    (r"/discover/movie", 0.5 * DAY),
+    (r"/movie/\d+(\?|$)", 0.5 * DAY),
+]
+
+
+def today() -> date:
+    """The current date, looked up on every call so the daemon mode doesn't keep the date it was started on."""
+    return datetime.today().date()
+
+
+# The changes endpoint only covers up to 14 days at a time
+TMDB_CHANGES_MAX_DAYS = 14
+
+GENRE_REFRESH_LOCK = threading.Lock()
 
 HEADERS = {
     "accept": "application/json",
     "Authorization": f"Bearer {TMDB_API_TOKEN}"
 }
 
+# Sorting by release date lets the pagination stop at the first page of released movies
+DISCOVER_PARAMS = {
+    "include_adult": False,
+    "include_video": False,
+    "language": "en-US",
+    "sort_by": "primary_release_date.desc",
+}
+
 
 
 def normalize_string(title: str) -> str:
@@ -51,225 +86,162 @@ def normalize_string(title: str) -> str:
     return normalized_title.lower()
 
 
-def get_person_id(requests_session: RateLimitedSession, name: str) -> str:
-    """Looks up the id of the director/actor on TMDb for use in future API calls with this person."""
-    person_id = ""
-
-    response = requests_session.get(f"{TMDB_API_PERSON_URL}{name}", headers=HEADERS)
-
-    data = response.json()
-    if response.status_code == 200 and data["results"]:
-        person_id = data["results"][0]["id"]
-        
-    return person_id
-
-
-def get_external_id_person(requests_session: RateLimitedSession, person_id: str) -> str:
-    """Retrieve external (imdb) id for a person."""
-    imdb_id = ""
-    external_ids_url = f"https://api.themoviedb.org/3/person/{person_id}/external_ids"
-
-    response = requests_session.get(external_ids_url, headers=HEADERS)
-
-    data = response.json()
-    if response.status_code == 200:
-        imdb_id = data["imdb_id"]
-    else:
-        CustomLogger.error(f"Error in get_external_id_person({person_id=}): {data['status_message']}")
-
-    return imdb_id
-
-
-def get_external_id_project(requests_session: RateLimitedSession, project_id: str) -> str:
-    """Retrieve external (imdb) id for a film project."""
-    imdb_id = ""
-    external_ids_url = f"https://api.themoviedb.org/3/movie/{project_id}/external_ids"
-
-    response = requests_session.get(external_ids_url, headers=HEADERS)
-
-    data = response.json()
-    if response.status_code == 200:
-        imdb_id = data["imdb_id"]
-    else:
-        CustomLogger.error(f"Error in get_external_id_project({project_id=}): {data['status_message']}")
-
-    return imdb_id
+def build_person_urls(name: str, tmdb_id: str, imdb_id: str) -> "tuple[str, str]":
+    """Build the TMDb and IMDb urls of a person from their ids. The IMDb url is empty without an IMDb id."""
+    tmdb_url = f"{TMDB_PERSON_URL}/{tmdb_id}-{normalize_string(title=name)}"
+    imdb_url = f"{IMDB_PERSON_URL}/{imdb_id}" if imdb_id else ""
+    return tmdb_url, imdb_url
 
 
 def get_genres_by_id(requests_session: RateLimitedSession, genre_ids: "list[int]") -> "list[str]":
-    """Convert TMDb genre ids to the genre names, either from existing file or from the API."""
-
-    all_genres: dict[str, str] = {}
-
-    # Check if the genres file already exists
-    if os.path.isfile(TMDB_GENRES_FILE):
-        with open(TMDB_GENRES_FILE, "r") as file:
-            all_genres = json.load(file)
-    else:
-        # Fetch the genres from the TMDB API
-        response = requests_session.get(TMDB_API_GENRES_URL, headers=HEADERS)
-        data = response.json()
-
-        if response.status_code == 200:
-            all_genres = {genre["id"]: genre["name"] for genre in data["genres"]}
-            
-            # Save the genres to a JSON file for future use
-            with open(TMDB_GENRES_FILE, "w") as file:
-                json.dump(all_genres, file, indent=4)
-        else:
-            CustomLogger.error(f"Error in get_genres_by_id({genre_ids=}): {data['status_message']}")
-    
-    current_genres = [all_genres.get(str(genre_id)) for genre_id in genre_ids]
-    current_genres = [genre for genre in current_genres if genre is not None]
-    return current_genres
-
-
-
-def create_film_projects_from_response(requests_session: RateLimitedSession, json_data: dict, person: Person) -> "list[FilmProject]":
-    """Extract relevant details from the API response and create `FilmProject` objects."""
-    projects = []
-    
-    film_projects = json_data["results"]
-    for film_project in film_projects:
-
-        # Filter only projects that doesn't have a release date or that has a release date in the future
-        release_date = film_project.get("release_date")
-        if not release_date or datetime.strptime(release_date, "%Y-%m-%d").date() > DATE_TODAY:
-        
-            film_id = str(film_project["id"])
-
-            # Fetch detailed information for the movie
-            movie_credits_url = f"{TMDB_API_MOVIE_DETAILS_URL}/{film_id}/credits"
-            response = requests_session.get(movie_credits_url, params={"language": "en-US"}, headers=HEADERS)
-            movie_details = response.json()
-
-            cast = movie_details.get("cast", [])
-            crew = movie_details.get("crew", [])
-            
-            # Check if the person is in the cast or is the director
-            person_found = False
-            for cast_member in cast:
-                if str(cast_member["id"]) == person.tmdb_id:
-                    person_found = True
-                    break
-            if not person_found:
-                for crew_member in crew:
-                    crew_member_id = str(crew_member["id"])
-                    crew_member_job = crew_member["job"]
-                    if crew_member_id == person.tmdb_id and crew_member_job == "Director":
-                        person_found = True
-                        break
-            if not person_found:
-                continue
-
-            title = film_project["title"]
-            synopsis = film_project["overview"]
-            genre_ids = film_project["genre_ids"]
-            popularity = film_project["popularity"]
-
-            imdb_id = get_external_id_project(requests_session=requests_session, project_id=film_id)
-            imdb_url = f"{IMDB_MOVIE_URL}/{imdb_id}" if imdb_id else ""
-            
-            # Build the url for the film project
-            normalized_title = normalize_string(title=title)
-            tmdb_url = f"{TMDB_MOVIE_URL}/{film_id}-{normalized_title}"
-
-            # Convert genre ids to actual genres
-            genres = get_genres_by_id(requests_session=requests_session, genre_ids=genre_ids)
-            project = FilmProject(
-                tmdb_id=film_id,
-                tmdb_url=tmdb_url,
-                imdb_url=imdb_url,
-                title=title,
-                synopsis=synopsis,
-                genres=genres,
-                popularity=popularity,
-                associated_person_page_ids=[person.notion_page_id],
-            )
-
-            if release_date:
-                project.release_date = release_date
-
-            projects.append(project)
-
-    return projects
-
-
-def find_upcoming_projects(requests_session: RateLimitedSession, person: Person) -> "list[FilmProject]":
-    """Calls the API with the id of the person and returns upcoming projects with said person."""
-
-    film_projects = []
-
-    params = {
-        "include_adult": False,
-        "include_video": False,
-        "language": "en-US",
-        "sort_by": "primary_release_date.desc",
-        "page": 1
-    }
-
-    total_pages = 2
-
+    """Convert TMDb genre ids to the genre names, fetching the genres from the API if any of the ids are unknown."""
+
+    if GENRE_REGISTRY.missing_genre_ids(genre_ids) and not GENRE_REGISTRY.tmdb_genres_refreshed:
+        # Only one thread needs to fetch the genres when projects are created concurrently
+        with GENRE_REFRESH_LOCK:
+            if not GENRE_REGISTRY.tmdb_genres_refreshed:
+                # Fetch the genres from the TMDB API
+                response = requests_session.get(TMDB_API_GENRES_URL, headers=HEADERS)
+                data = response.json()
+
+                if response.status_code == 200:
+                    GENRE_REGISTRY.update_tmdb_genres(genres=data["genres"])
+                else:
+                    CustomLogger.error(f"Error in get_genres_by_id({genre_ids=}): {data['status_message']}")
+
+    return GENRE_REGISTRY.get_genre_names(genre_ids)
+
+
+def is_upcoming(release_date: str) -> bool:
+    """Check if a project doesn't have a release date or has a release date in the future."""
+    return not release_date or datetime.strptime(release_date, "%Y-%m-%d").date() > today()
+
+
+def person_in_credits(credits: dict, person: Person) -> bool:
+    """Check if the person is in the cast or is the director in the credits response of a movie."""
+    for cast_member in credits.get("cast", []):
+        if str(cast_member["id"]) == person.tmdb_id:
+            return True
+    for crew_member in credits.get("crew", []):
+        if str(crew_member["id"]) == person.tmdb_id and crew_member["job"] == "Director":
+            return True
+    return False
+
+
+def get_credited_persons(credits: dict, actors: "dict[str, list[Person]]", directors: "dict[str, list[Person]]") -> "list[Person]":
+    """Return the persons from `actors` in the cast and from `directors` directing in the credits response of a movie.
+
+    `actors` and `directors` map TMDb person ids to the persons with that id.
+    """
+    credited_persons: "list[Person]" = []
+    for cast_member in credits.get("cast", []):
+        credited_persons.extend(actors.get(str(cast_member["id"]), []))
+    for crew_member in credits.get("crew", []):
+        if crew_member["job"] == "Director":
+            credited_persons.extend(directors.get(str(crew_member["id"]), []))
+
+    # Keep the order, but only list each person once
+    return list({person.notion_page_id: person for person in credited_persons}.values())
+
+
+def build_film_project(film_project: dict, imdb_id: str, genres: "list[str]", person: Person) -> FilmProject:
+    """Create a `FilmProject` from a movie in a TMDb response."""
+    film_id = str(film_project["id"])
+    title = film_project["title"]
+
+    imdb_url = f"{IMDB_MOVIE_URL}/{imdb_id}" if imdb_id else ""
+
+    # Build the url for the film project
+    normalized_title = normalize_string(title=title)
+    tmdb_url = f"{TMDB_MOVIE_URL}/{film_id}-{normalized_title}"
+
+    project = FilmProject(
+        tmdb_id=film_id,
+        tmdb_url=tmdb_url,
+        imdb_url=imdb_url,
+        title=title,
+        synopsis=film_project["overview"],
+        genres=genres,
+        popularity=film_project["popularity"],
+        associated_person_page_ids=[person.notion_page_id],
+        release_date=film_project.get("release_date") or None,
+    )
+
+    return project
+
+
+def build_film_project_from_details(movie_details: dict, project: FilmProject) -> FilmProject:
+    """Create an up to date copy of `project` from a TMDb movie details response, keeping its Notion page and people."""
+    imdb_id = movie_details.get("imdb_id")
+    title = movie_details["title"]
+
+    fresh_project = FilmProject(
+        tmdb_id=project.tmdb_id,
+        tmdb_url=f"{TMDB_MOVIE_URL}/{project.tmdb_id}-{normalize_string(title=title)}",
+        imdb_url=f"{IMDB_MOVIE_URL}/{imdb_id}" if imdb_id else "",
+        title=title,
+        synopsis=movie_details["overview"],
+        genres=[genre["name"] for genre in movie_details.get("genres", [])],
+        popularity=movie_details["popularity"],
+        associated_person_page_ids=list(project.associated_person_page_ids),
+        release_date=movie_details.get("release_date") or None,
+        notion_page_id=project.notion_page_id,
+        excluded=project.excluded,
+    )
+
+    return fresh_project
+
+
+def is_past_page(json_data: dict) -> bool:
+    """Check if a discover page sorted by descending release date ends with an already released movie.
+
+    All following pages then only contain movies released even earlier, so there is no need to fetch them.
+    """
+    results = json_data.get("results", [])
+    if not results:
+        return True
+    release_date = results[-1].get("release_date")
+    return bool(release_date) and not is_upcoming(release_date)
+
+
+def get_upcoming_credits(json_data: dict, person: Person) -> "list[dict]":
+    """Return the unreleased movies from a movie credits response where the person acts or directs."""
+    credits = []
     if person.is_actor:
-        params["with_cast"] = person.tmdb_id
-
-        while params["page"] <= total_pages:
-
-            response = requests_session.get(TMDB_API_MOVIES_URL, params=params, headers=HEADERS)
-
-            data = response.json()
-
-            if response.status_code == 200:
-                projects = create_film_projects_from_response(requests_session=requests_session, json_data=data, person=person)
-                film_projects.extend(projects)
-
-                params["page"] += 1
-                total_pages = data["total_pages"]
-            else:
-                CustomLogger.error(f"Error in the actor block of find_upcoming_projects({person.name=}): {data['status_message']}")
-
-    params["page"] = 1
-    total_pages = 2
-
+        credits.extend(json_data.get("cast", []))
     if person.is_director:
-        params["with_crew"] = person.tmdb_id
-        params["crew_position"] = "Director"
-
-        while params["page"] <= total_pages:
-            response = requests_session.get(TMDB_API_MOVIES_URL, params=params, headers=HEADERS)
-
-            data = response.json()
-
-            if response.status_code == 200:
-
-                projects = create_film_projects_from_response(requests_session=requests_session, json_data=data, person=person)
-                film_projects.extend(projects)
-
-                params["page"] += 1
-                total_pages = data["total_pages"]
-            else:
-                CustomLogger.error(f"Error in the director block of find_upcoming_projects({person.name=}): {data['status_message']}")
-
-    return film_projects
-
-
-def get_released_projects_from_previous(requests_session: RateLimitedSession, previous_projects: "list[FilmProject]") -> "list[FilmProject]":
-    """Check if any of the previous upcoming projects have been released and return the released projects."""
-
-    released_projects: "list[FilmProject]" = []
-
-    for project in previous_projects:
-        movie_url = f"{TMDB_API_MOVIE_DETAILS_URL}/{project.tmdb_id}"
-        response = requests_session.get(movie_url, params={"language": "en-US"}, headers=HEADERS)
-        movie_details = response.json()
-
-        if response.status_code == 200:
-            release_date = movie_details.get("release_date")
-            status = movie_details.get("status")
-            if release_date and datetime.strptime(release_date, "%Y-%m-%d").date() < DATE_TODAY and status == "Released":
-                released_projects.append(project)
-
-    return released_projects
+        credits.extend(crew_member for crew_member in json_data.get("crew", []) if crew_member["job"] == "Director")
+
+    # A person can have several credits for the same movie, e.g. both as actor and director
+    upcoming_credits: "dict[int, dict]" = {}
+    for credit in credits:
+        if credit.get("adult") or credit.get("video"):
+            continue
+        if credit["id"] not in upcoming_credits and is_upcoming(credit.get("release_date")):
+            upcoming_credits[credit["id"]] = credit
+
+    return list(upcoming_credits.values())
+
+
+def is_released(movie_details: dict) -> bool:
+    """Check if a movie details response is for a movie that has been released."""
+    release_date = movie_details.get("release_date")
+    return bool(release_date) and datetime.strptime(release_date, "%Y-%m-%d").date() < today() and movie_details.get("status") == "Released"
+
+
+def get_release_candidates(previous_projects: "list[FilmProject]", changed_ids: "set[str] | None") -> "list[FilmProject]":
+    """Return the previous projects that could have been released since the last release check.
+
+    A project is a candidate when its stored release date has passed, or when the movie has changed on
+    TMDb since the last check, since that is the only way its release date could have moved closer.
+    Without `changed_ids`, every project is a candidate.
+    """
+    if changed_ids is None:
+        return list(previous_projects)
+    return [
+        project for project in previous_projects
+        if project.tmdb_id in changed_ids or not is_upcoming(project.release_date)
+    ]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,459 @@
+import asyncio
+import functools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Iterator
+
+import requests
+
+from custom_dataclasses import FilmProject, Person
+from custom_logger import CustomLogger
+from person_id_cache import PersonIdCache
+from requests_session import RateLimitedSession
+from resilience import build_error_response
+from tmdb_api_calls import (
+    DISCOVER_PARAMS,
+    HEADERS,
+    TMDB_API_MOVIE_CHANGES_URL,
+    TMDB_API_MOVIE_DETAILS_URL,
+    TMDB_API_MOVIES_URL,
+    TMDB_API_PERSON_DETAILS_URL,
+    TMDB_API_PERSON_URL,
+    TMDB_CHANGES_MAX_DAYS,
+    build_film_project,
+    build_film_project_from_details,
+    build_person_urls,
+    get_credited_persons,
+    get_genres_by_id,
+    get_release_candidates,
+    get_upcoming_credits,
+    is_past_page,
+    is_released,
+    is_upcoming,
+    person_in_credits,
+    today,
+)
+
+# Ways of scanning the persons for upcoming projects, see `AsyncTMDbClient`
+SCAN_MODES = ["discover", "credits", "batch"]
+
+
+class AsyncTMDbClient():
+    """Scan TMDb for upcoming projects with many requests in flight at once.
+
+    The requests themselves are sent with the shared `RateLimitedSession` in a thread pool, so they use
+    the same rate limit budget as every other TMDb request. The event loop makes sure no more than
+    `max_concurrency` requests are in flight at the same time.
+
+    Param `scan_mode` must be either "discover", "credits" or "batch". The "discover" mode pages through
+    the discover endpoint and verifies the credits of every unreleased movie, while the "credits" mode
+    builds the projects from a single movie credits request per person. The "batch" mode sends the ids
+    of up to `batch_size` persons in each discover query and assigns every unreleased movie back to the
+    persons found in its credits.
+    """
+
+    def __init__(self, session: RateLimitedSession, max_concurrency: int = 10, scan_mode: str = "discover", batch_size: int = 50) -> None:
+        if scan_mode not in SCAN_MODES:
+            error = "Param `scan_mode` must be either 'discover', 'credits' or 'batch'."
+            CustomLogger.error(error)
+            raise ValueError(error)
+
+        self._session = session
+        self._max_concurrency = max_concurrency
+        self._scan_mode = scan_mode
+        self._batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # Created inside the running event loop, see `scan_persons_into_queue`
+        self._semaphore: "asyncio.Semaphore | None" = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def get(self, url: str, params: "dict | None" = None) -> requests.Response:
+        """Send a GET request to the TMDb API without blocking the event loop. A request that gets no response returns a 503 response."""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            request = functools.partial(self._session.get, url, params=params, headers=HEADERS)
+            try:
+                return await loop.run_in_executor(self._executor, request)
+            except requests.RequestException as error:
+                # The session has already retried the request, so only this person or project is skipped instead of the whole scan
+                CustomLogger.error(f"Error in get({url=}): {error!r}")
+                return build_error_response(url, str(error))
+
+    async def get_external_id_project(self, project_id: str) -> str:
+        """Retrieve external (imdb) id for a film project."""
+        response = await self.get(f"{TMDB_API_MOVIE_DETAILS_URL}/{project_id}/external_ids")
+        data = response.json()
+        if response.status_code == 200:
+            return data["imdb_id"] or ""
+        CustomLogger.error(f"Error in get_external_id_project({project_id=}): {data.get('status_message')}")
+        return ""
+
+    async def create_film_project(self, film_project: dict, person: Person, verify_credits: bool = True) -> "FilmProject | None":
+        """Verify that the person is credited in the movie and create a `FilmProject` from it."""
+        film_id = str(film_project["id"])
+
+        if verify_credits:
+            response = await self.get(f"{TMDB_API_MOVIE_DETAILS_URL}/{film_id}/credits", params={"language": "en-US"})
+            if not person_in_credits(credits=response.json(), person=person):
+                return None
+
+        imdb_id = await self.get_external_id_project(project_id=film_id)
+
+        loop = asyncio.get_running_loop()
+        genres = await loop.run_in_executor(
+            self._executor,
+            functools.partial(get_genres_by_id, requests_session=self._session, genre_ids=film_project["genre_ids"])
+        )
+
+        return build_film_project(film_project=film_project, imdb_id=imdb_id, genres=genres, person=person)
+
+    async def create_film_projects_from_results(self, results: "list[dict]", person: Person) -> "list[FilmProject]":
+        """Create `FilmProject` objects concurrently from the unreleased movies of a discover response."""
+        upcoming = [film_project for film_project in results if is_upcoming(film_project.get("release_date"))]
+        projects = await asyncio.gather(*[self.create_film_project(film_project, person) for film_project in upcoming])
+        return [project for project in projects if project is not None]
+
+    async def get_person_id(self, name: str) -> str:
+        """Look up the TMDb id of the person named `name`, or an empty string if nobody is found."""
+        response = await self.get(f"{TMDB_API_PERSON_URL}{name}")
+        data = response.json()
+        if response.status_code == 200 and data["results"]:
+            return str(data["results"][0]["id"])
+        return ""
+
+    async def get_external_id_person(self, person_id: str) -> str:
+        """Retrieve external (imdb) id for a person."""
+        response = await self.get(f"{TMDB_API_PERSON_DETAILS_URL}/{person_id}/external_ids")
+        data = response.json()
+        if response.status_code == 200:
+            return data["imdb_id"] or ""
+        CustomLogger.error(f"Error in get_external_id_person({person_id=}): {data.get('status_message')}")
+        return ""
+
+    async def resolve_person(self, person: Person, cache: PersonIdCache) -> bool:
+        """Find the TMDb and IMDb ids of a person with missing urls, and fill in their ids and urls.
+
+        A TMDb id read from an existing TMDb url is used instead of searching by name. Returns whether a
+        missing url was filled in, so False if the person can't be found on TMDb, and also for a person
+        whose only missing url is an IMDb url that TMDb doesn't have either.
+        """
+        ids = cache.get(person.name)
+        if ids is None:
+            tmdb_id = person.tmdb_id or await self.get_person_id(person.name)
+            if not tmdb_id:
+                CustomLogger.warning(f"Could not find {person.name} on TMDb")
+                return False
+            imdb_id = await self.get_external_id_person(tmdb_id)
+            cache.set(name=person.name, tmdb_id=tmdb_id, imdb_id=imdb_id)
+        else:
+            tmdb_id, imdb_id = ids
+
+        tmdb_url, imdb_url = build_person_urls(name=person.name, tmdb_id=tmdb_id, imdb_id=imdb_id)
+        filled_in = (not person.tmdb_url and tmdb_url) or (not person.imdb_url and imdb_url)
+        person.tmdb_id = tmdb_id
+        person.tmdb_url = person.tmdb_url or tmdb_url
+        person.imdb_url = person.imdb_url or imdb_url
+        return bool(filled_in)
+
+    async def resolve_persons(self, persons: "list[Person]", cache: PersonIdCache) -> "list[Person]":
+        """Resolve the ids of all persons concurrently, and return the persons with urls that were filled in."""
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        resolved = await asyncio.gather(*[self.resolve_person(person, cache) for person in persons])
+        cache.save()
+        return [person for person, is_resolved in zip(persons, resolved) if is_resolved]
+
+    def run_resolve_persons(self, persons: "list[Person]", cache: "PersonIdCache | None" = None) -> "list[Person]":
+        """Blocking entry point for `resolve_persons`."""
+        return asyncio.run(self.resolve_persons(persons, cache if cache is not None else PersonIdCache()))
+
+    async def check_project(self, project: FilmProject) -> "tuple[FilmProject | None, bool]":
+        """Return an up to date copy of `project` with the current details from TMDb, and whether it has been released.
+
+        The copy is None if the details can't be fetched.
+        """
+        response = await self.get(f"{TMDB_API_MOVIE_DETAILS_URL}/{project.tmdb_id}", params={"language": "en-US"})
+        data = response.json()
+        if response.status_code != 200:
+            CustomLogger.error(f"Error in check_project({project.tmdb_id=}): {data.get('status_message')}")
+            return None, False
+        return build_film_project_from_details(movie_details=data, project=project), is_released(data)
+
+    async def get_project_details(self, project: FilmProject) -> "FilmProject | None":
+        """Return an up to date copy of `project` with the current details from TMDb."""
+        fresh_project, _ = await self.check_project(project)
+        return fresh_project
+
+    async def refresh_projects(self, projects: "list[FilmProject]") -> "list[FilmProject]":
+        """Fetch the current details of all projects concurrently. Projects that can't be fetched are left out."""
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        fresh_projects = await asyncio.gather(*[self.get_project_details(project) for project in projects])
+        return [project for project in fresh_projects if project is not None]
+
+    def run_refresh(self, projects: "list[FilmProject]") -> "list[FilmProject]":
+        """Blocking entry point for `refresh_projects`."""
+        return asyncio.run(self.refresh_projects(projects))
+
+    async def check_projects(self, projects: "list[FilmProject]") -> "list[tuple[FilmProject | None, bool]]":
+        """Run `check_project` for all projects concurrently, in the same order as `projects`."""
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return await asyncio.gather(*[self.check_project(project) for project in projects])
+
+    def run_check_projects(self, projects: "list[FilmProject]") -> "list[tuple[FilmProject | None, bool]]":
+        """Blocking entry point for `check_projects`."""
+        return asyncio.run(self.check_projects(projects))
+
+    async def get_changed_movie_ids(self, start_date: date, max_pages: "int | None" = None) -> "set[str] | None":
+        """Return the ids of all movies changed on TMDb from `start_date` until today, or None if the changes can't be read.
+
+        Also returns None when the changes take more than `max_pages` pages.
+        """
+        params = {"start_date": start_date.isoformat(), "end_date": today().isoformat()}
+
+        response = await self.get(TMDB_API_MOVIE_CHANGES_URL, params={**params, "page": 1})
+        data = response.json()
+        if response.status_code != 200:
+            CustomLogger.error(f"Error in get_changed_movie_ids({start_date=}): {data.get('status_message')}")
+            return None
+        if max_pages is not None and data["total_pages"] > max_pages:
+            CustomLogger.debug(f"Not reading the {data['total_pages']} pages of movie changes since {start_date}")
+            return None
+
+        pages = [data]
+        responses = await asyncio.gather(*[self.get(TMDB_API_MOVIE_CHANGES_URL, params={**params, "page": page}) for page in range(2, data["total_pages"] + 1)])
+        for response in responses:
+            data = response.json()
+            if response.status_code != 200:
+                CustomLogger.error(f"Error in get_changed_movie_ids({start_date=}): {data.get('status_message')}")
+                return None
+            pages.append(data)
+
+        return {str(result["id"]) for page in pages for result in page["results"]}
+
+    async def check_released(self, project: FilmProject) -> "bool | None":
+        """Check if a project has been released. Returns None if the details can't be fetched."""
+        response = await self.get(f"{TMDB_API_MOVIE_DETAILS_URL}/{project.tmdb_id}", params={"language": "en-US"})
+        data = response.json()
+        if response.status_code != 200:
+            CustomLogger.error(f"Error in check_released({project.tmdb_id=}): {data.get('status_message')}")
+            return None
+        return is_released(data)
+
+    async def find_released_projects(self, projects: "list[FilmProject]", last_check: "date | None" = None) -> "tuple[list[FilmProject], bool]":
+        """Return the projects that have been released, only checking the projects that could have been released since `last_check`.
+
+        Without a `last_check`, or when it is too long ago for the changes endpoint, every project is checked.
+        The same happens when the changes since `last_check` take more requests than checking every project.
+        Also returns whether every checked project could be fetched.
+        """
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        changed_ids = None
+        if last_check is not None and (today() - last_check).days <= TMDB_CHANGES_MAX_DAYS:
+            changed_ids = await self.get_changed_movie_ids(start_date=last_check, max_pages=len(projects))
+
+        candidates = get_release_candidates(previous_projects=projects, changed_ids=changed_ids)
+        CustomLogger.debug(f"Checking {len(candidates)} of {len(projects)} upcoming projects for a release")
+
+        released = await asyncio.gather(*[self.check_released(project) for project in candidates])
+        released_projects = [project for project, is_project_released in zip(candidates, released) if is_project_released]
+        return released_projects, None not in released
+
+    def run_release_check(self, projects: "list[FilmProject]", last_check: "date | None" = None) -> "tuple[list[FilmProject], bool]":
+        """Blocking entry point for `find_released_projects`."""
+        return asyncio.run(self.find_released_projects(projects, last_check))
+
+    async def get_discover_pages(self, params: dict) -> "list[dict] | None":
+        """Fetch the discover pages for `params` until the pages only contain released movies. Returns None if a page couldn't be fetched."""
+        response = await self.get(TMDB_API_MOVIES_URL, params={**params, "page": 1})
+        data = response.json()
+        if response.status_code != 200:
+            CustomLogger.error(f"Error in get_discover_pages({params=}): {data.get('status_message')}")
+            return None
+
+        pages = [data]
+        total_pages = data["total_pages"]
+        next_page = 2
+
+        # Page 1 tells how many pages there are, so the next ones can be requested at the same time
+        while next_page <= total_pages and not is_past_page(pages[-1]):
+            page_numbers = range(next_page, min(next_page + self._max_concurrency, total_pages + 1))
+            next_page += len(page_numbers)
+
+            responses = await asyncio.gather(*[self.get(TMDB_API_MOVIES_URL, params={**params, "page": page}) for page in page_numbers])
+            for response in responses:
+                data = response.json()
+                if response.status_code != 200:
+                    CustomLogger.error(f"Error in get_discover_pages({params=}): {data.get('status_message')}")
+                    return None
+
+                pages.append(data)
+                if is_past_page(data):
+                    break
+
+        return pages
+
+    async def discover(self, params: dict, person: Person) -> "list[FilmProject] | None":
+        """Fetch all discover pages for `params` and return the upcoming projects of the person, or None if the pages couldn't be fetched."""
+        pages = await self.get_discover_pages(params)
+        if pages is None:
+            return None
+        projects = await asyncio.gather(*[self.create_film_projects_from_results(page["results"], person) for page in pages])
+        return [project for page_projects in projects for project in page_projects]
+
+    async def find_upcoming_projects_from_credits(self, person: Person) -> "list[FilmProject] | None":
+        """Return upcoming projects of the person using a single movie credits request, or None if the request failed."""
+        response = await self.get(f"{TMDB_API_PERSON_DETAILS_URL}/{person.tmdb_id}/movie_credits", params={"language": "en-US"})
+        data = response.json()
+        if response.status_code != 200:
+            CustomLogger.error(f"Error in find_upcoming_projects_from_credits({person.name=}): {data.get('status_message')}")
+            return None
+
+        credits = get_upcoming_credits(json_data=data, person=person)
+        projects = await asyncio.gather(*[self.create_film_project(credit, person, verify_credits=False) for credit in credits])
+        return [project for project in projects if project is not None]
+
+    async def find_upcoming_projects(self, person: Person) -> "list[FilmProject] | None":
+        """Return upcoming projects where the person is in the cast or is the director, or None if the scan failed."""
+        if self._scan_mode == "credits":
+            return await self.find_upcoming_projects_from_credits(person)
+
+        params = dict(DISCOVER_PARAMS)
+
+        searches = []
+        if person.is_actor:
+            searches.append(self.discover(params={**params, "with_cast": person.tmdb_id}, person=person))
+        if person.is_director:
+            searches.append(self.discover(params={**params, "with_crew": person.tmdb_id, "crew_position": "Director"}, person=person))
+
+        film_projects = []
+        for projects in await asyncio.gather(*searches):
+            if projects is None:
+                return None
+            film_projects.extend(projects)
+        return film_projects
+
+    async def create_batch_film_project(self, film_project: dict, actors: "dict[str, list[Person]]", directors: "dict[str, list[Person]]") -> "FilmProject | None":
+        """Create a `FilmProject` associated with every person of the batch that is credited in the movie."""
+        film_id = str(film_project["id"])
+
+        response = await self.get(f"{TMDB_API_MOVIE_DETAILS_URL}/{film_id}/credits", params={"language": "en-US"})
+        credited_persons = get_credited_persons(credits=response.json(), actors=actors, directors=directors)
+        if not credited_persons:
+            return None
+
+        project = await self.create_film_project(film_project, credited_persons[0], verify_credits=False)
+        project.associated_person_page_ids = [person.notion_page_id for person in credited_persons]
+        return project
+
+    async def scan_persons_batch(self, persons: "list[Person]") -> "list[tuple[Person, list[FilmProject] | None]]":
+        """Find upcoming projects for all persons with discover queries covering many persons at once.
+
+        Each project is shared between the persons credited in it, with all of them listed in
+        `associated_person_page_ids`. The persons of a query that failed get None instead of their projects.
+        """
+        actors: "dict[str, list[Person]]" = {}
+        directors: "dict[str, list[Person]]" = {}
+        for person in persons:
+            if not person.tmdb_id:
+                continue
+            if person.is_actor:
+                actors.setdefault(person.tmdb_id, []).append(person)
+            if person.is_director:
+                directors.setdefault(person.tmdb_id, []).append(person)
+
+        # Pipe separated ids are OR'ed by TMDb, while with_cast and with_crew would be AND'ed if combined
+        sweeps = []
+        sweep_persons: "list[list[Person]]" = []
+        for key, persons_by_id in (("with_cast", actors), ("with_crew", directors)):
+            ids = list(persons_by_id)
+            for i in range(0, len(ids), self._batch_size):
+                sweeps.append(self.get_discover_pages({**DISCOVER_PARAMS, key: "|".join(ids[i:i + self._batch_size])}))
+                sweep_persons.append([person for tmdb_id in ids[i:i + self._batch_size] for person in persons_by_id[tmdb_id]])
+
+        # The same movie shows up in several sweeps when several persons are involved in it
+        upcoming: "dict[int, dict]" = {}
+        failed_page_ids: "set[str]" = set()
+        for pages, swept_persons in zip(await asyncio.gather(*sweeps), sweep_persons):
+            if pages is None:
+                failed_page_ids.update(person.notion_page_id for person in swept_persons)
+                continue
+            for page in pages:
+                for film_project in page["results"]:
+                    if is_upcoming(film_project.get("release_date")):
+                        upcoming.setdefault(film_project["id"], film_project)
+
+        projects = await asyncio.gather(*[self.create_batch_film_project(film_project, actors, directors) for film_project in upcoming.values()])
+
+        person_projects: "dict[str, list[FilmProject]]" = {person.notion_page_id: [] for person in persons}
+        for project in projects:
+            if project is None:
+                continue
+            for page_id in project.associated_person_page_ids:
+                person_projects[page_id].append(project)
+
+        return [(person, None if person.notion_page_id in failed_page_ids else person_projects[person.notion_page_id]) for person in persons]
+
+    async def scan_persons_into_queue(self, persons: "list[Person]", results: queue.Queue):
+        """Put `(person, projects)` into `results` as soon as each person has been scanned, with None as the projects if the scan failed.
+
+        Scanning a person only starts when there is room for another result, so a slow consumer
+        limits how many scanned persons are held in memory.
+        """
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        loop = asyncio.get_running_loop()
+
+        if self._scan_mode == "batch":
+            for result in await self.scan_persons_batch(persons):
+                await loop.run_in_executor(None, results.put, result)
+            return
+
+        persons_in_progress = asyncio.Semaphore(results.maxsize or self._max_concurrency)
+
+        async def scan_person(person: Person):
+            async with persons_in_progress:
+                projects = await self.find_upcoming_projects(person)
+                await loop.run_in_executor(None, results.put, (person, projects))
+
+        await asyncio.gather(*[scan_person(person) for person in persons])
+
+    def iter_scan(self, persons: "list[Person]", queue_size: int = 10) -> "Iterator[tuple[Person, list[FilmProject] | None]]":
+        """Yield `(person, projects)` in the order the persons finish scanning, with None as the projects if the scan failed.
+
+        The scan runs in a background thread with its own event loop, and at most `queue_size` scanned
+        persons wait to be consumed. In "batch" mode every person is yielded at the end of the sweep.
+        """
+        results: queue.Queue = queue.Queue(maxsize=queue_size)
+        finished = object()
+        errors: "list[BaseException]" = []
+
+        def scan():
+            try:
+                asyncio.run(self.scan_persons_into_queue(persons, results))
+            except BaseException as error:
+                errors.append(error)
+            finally:
+                results.put(finished)
+
+        thread = threading.Thread(target=scan, daemon=True)
+        thread.start()
+
+        while True:
+            result = results.get()
+            if result is finished:
+                break
+            yield result
+
+        thread.join()
+        if errors:
+            raise errors[0]